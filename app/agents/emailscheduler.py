@@ -1,15 +1,27 @@
 # app/agents/emailscheduler.py
 
+import asyncio
+import logging
+import math
+import os
+import socket
+import threading
 import time
+import uuid
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Set, Tuple
 
 from sqlalchemy.orm import Session # For type hinting the session
 
 from app.utils.logger import logger
 from app.db import database # To call database functions
 from app.db.database import get_db  # To get a database session
-from app.utils.email_sender import send_email, EmailSendingResult
+from app.db.batch_writer import LeadCampaignStatusBatchWriter
+from app.utils.email_sender import send_email, EmailSendingResult, smtp_connection_pool
+from app.utils.config import settings
+from app.utils.due_time_wheel import due_time_wheel
+from app.utils.rate_limiter import SendRateLimiter
+from app.utils.templating import CompiledStepTemplateCache, lead_placeholder_values
 # Assuming your models are accessible via database.models if not imported directly
 # from app.db import models # Or from app.db.models import Lead, LeadCampaignStatus, etc.
 
@@ -20,7 +32,42 @@ class EmailSchedulerAgent:
     logging sent emails, and updating lead status.
     """
     def __init__(self):
-        logger.info("EmailSchedulerAgent initialized.")
+        # Identifies this worker's leases on lead_campaign_status rows; unique per process/instance
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.claim_lease_seconds = int(getattr(settings, "EMAIL_SCHEDULER_CLAIM_LEASE_SECONDS", 600))
+        self.claim_batch_size = int(getattr(settings, "EMAIL_SCHEDULER_CLAIM_BATCH_SIZE", 500))
+        self.tier_weights: Dict[str, float] = {}
+        for price_id, weight in (getattr(settings, "EMAIL_SCHEDULER_TIER_WEIGHTS", None) or {}).items():
+            if float(weight) > 0:
+                self.tier_weights[price_id] = float(weight)
+            else:
+                logger.warning(f"EmailSchedulerAgent: Ignoring non-positive fair-share weight {weight} for price '{price_id}'.")
+        self.drain_mode = bool(getattr(settings, "EMAIL_SCHEDULER_DRAIN_MODE", False))
+        self.drain_time_budget_seconds = int(getattr(settings, "EMAIL_SCHEDULER_DRAIN_TIME_BUDGET_SECONDS", 240))
+        if self.drain_mode and self.drain_time_budget_seconds >= self.claim_lease_seconds:
+            # Claims are held for the whole cycle; they must not expire while it is still draining
+            logger.warning(f"EmailSchedulerAgent: Drain time budget ({self.drain_time_budget_seconds}s) is not below the claim lease "
+                           f"({self.claim_lease_seconds}s); capping it at half the lease.")
+            self.drain_time_budget_seconds = self.claim_lease_seconds // 2
+        self.max_send_concurrency = int(getattr(settings, "EMAIL_SEND_MAX_CONCURRENCY", 10))
+        self.max_send_concurrency_per_org = int(getattr(settings, "EMAIL_SEND_MAX_CONCURRENCY_PER_ORG", 2))
+        self.template_cache = CompiledStepTemplateCache()
+        self.status_flush_rows = int(getattr(settings, "EMAIL_SCHEDULER_STATUS_FLUSH_ROWS", 200))
+        self.status_flush_interval_ms = int(getattr(settings, "EMAIL_SCHEDULER_STATUS_FLUSH_INTERVAL_MS", 1000))
+        # Lives as long as the agent so budgets carry over between cycles
+        self.rate_limiter = SendRateLimiter(
+            org_rate_per_minute=float(getattr(settings, "EMAIL_SEND_RATE_PER_ORG_PER_MINUTE", 60)),
+            org_burst=float(getattr(settings, "EMAIL_SEND_BURST_PER_ORG", 20)),
+            host_rate_per_minute=float(getattr(settings, "EMAIL_SEND_RATE_PER_HOST_PER_MINUTE", 300)),
+            host_burst=float(getattr(settings, "EMAIL_SEND_BURST_PER_HOST", 50)),
+        )
+        self.due_wheel = due_time_wheel
+        self.deferred_retry_seconds = float(getattr(settings, "EMAIL_SCHEDULER_DEFERRED_RETRY_SECONDS", 30))
+        self._cycle_running = False
+        self.backlog_stats_interval_seconds = float(getattr(settings, "EMAIL_SCHEDULER_BACKLOG_STATS_INTERVAL_SECONDS", 300))
+        self._backlog_stats_logged_at = float("-inf")
+        self.cycle_running_recheck_seconds = 1.0 # Due-time loop polls this often while a cycle runs; no DB work
+        logger.info(f"EmailSchedulerAgent initialized (worker_id: {self.worker_id}).")
 
     def _calculate_next_due_at(self, base_time: datetime, delay_days: int) -> datetime:
         if delay_days < 0:
@@ -29,222 +76,430 @@ class EmailSchedulerAgent:
             base_time = base_time.replace(tzinfo=timezone.utc)
         return base_time + timedelta(days=delay_days)
 
-    def _personalize_template(self, template: Optional[str], lead_orm_obj: Any) -> str: # Changed to accept ORM object
-        """Replaces placeholders in a template string with lead data from an ORM object."""
-        if not template:
-            return ""
-
-        personalized_content = template
-        # Access attributes from the ORM object
-        lead_name = getattr(lead_orm_obj, "name", "")
-        first_name = lead_name.split(" ")[0] if lead_name else "there"
-
-        placeholders = {
-            "{{lead_name}}": lead_name or "there",
-            "{{lead_first_name}}": first_name,
-            "{{company_name}}": getattr(lead_orm_obj, "company", "your company"),
-            "{{title}}": getattr(lead_orm_obj, "title", "your role"),
-            "{{industry}}": getattr(lead_orm_obj, "industry", "your industry"),
-            "{{location}}": getattr(lead_orm_obj, "location", "your area"),
-        }
-        for placeholder, value in placeholders.items():
-            replacement_value = str(value) if value is not None else ""
-            personalized_content = personalized_content.replace(placeholder, replacement_value)
-        return personalized_content
-
-    def run_scheduler_cycle(self):
-        cycle_start_time = datetime.now(timezone.utc)
-        logger.info(f"--- Starting email scheduler cycle ({cycle_start_time.isoformat()}) ---")
-
-        processed_count = 0
-        error_count = 0
-        skipped_count = 0
-
-        db_session: Session = next(get_db()) # <--- GET A DATABASE SESSION
-
-        try:
-            # Call the ORM version of the function, passing the db_session
-            active_lead_statuses: List[database.models.LeadCampaignStatus] = database.get_active_leads_due_for_step(
-                db=db_session,          # <--- PASS THE SESSION
-                organization_id=None,   # Get for all orgs
-                query_limit=500         # Example limit
-            )
-
-            if not active_lead_statuses:
-                logger.info("EmailSchedulerAgent: No leads currently due for an email.")
-                # No need to log full finish message here, it's done at the end of the try block
-                return # Exit early if no leads
-
-            logger.info(f"EmailSchedulerAgent: Found {len(active_lead_statuses)} lead campaign statuses potentially due for processing.")
-
-            for status_record in active_lead_statuses: # status_record is now an ORM object
-                now_utc = datetime.now(timezone.utc)
-                # Access attributes directly from the ORM object
-                lead_id = status_record.lead_id
-                campaign_id = status_record.campaign_id
-                organization_id = status_record.organization_id
-                status_id = status_record.id # lead_campaign_status.id
-                current_step_completed = status_record.current_step_number or 0
-
-                if not all([lead_id, campaign_id, organization_id, status_id is not None]):
-                    logger.warning(f"EmailSchedulerAgent: Skipping status record due to missing critical IDs from ORM object: LCS_ID {status_id}")
-                    error_count += 1
-                    continue
-
-                logger.debug(f"EmailSchedulerAgent: Evaluating LCS_ID: {status_id} (Lead: {lead_id}, Campaign: {campaign_id}, Org: {organization_id}, Last Step Sent: {current_step_completed})")
-
-                next_step_to_send_data: Optional[database.models.CampaignStep] = database.get_next_campaign_step(
-                    db=db_session, # <--- PASS SESSION
-                    campaign_id=campaign_id,
+    def _render_step_email(self, campaign_step: Any, lead_orm_obj: Any) -> Tuple[str, str, str]:
+        """Renders (subject, html_body, text_body) for a lead from the step's cached compiled templates."""
+        subject_tpl, body_tpl = self.template_cache.get(campaign_step)
+        values = lead_placeholder_values(lead_orm_obj)
+        body_text = body_tpl.render(values)
+        return subject_tpl.render(values), body_text.replace('\n', '<br/>'), body_text
+
+    def _prepare_send_jobs(self, status_writer: LeadCampaignStatusBatchWriter, working_set: List[Dict[str, Any]], cycle_stats: Dict[str, int]) -> List[Dict[str, Any]]:
+        """
+        Validates each working-set item and personalizes its email. Items that cannot be sent
+        get their status transition buffered right away; the rest are returned as send jobs.
+        """
+        send_jobs: List[Dict[str, Any]] = []
+        for work_item in working_set:
+            status_record: database.models.LeadCampaignStatus = work_item["status"]
+            # Access attributes directly from the ORM object
+            lead_id = status_record.lead_id
+            campaign_id = status_record.campaign_id
+            organization_id = status_record.organization_id
+            status_id = status_record.id # lead_campaign_status.id
+            current_step_completed = status_record.current_step_number or 0
+
+            if not all([lead_id, campaign_id, organization_id, status_id is not None]):
+                logger.warning(f"EmailSchedulerAgent: Skipping status record due to missing critical IDs from ORM object: LCS_ID {status_id}")
+                cycle_stats["errors"] += 1
+                continue
+
+            logger.debug(f"EmailSchedulerAgent: Evaluating LCS_ID: {status_id} (Lead: {lead_id}, Campaign: {campaign_id}, Org: {organization_id}, Last Step Sent: {current_step_completed})")
+
+            next_step_to_send_data: Optional[database.models.CampaignStep] = work_item["next_step"]
+
+            if not next_step_to_send_data:
+                logger.info(f"EmailSchedulerAgent: No further steps for Lead ID {lead_id} in Campaign {campaign_id}. Marking sequence as completed.")
+                status_writer.add(
+                    status_id=status_id,
                     organization_id=organization_id,
-                    current_step_number=current_step_completed
+                    updates={"status": "completed_sequence", "next_email_due_at": None} # updated_at managed by ORM/DB
                 )
+                continue
 
-                if not next_step_to_send_data:
-                    logger.info(f"EmailSchedulerAgent: No further steps for Lead ID {lead_id} in Campaign {campaign_id}. Marking sequence as completed.")
-                    database.update_lead_campaign_status(
-                        db=db_session, # <--- PASS SESSION
-                        status_id=status_id,
-                        organization_id=organization_id,
-                        updates={"status": "completed_sequence", "next_email_due_at": None} # updated_at managed by ORM/DB
-                    )
-                    continue
-
-                next_step_number_to_send = next_step_to_send_data.step_number
-                campaign_step_db_id = next_step_to_send_data.id
+            next_step_number_to_send = next_step_to_send_data.step_number
 
-                lead_data_orm_obj: Optional[database.models.Lead] = database.get_lead_by_id(
-                    db=db_session, # <--- PASS SESSION
-                    lead_id=lead_id,
-                    organization_id=organization_id
+            lead_data_orm_obj: Optional[database.models.Lead] = work_item["lead"]
+            if not lead_data_orm_obj:
+                logger.error(f"EmailSchedulerAgent: Lead data not found for Lead ID {lead_id}. Marking status as error.")
+                status_writer.add(
+                    status_id=status_id,
+                    organization_id=organization_id,
+                    updates={"status": "error_lead_not_found", "error_message": "Lead data missing."}
                 )
-                if not lead_data_orm_obj:
-                    logger.error(f"EmailSchedulerAgent: Lead data not found for Lead ID {lead_id}. Marking status as error.")
-                    database.update_lead_campaign_status(
-                        db=db_session, # <--- PASS SESSION
-                        status_id=status_id,
-                        organization_id=organization_id,
-                        updates={"status": "error_lead_not_found", "error_message": "Lead data missing."}
-                    )
-                    error_count += 1
-                    continue
+                cycle_stats["errors"] += 1
+                continue
 
-                email_settings: Optional[database.models.OrganizationEmailSettings] = database.get_org_email_settings_from_db(
-                    db=db_session, # <--- PASS SESSION
+            email_settings: Optional[database.models.OrganizationEmailSettings] = work_item["email_settings"]
+            if not email_settings or not email_settings.is_configured:
+                logger.warning(f"EmailSchedulerAgent: Email settings not configured for Org {organization_id}. Skipping Lead {lead_id}.")
+                status_writer.add(
+                    status_id=status_id,
                     organization_id=organization_id,
-                    decrypt=True # Assuming you want decrypted passwords
+                    updates={"status": "error_email_config", "error_message": "Organization email settings not configured."}
                 )
-                if not email_settings or not email_settings.is_configured:
-                    logger.warning(f"EmailSchedulerAgent: Email settings not configured for Org {organization_id}. Skipping Lead {lead_id}.")
-                    database.update_lead_campaign_status(
-                        db=db_session, # <--- PASS SESSION
-                        status_id=status_id,
-                        organization_id=organization_id,
-                        updates={"status": "error_email_config", "error_message": "Organization email settings not configured."}
-                    )
-                    skipped_count += 1
-                    continue
+                cycle_stats["skipped"] += 1
+                continue
 
-                subject_template = next_step_to_send_data.subject_template
-                body_template = next_step_to_send_data.body_template
-
-                if not subject_template or not body_template:
-                    logger.error(f"EmailSchedulerAgent: Template subject or body missing for Campaign {campaign_id}, Step {next_step_number_to_send}. Lead ID {lead_id}.")
-                    database.update_lead_campaign_status(
-                        db=db_session, # <--- PASS SESSION
-                        status_id=status_id,
-                        organization_id=organization_id,
-                        updates={"status": "error_template_missing", "error_message": f"Template content missing for step {next_step_number_to_send}."}
-                    )
-                    error_count += 1
-                    continue
+            subject_template = next_step_to_send_data.subject_template
+            body_template = next_step_to_send_data.body_template
 
-                final_subject = self._personalize_template(subject_template, lead_data_orm_obj)
-                final_body_html = self._personalize_template(body_template, lead_data_orm_obj).replace('\n', '<br/>')
-                final_body_text = self._personalize_template(body_template, lead_data_orm_obj)
-
-                email_send_outcome: Optional[EmailSendingResult] = None
-                send_exception_message = None
-
-                logger.info(f"EmailSchedulerAgent: Attempting to send Campaign {campaign_id} Step {next_step_number_to_send} to Lead {lead_id} ({lead_data_orm_obj.email}) for Org {organization_id}.")
-                try:
-                    email_send_outcome = send_email(
-                        recipient_email=lead_data_orm_obj.email,
-                        subject=final_subject,
-                        html_body=final_body_html,
-                        text_body=final_body_text,
-                        organization_id=organization_id # send_email needs to fetch settings using its own DB session or be passed settings
-                                                        # OR, pass the decrypted settings from email_settings ORM object
-                    )
-                except Exception as e_send:
-                    logger.error(f"EmailSchedulerAgent: Exception during send_email call for Lead {lead_id}: {e_send}", exc_info=True)
-                    send_exception_message = str(e_send)
-
-                update_payload = {} # updated_at will be handled by ORM/DB
-                if email_send_outcome and email_send_outcome.success:
-                    logger.info(f"EmailSchedulerAgent: Successfully sent Step {next_step_number_to_send} to Lead ID {lead_id}. Message-ID: {email_send_outcome.message_id}")
-                    update_payload["last_email_sent_at"] = now_utc
-                    update_payload["current_step_number"] = next_step_number_to_send
-                    update_payload["error_message"] = None
-
-                    if email_send_outcome.message_id and campaign_step_db_id is not None:
-                        log_result = database.log_sent_email(
-                            db=db_session, # <--- PASS SESSION
-                            lead_campaign_status_id=status_id,
-                            organization_id=organization_id,
-                            lead_id=lead_id,
-                            campaign_id=campaign_id,
-                            campaign_step_db_id=campaign_step_db_id,
-                            message_id_header=email_send_outcome.message_id,
-                            to_email=lead_data_orm_obj.email,
-                            subject=final_subject
-                        )
-                        if not log_result:
-                            logger.error(f"EmailSchedulerAgent: CRITICAL - Failed to log sent email with Message-ID {email_send_outcome.message_id} to DB for lead {lead_id}.")
-                    elif not campaign_step_db_id:
-                        logger.error(f"EmailSchedulerAgent: CRITICAL - campaign_step_db_id is None for Step {next_step_number_to_send}, Campaign {campaign_id}. Cannot log sent email accurately.")
-                    else:
-                        logger.warning(f"EmailSchedulerAgent: Email sent to lead {lead_id} but no Message-ID returned. Reply linking might be affected.")
-
-                    next_subsequent_step_data: Optional[database.models.CampaignStep] = database.get_next_campaign_step(
-                        db=db_session, # <--- PASS SESSION
-                        campaign_id=campaign_id,
-                        organization_id=organization_id,
-                        current_step_number=next_step_number_to_send
-                    )
-                    if next_subsequent_step_data:
-                        delay_for_next = next_subsequent_step_data.delay_days or 0
-                        update_payload["next_email_due_at"] = self._calculate_next_due_at(now_utc, delay_for_next)
-                        update_payload["status"] = "active" # Or use LeadStatusEnum
-                    else:
-                        logger.info(f"EmailSchedulerAgent: Lead {lead_id} completed all steps in Campaign {campaign_id}.")
-                        update_payload["next_email_due_at"] = None
-                        update_payload["status"] = "completed_sequence"
-                    processed_count += 1
-                else:
-                    failure_reason = "Unknown sending error"
-                    if email_send_outcome and email_send_outcome.error_message:
-                        failure_reason = email_send_outcome.error_message
-                    elif send_exception_message:
-                        failure_reason = send_exception_message
-
-                    logger.error(f"EmailSchedulerAgent: Failed to send Step {next_step_number_to_send} to Lead ID {lead_id}. Reason: {failure_reason}")
-                    update_payload["status"] = "error_sending_email"
-                    update_payload["error_message"] = f"Step {next_step_number_to_send} send fail: {failure_reason[:250]}"
-                    error_count += 1
-
-                database.update_lead_campaign_status(
-                    db=db_session, # <--- PASS SESSION
+            if not subject_template or not body_template:
+                logger.error(f"EmailSchedulerAgent: Template subject or body missing for Campaign {campaign_id}, Step {next_step_number_to_send}. Lead ID {lead_id}.")
+                status_writer.add(
                     status_id=status_id,
                     organization_id=organization_id,
-                    updates=update_payload
+                    updates={"status": "error_template_missing", "error_message": f"Template content missing for step {next_step_number_to_send}."}
+                )
+                cycle_stats["errors"] += 1
+                continue
+
+            final_subject, final_body_html, final_body_text = self._render_step_email(next_step_to_send_data, lead_data_orm_obj)
+            send_jobs.append({
+                "status_id": status_id, "lead_id": lead_id, "campaign_id": campaign_id, "organization_id": organization_id,
+                "step": next_step_to_send_data, "following_step": work_item["following_step"],
+                "lead": lead_data_orm_obj, "email_settings": email_settings,
+                "subject": final_subject, "body_html": final_body_html, "body_text": final_body_text,
+                "outcome": None, "send_exception_message": None, "deferred": False,
+            })
+        return send_jobs
+
+    async def _send_job(self, job: Dict[str, Any], global_slots: asyncio.Semaphore, org_slots: Dict[int, asyncio.Semaphore]) -> Dict[str, Any]:
+        """
+        Sends one job's email off the event loop, bounded by the global and per-org concurrency limits.
+        Jobs over the org/host rate budget are marked deferred instead of waiting for tokens.
+        """
+        org_slot = org_slots.setdefault(job["organization_id"], asyncio.Semaphore(self.max_send_concurrency_per_org))
+        async with global_slots, org_slot:
+            email_settings = job["email_settings"]
+            host_key = getattr(email_settings, "smtp_host", None) or getattr(email_settings, "provider_type", None)
+            if not self.rate_limiter.try_acquire(job["organization_id"], host_key):
+                job["deferred"] = True
+                job["host_key"] = host_key
+                return job
+            logger.info(f"EmailSchedulerAgent: Attempting to send Campaign {job['campaign_id']} Step {job['step'].step_number} to Lead {job['lead_id']} ({job['lead'].email}) for Org {job['organization_id']}.")
+            try:
+                job["outcome"] = await asyncio.to_thread(
+                    send_email,
+                    recipient_email=job["lead"].email,
+                    subject=job["subject"],
+                    html_body=job["body_html"],
+                    text_body=job["body_text"],
+                    organization_id=job["organization_id"],
+                    email_settings=job["email_settings"] # Already decrypted by the working-set prefetch
                 )
-                time.sleep(0.1) # Reduced delay, ensure it's truly needed
+            except Exception as e_send:
+                logger.error(f"EmailSchedulerAgent: Exception during send_email call for Lead {job['lead_id']}: {e_send}", exc_info=True)
+                job["send_exception_message"] = str(e_send)
+        return job
+
+    def _record_send_result(self, status_writer: LeadCampaignStatusBatchWriter, job: Dict[str, Any], cycle_stats: Dict[str, int],
+                            deferred_status_ids: Dict[Tuple[int, Optional[str]], List[int]]) -> None:
+        """Buffers the status transition (and sent-email log row) for a finished send; no DB I/O."""
+        if job["deferred"]:
+            # Over the rate budget: leave the row active and due; it is picked up again later
+            # (see _schedule_deferred_sends)
+            logger.info(f"EmailSchedulerAgent: Send rate budget exhausted for Org {job['organization_id']}. Deferring Lead {job['lead_id']}.")
+            cycle_stats["deferred"] += 1
+            deferred_status_ids.setdefault((job["organization_id"], job["host_key"]), []).append(job["status_id"])
+            return
+        now_utc = datetime.now(timezone.utc)
+        status_id, lead_id, campaign_id, organization_id = job["status_id"], job["lead_id"], job["campaign_id"], job["organization_id"]
+        next_step_number_to_send = job["step"].step_number
+        campaign_step_db_id = job["step"].id
+        email_send_outcome: Optional[EmailSendingResult] = job["outcome"]
+
+        update_payload = {} # updated_at will be handled by ORM/DB
+        if email_send_outcome and email_send_outcome.success:
+            logger.info(f"EmailSchedulerAgent: Successfully sent Step {next_step_number_to_send} to Lead ID {lead_id}. Message-ID: {email_send_outcome.message_id}")
+            update_payload["last_email_sent_at"] = now_utc
+            update_payload["current_step_number"] = next_step_number_to_send
+            update_payload["error_message"] = None
+
+            if email_send_outcome.message_id and campaign_step_db_id is not None:
+                # Written with the cycle's other sends in one multi-row INSERT on the next flush
+                status_writer.add_sent_email_log({
+                    "lead_campaign_status_id": status_id,
+                    "organization_id": organization_id,
+                    "lead_id": lead_id,
+                    "campaign_id": campaign_id,
+                    "campaign_step_id": campaign_step_db_id,
+                    "message_id_header": email_send_outcome.message_id,
+                    "to_email": job["lead"].email,
+                    "subject": job["subject"]
+                })
+            elif not campaign_step_db_id:
+                logger.error(f"EmailSchedulerAgent: CRITICAL - campaign_step_db_id is None for Step {next_step_number_to_send}, Campaign {campaign_id}. Cannot log sent email accurately.")
+            else:
+                logger.warning(f"EmailSchedulerAgent: Email sent to lead {lead_id} but no Message-ID returned. Reply linking might be affected.")
+
+            next_subsequent_step_data: Optional[database.models.CampaignStep] = job["following_step"]
+            if next_subsequent_step_data:
+                delay_for_next = next_subsequent_step_data.delay_days or 0
+                update_payload["next_email_due_at"] = self._calculate_next_due_at(now_utc, delay_for_next)
+                update_payload["status"] = "active" # Or use LeadStatusEnum
+            else:
+                logger.info(f"EmailSchedulerAgent: Lead {lead_id} completed all steps in Campaign {campaign_id}.")
+                update_payload["next_email_due_at"] = None
+                update_payload["status"] = "completed_sequence"
+            cycle_stats["processed"] += 1
+        else:
+            failure_reason = "Unknown sending error"
+            if email_send_outcome and email_send_outcome.error_message:
+                failure_reason = email_send_outcome.error_message
+            elif job["send_exception_message"]:
+                failure_reason = job["send_exception_message"]
+
+            logger.error(f"EmailSchedulerAgent: Failed to send Step {next_step_number_to_send} to Lead ID {lead_id}. Reason: {failure_reason}")
+            update_payload["status"] = "error_sending_email"
+            update_payload["error_message"] = f"Step {next_step_number_to_send} send fail: {failure_reason[:250]}"
+            cycle_stats["errors"] += 1
+
+        status_writer.add(
+            status_id=status_id,
+            organization_id=organization_id,
+            updates=update_payload
+        )
+
+    def _schedule_deferred_sends(self, deferred_status_ids: Dict[Tuple[int, Optional[str]], List[int]]):
+        """
+        Puts rate-deferred rows back on the due wheel for when their org/host buckets have
+        refilled enough to send them (up to a burst), rather than one token's time from now.
+        Wake times are rounded up to EMAIL_SCHEDULER_DEFERRED_RETRY_SECONDS, so all deferred
+        rows - across orgs - share a few wake-ups instead of waking a full cycle every second.
+        """
+        if not deferred_status_ids:
+            return
+        now = time.time()
+        granularity = self.deferred_retry_seconds
+        for (organization_id, host_key), status_ids in deferred_status_ids.items():
+            wait_seconds = self.rate_limiter.seconds_until_available(organization_id, host_key, len(status_ids))
+            retry_at_ts = math.ceil((now + max(wait_seconds, granularity)) / granularity) * granularity
+            retry_at = datetime.fromtimestamp(retry_at_ts, timezone.utc)
+            for status_id in status_ids:
+                self.due_wheel.schedule(status_id, retry_at)
+            logger.debug(f"EmailSchedulerAgent: {len(status_ids)} deferred sends for Org {organization_id} retry at {retry_at.isoformat()}.")
+
+    def run_scheduler_cycle(self):
+        """Synchronous entry point (e.g. background tasks/threads); runs one async cycle to completion."""
+        return asyncio.run(self.run_scheduler_cycle_async())
+
+    def _backlog_stats_due(self) -> bool:
+        """
+        Whether this cycle should log backlog stats: a COUNT/MIN over the whole due set is too
+        costly for every cycle (the due-time loop can run several a minute), so it is sampled
+        every EMAIL_SCHEDULER_BACKLOG_STATS_INTERVAL_SECONDS, or on every cycle with debug logging.
+        """
+        now = time.monotonic()
+        if logger.isEnabledFor(logging.DEBUG) or now - self._backlog_stats_logged_at >= self.backlog_stats_interval_seconds:
+            self._backlog_stats_logged_at = now
+            return True
+        return False
+
+    def _log_backlog(self, backlog: Optional[Dict[str, Any]], when: str):
+        if backlog is None:
+            return
+        logger.info(f"EmailSchedulerAgent: Backlog {when}: {backlog['due_count']} lead campaign statuses due, "
+                    f"oldest overdue by {backlog['oldest_overdue_seconds']:.0f}s.")
+
+    async def _process_claimed_batch(self, db_session: Session, status_writer: LeadCampaignStatusBatchWriter,
+                                     claimed_status_ids: List[int], cycle_stats: Dict[str, int],
+                                     deferred_status_ids: Dict[Tuple[int, Optional[str]], List[int]]) -> int:
+        """
+        Claims one batch of due rows, sends their emails and buffers the results.
+        Claimed ids are appended to claimed_status_ids as soon as they are leased so the
+        caller can release them even if the batch fails. Returns the number of rows claimed.
+        """
+        # Lease the due rows to this worker so other scheduler workers/replicas skip them
+        active_lead_statuses: List[database.models.LeadCampaignStatus] = await asyncio.to_thread(
+            database.claim_leads_due_for_step,
+            db=db_session,          # <--- PASS THE SESSION
+            worker_id=self.worker_id,
+            organization_id=None,   # Get for all orgs
+            query_limit=self.claim_batch_size,
+            lease_seconds=self.claim_lease_seconds,
+            tier_weights=self.tier_weights
+        )
+        batch_status_ids = [status_record.id for status_record in active_lead_statuses]
+        claimed_status_ids.extend(batch_status_ids)
+        if not batch_status_ids:
+            return 0
+
+        logger.info(f"EmailSchedulerAgent: Found {len(active_lead_statuses)} lead campaign statuses potentially due for processing.")
+
+        # Prefetch leads, next/following steps and decrypted org settings in one query;
+        # everything after this runs on in-memory data and only writes back to the DB.
+        working_set = await asyncio.to_thread(database.get_scheduler_working_set, db_session, batch_status_ids)
+        send_jobs = await asyncio.to_thread(self._prepare_send_jobs, status_writer, working_set, cycle_stats)
+
+        global_slots = asyncio.Semaphore(self.max_send_concurrency)
+        org_slots: Dict[int, asyncio.Semaphore] = {}
+        # Record results as sends complete so buffered transitions flush while later sends are in flight
+        for finished_send in asyncio.as_completed([self._send_job(job, global_slots, org_slots) for job in send_jobs]):
+            job = await finished_send
+            self._record_send_result(status_writer, job, cycle_stats, deferred_status_ids)
+            if status_writer.should_flush():
+                await asyncio.to_thread(status_writer.flush)
+        return len(batch_status_ids)
+
+    async def run_scheduler_cycle_async(self):
+        """
+        Runs one scheduler cycle without blocking the event loop: DB phases run in a worker
+        thread and sends run concurrently, bounded by EMAIL_SEND_MAX_CONCURRENCY overall and
+        EMAIL_SEND_MAX_CONCURRENCY_PER_ORG per organization.
+        With EMAIL_SCHEDULER_DRAIN_MODE the cycle keeps claiming batches until nothing is due
+        or EMAIL_SCHEDULER_DRAIN_TIME_BUDGET_SECONDS is spent; otherwise it handles one batch.
+        Returns (claimed status ids, whether more rows may still be due), or None if skipped.
+        """
+        if self._cycle_running:
+            # The interval job and the due-time loop share this agent; one cycle at a time
+            logger.info("EmailSchedulerAgent: A scheduler cycle is already running; skipping this trigger.")
+            return None
+        self._cycle_running = True
+        try:
+            return await self._run_scheduler_cycle()
+        finally:
+            self._cycle_running = False
+
+    async def _run_scheduler_cycle(self) -> Tuple[Set[int], bool]:
+        cycle_start_time = datetime.now(timezone.utc)
+        logger.info(f"--- Starting email scheduler cycle ({cycle_start_time.isoformat()}) ---")
+
+        cycle_stats = {"processed": 0, "skipped": 0, "deferred": 0, "errors": 0}
+        batches_run = 0
+        more_due = False # Set when the last batch was full, i.e. the cycle stopped before the due set ran out
+
+        db_session: Session = next(get_db()) # <--- GET A DATABASE SESSION
+        # Claims are held until the end of the cycle, so rows deferred by the rate limiter
+        # are not re-claimed by the next batch of a draining cycle.
+        claimed_status_ids: List[int] = []
+        deferred_status_ids: Dict[Tuple[int, Optional[str]], List[int]] = {} # (org, host) -> rate-deferred rows
+        # Status transitions are buffered and written in bulk instead of one commit per lead
+        status_writer = LeadCampaignStatusBatchWriter(
+            db_session,
+            max_rows=self.status_flush_rows,
+            max_delay_ms=self.status_flush_interval_ms
+        )
+        drain_deadline = time.monotonic() + self.drain_time_budget_seconds
+
+        try:
+            if self._backlog_stats_due():
+                self._log_backlog(await asyncio.to_thread(database.get_due_backlog_stats, db_session), "at cycle start")
+
+            while True:
+                claimed_count = await self._process_claimed_batch(db_session, status_writer, claimed_status_ids, cycle_stats, deferred_status_ids)
+                if claimed_count:
+                    batches_run += 1
+                more_due = claimed_count >= self.claim_batch_size
+                # A short batch means nothing else was due when it was claimed
+                if not self.drain_mode or claimed_count < self.claim_batch_size:
+                    break
+                await asyncio.to_thread(status_writer.flush)
+                if time.monotonic() >= drain_deadline:
+                    logger.warning(f"EmailSchedulerAgent: Drain time budget of {self.drain_time_budget_seconds}s spent after {batches_run} batches.")
+                    self._log_backlog(await asyncio.to_thread(database.get_due_backlog_stats, db_session), "left for the next cycle")
+                    break
+
+            if not batches_run:
+                logger.info("EmailSchedulerAgent: No leads currently due for an email.")
 
         except Exception as e_cycle:
             logger.error(f"Unhandled error in email scheduler cycle: {e_cycle}", exc_info=True)
             # This error is outside the loop, so it's a general cycle failure
             # You might want to increment a general error counter if you have one
         finally:
+            # Flush before releasing claims so no other worker picks up a row whose transition is still buffered
+            try:
+                await asyncio.to_thread(status_writer.flush)
+            except Exception as e_flush:
+                logger.error(f"EmailSchedulerAgent: Failed to flush buffered status updates: {e_flush}", exc_info=True)
+            if claimed_status_ids:
+                await asyncio.to_thread(database.release_lead_campaign_status_claims, db_session, claimed_status_ids, self.worker_id)
+            self._schedule_deferred_sends(deferred_status_ids)
             db_session.close() # <--- ALWAYS CLOSE THE SESSION
-            logger.info(f"--- Email scheduler cycle finished. Processed: {processed_count}, Skipped: {skipped_count}, Errors: {error_count} ---")
+            await asyncio.to_thread(smtp_connection_pool.close_all) # Don't hold SMTP sessions open between cycles
+            cycle_seconds = (datetime.now(timezone.utc) - cycle_start_time).total_seconds()
+            logger.info(f"--- Email scheduler cycle finished in {cycle_seconds:.1f}s ({batches_run} batches). Processed: {cycle_stats['processed']}, Skipped: {cycle_stats['skipped']}, Deferred: {cycle_stats['deferred']}, Errors: {cycle_stats['errors']} ---")
+        return set(claimed_status_ids), more_due
+
+    def _reload_due_time_wheel(self):
+        horizon_end = datetime.now(timezone.utc) + timedelta(seconds=self.due_wheel.horizon_seconds)
+        db_session: Session = next(get_db())
+        try:
+            upcoming = database.get_upcoming_due_times(db_session, horizon_end)
+        finally:
+            db_session.close()
+        if upcoming is not None:
+            self.due_wheel.load(upcoming, horizon_end)
+            logger.info(f"EmailSchedulerAgent: Due-time wheel loaded with {len(upcoming)} sends due in the next {self.due_wheel.horizon_seconds:.0f}s.")
+
+    def _rearm_unclaimed_due_ids(self, due_status_ids: List[int], cycle_result: Optional[Tuple[Set[int], bool]]):
+        """
+        Puts popped due ids back on the wheel if the cycle they woke didn't get to them: it was
+        skipped, or its last batch was full so rows were still due when it stopped. A short last
+        batch means the unclaimed ids weren't due in the DB after all; the next reload corrects them.
+        """
+        if cycle_result is None:
+            leftover_ids = due_status_ids
+        else:
+            claimed_ids, more_due = cycle_result
+            leftover_ids = [status_id for status_id in due_status_ids if status_id not in claimed_ids] if more_due else []
+        if not leftover_ids:
+            return
+        now = datetime.now(timezone.utc)
+        for status_id in leftover_ids:
+            self.due_wheel.schedule(status_id, now)
+        logger.info(f"EmailSchedulerAgent: {len(leftover_ids)} due sends weren't reached by the cycle; running another.")
+
+    async def run_due_time_loop(self):
+        """
+        Long-running task that sleeps until the due-time wheel says an email is due and then
+        runs a scheduler cycle, instead of waiting for the next fixed interval. The wheel is
+        reloaded from the DB every half horizon; the interval job stays as a safety net.
+        """
+        self.due_wheel.bind_loop(asyncio.get_running_loop())
+        reload_every = self.due_wheel.horizon_seconds / 2
+        next_reload_at = 0.0
+        logger.info("EmailSchedulerAgent: Due-time loop started.")
+        while True:
+            try:
+                if time.monotonic() >= next_reload_at:
+                    await asyncio.to_thread(self._reload_due_time_wheel)
+                    next_reload_at = time.monotonic() + reload_every
+
+                if self._cycle_running:
+                    # Leave due entries on the wheel: popping them now would lose them when the
+                    # cycle call below is skipped. Re-check once the running cycle has finished.
+                    await asyncio.sleep(self.cycle_running_recheck_seconds)
+                    continue
+                due_status_ids = self.due_wheel.pop_due()
+                if due_status_ids:
+                    self._rearm_unclaimed_due_ids(due_status_ids, await self.run_scheduler_cycle_async())
+                    continue
+
+                timeout = next_reload_at - time.monotonic()
+                next_due_at = self.due_wheel.next_due_at()
+                if next_due_at is not None:
+                    timeout = min(timeout, next_due_at - time.time())
+                await self.due_wheel.wait(timeout)
+            except asyncio.CancelledError:
+                logger.info("EmailSchedulerAgent: Due-time loop stopped.")
+                raise
+            except Exception as e_loop:
+                logger.error(f"EmailSchedulerAgent: Error in due-time loop: {e_loop}", exc_info=True)
+                await asyncio.sleep(5)
+
+
+_shared_agent: Optional[EmailSchedulerAgent] = None
+_shared_agent_lock = threading.Lock()
+
+
+def get_email_scheduler_agent() -> EmailSchedulerAgent:
+    """
+    The process-wide agent used by the interval job, the due-time loop and manual triggers,
+    so they share one send rate limiter and one running-cycle guard.
+    """
+    global _shared_agent
+    with _shared_agent_lock:
+        if _shared_agent is None:
+            _shared_agent = EmailSchedulerAgent()
+        return _shared_agent
@@ -0,0 +1,225 @@
+# app/agents/imap_idle_manager.py
+
+import imaplib
+import itertools
+import select
+import ssl
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy.orm import Session # For type hinting
+
+from app.utils.config import settings
+from app.utils.logger import logger
+from app.db import database as db_ops
+from app.db.database import get_db
+from app.agents.imap_reply_agent import ImapReplyAgent
+
+# Servers may drop an IDLE after 30 minutes of inactivity (RFC 2177), so it is re-issued well before that
+MAX_IDLE_SECONDS = 29 * 60
+_IDLE_READ_SLICE_SECONDS = 5.0 # How often a waiting session checks whether it should stop
+_idle_tag_counter = itertools.count(1)
+
+
+class ImapIdleConnectionManager:
+    """
+    Keeps one authenticated, INBOX-selected IMAP session open per organization and processes
+    new mail as soon as the server reports it, instead of reconnecting every poll interval.
+
+    Each session runs on its own daemon thread. Where the server advertises IDLE the thread
+    waits on the socket for an EXISTS notification; otherwise it sends NOOP every
+    IMAP_IDLE_NOOP_INTERVAL_SECONDS and checks for new UIDs. Mail is processed with
+    ImapReplyAgent.process_mailbox, which also resets last_imap_poll_uid when UIDVALIDITY changes.
+    A session claims its organization on the agent while connected, so the interval poller
+    skips it; while a session is reconnecting (with exponential backoff) the poller covers it.
+    """
+    def __init__(self, agent: ImapReplyAgent):
+        self.agent = agent
+        self.idle_timeout_seconds = min(float(getattr(settings, "IMAP_IDLE_TIMEOUT_SECONDS", 1500)), MAX_IDLE_SECONDS)
+        self.noop_interval_seconds = float(getattr(settings, "IMAP_IDLE_NOOP_INTERVAL_SECONDS", 30))
+        self.org_refresh_seconds = float(getattr(settings, "IMAP_IDLE_ORG_REFRESH_SECONDS", 300))
+        self.max_reconnect_delay_seconds = float(getattr(settings, "IMAP_IDLE_MAX_RECONNECT_DELAY_SECONDS", 300))
+        self._stop_event = threading.Event()
+        self._sessions: Dict[int, Tuple[threading.Thread, threading.Event]] = {}
+        self._supervisor: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._supervisor and self._supervisor.is_alive():
+            return
+        self._stop_event.clear()
+        self._supervisor = threading.Thread(target=self._supervise, name="imap-idle-supervisor", daemon=True)
+        self._supervisor.start()
+        logger.info("ImapIdleConnectionManager: Started.")
+
+    def stop(self, timeout: float = 10.0):
+        """Signals every session to finish its current wait, log out and exit."""
+        self._stop_event.set()
+        for _, org_stop in self._sessions.values():
+            org_stop.set()
+        join_deadline = time.monotonic() + timeout
+        for thread, _ in list(self._sessions.values()):
+            thread.join(max(0.0, join_deadline - time.monotonic()))
+        logger.info("ImapIdleConnectionManager: Stopped.")
+
+    def _enabled_organization_ids(self) -> set:
+        db_session: Session = next(get_db())
+        try:
+            return {
+                org_settings.organization_id for org_settings in db_ops.get_organizations_with_imap_enabled(db_session)
+                if org_settings.organization_id and org_settings.is_configured and org_settings.enable_reply_detection
+            }
+        finally:
+            db_session.close()
+
+    def _supervise(self):
+        """Starts a session per enabled organization and stops sessions of orgs no longer enabled."""
+        while not self._stop_event.is_set():
+            try:
+                organization_ids = self._enabled_organization_ids()
+                for org_id in list(self._sessions):
+                    thread, org_stop = self._sessions[org_id]
+                    if org_id not in organization_ids:
+                        org_stop.set()
+                    if not thread.is_alive():
+                        del self._sessions[org_id]
+                for org_id in organization_ids - set(self._sessions):
+                    org_stop = threading.Event()
+                    thread = threading.Thread(target=self._run_session, args=(org_id, org_stop), name=f"imap-idle-{org_id}", daemon=True)
+                    self._sessions[org_id] = (thread, org_stop)
+                    thread.start()
+                logger.debug(f"ImapIdleConnectionManager: {len(self._sessions)} session(s) running.")
+            except Exception as e:
+                logger.error(f"ImapIdleConnectionManager: Failed to refresh organizations: {e}", exc_info=True)
+            self._stop_event.wait(self.org_refresh_seconds)
+
+    def _run_session(self, organization_id: int, org_stop: threading.Event):
+        """Session thread: keeps a connection open for one org, reconnecting with exponential backoff."""
+        reconnect_delay = 5.0
+        while not (org_stop.is_set() or self._stop_event.is_set()):
+            if not self.agent.claim_organization(organization_id):
+                # An interval poll worker has the inbox right now; try again shortly
+                org_stop.wait(self.noop_interval_seconds)
+                continue
+            try:
+                if self._serve(organization_id, org_stop):
+                    reconnect_delay = 5.0
+            except Exception as e:
+                logger.error(f"ImapIdleConnectionManager: Unexpected error in session for Org ID {organization_id}: {e}", exc_info=True)
+            finally:
+                self.agent.release_organization(organization_id)
+            if org_stop.is_set() or self._stop_event.is_set():
+                break
+            logger.info(f"ImapIdleConnectionManager: Reconnecting Org ID {organization_id} in {reconnect_delay:.0f}s.")
+            org_stop.wait(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, self.max_reconnect_delay_seconds)
+
+    def _process_new_mail(self, organization_id: int, imap_conn: Any, uidvalidity: Optional[str]) -> bool:
+        """Runs one catch-up pass on a fresh DB session; False if the org is no longer enabled."""
+        db_session: Session = next(get_db())
+        try:
+            org_settings = db_ops.get_org_email_settings_from_db(db_session, organization_id)
+            if not (org_settings and org_settings.is_configured and org_settings.enable_reply_detection):
+                return False
+            self.agent.process_mailbox(db_session, imap_conn, org_settings, uidvalidity)
+            return True
+        finally:
+            db_session.close()
+
+    def _serve(self, organization_id: int, org_stop: threading.Event) -> bool:
+        """
+        Holds one connection until it fails or the session is stopped.
+        Returns True if the connection was established (so the reconnect backoff resets).
+        """
+        db_session: Session = next(get_db())
+        try:
+            org_settings = db_ops.get_org_email_settings_from_db(db_session, organization_id) # Decrypts imap_password
+            opened = self.agent.open_mailbox(org_settings) if org_settings else None
+        finally:
+            db_session.close()
+        if opened is None:
+            return False
+        imap_conn, uidvalidity = opened
+        supports_idle = "IDLE" in imap_conn.capabilities
+        logger.info(f"ImapIdleConnectionManager: Session open for Org ID {organization_id} ({'IDLE' if supports_idle else 'NOOP polling'}).")
+        try:
+            while not (org_stop.is_set() or self._stop_event.is_set()):
+                if not self._process_new_mail(organization_id, imap_conn, uidvalidity):
+                    logger.info(f"ImapIdleConnectionManager: Reply detection no longer enabled for Org ID {organization_id}; closing session.")
+                    org_stop.set()
+                    break
+                if supports_idle:
+                    self._idle(imap_conn, org_stop)
+                else:
+                    org_stop.wait(self.noop_interval_seconds)
+                    imap_conn.noop()
+        except (imaplib.IMAP4.error, OSError) as e_imap:
+            logger.warning(f"ImapIdleConnectionManager: Connection for Org ID {organization_id} lost: {e_imap}")
+        finally:
+            self.agent.close_mailbox(imap_conn, organization_id)
+        return True
+
+    def _has_buffered_input(self, imap_conn: Any) -> bool:
+        """
+        Whether a response is already waiting in imaplib's buffered reader or the TLS layer,
+        where select() can't see it (e.g. "* 3 EXISTS" arriving in the same packet as "+ idling").
+        peek() on a non-blocking socket returns buffered bytes, or reads what is available,
+        without waiting.
+        """
+        sock = imap_conn.sock
+        peek = getattr(getattr(imap_conn, "file", None), "peek", None)
+        if peek is None:
+            return bool(getattr(sock, "pending", None) and sock.pending())
+        previous_timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            return bool(peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(previous_timeout)
+
+    def _wait_readable(self, imap_conn: Any, timeout: float) -> bool:
+        if self._has_buffered_input(imap_conn):
+            return True
+        readable, _, _ = select.select([imap_conn.sock], [], [], timeout)
+        return bool(readable)
+
+    def _idle(self, imap_conn: Any, org_stop: threading.Event) -> bool:
+        """
+        Issues IDLE (RFC 2177) and blocks until the server reports new mail, idle_timeout_seconds
+        pass or the session is stopped, then ends it with DONE. imaplib has no IDLE support before
+        Python 3.14, so the command is driven over the connection's raw line interface.
+        Returns True if an EXISTS notification arrived.
+        """
+        tag = f"IDLE{next(_idle_tag_counter)}".encode()
+        imap_conn.send(tag + b" IDLE\r\n")
+        line = imap_conn.readline()
+        if not line.startswith(b"+"):
+            raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+        new_mail = False
+        idle_deadline = time.monotonic() + self.idle_timeout_seconds
+        try:
+            while not (org_stop.is_set() or self._stop_event.is_set()):
+                remaining = idle_deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not self._wait_readable(imap_conn, min(_IDLE_READ_SLICE_SECONDS, remaining)):
+                    continue
+                line = imap_conn.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed during IDLE")
+                if line.rstrip().upper().endswith(b"EXISTS"):
+                    new_mail = True
+                    break
+        finally:
+            imap_conn.send(b"DONE\r\n")
+            # Untagged responses may still arrive before the IDLE command completes
+            while True:
+                line = imap_conn.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed while ending IDLE")
+                if line.startswith(tag + b" "):
+                    break
+        return new_mail
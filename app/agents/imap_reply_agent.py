@@ -5,18 +5,39 @@ import email
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
 import re
-from typing import List, Optional, Any # Removed Dict for org_settings_obj
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Any, Tuple
 from datetime import datetime, timezone
 from sqlalchemy.orm import Session # For type hinting
 
+from app.utils.config import settings
+from app.utils.imap_utils import (
+    compress_uid_set, decode_text_part, find_text_part, html_to_text,
+    parse_uid_fetch_items, parse_uid_fetch_literals
+)
 from app.utils.logger import logger
+from app.utils.message_id_cache import MessageIdLinkCache
+from app.utils.reply_text_cleaner import clean_reply_text
 from app.db import database as db_ops # Using an alias for clarity
 from app.db.database import get_db # To get a database session
 from app.agents.reply_classifier_agent import ReplyClassifierAgent
+from app.agents.reply_classification_queue import ReplyClassificationWorkerPool, apply_classification_to_lead
+from app.agents.reply_rule_classifier import AUTO_REPLY_HEADER_NAMES, classify_reply_by_rules
 from app.db import models # Import your ORM models for type hinting
 
 # (Keep your existing logger setup if not using app.utils.logger)
 
+# Only the headers needed to link and pre-classify a reply; BODY.PEEK leaves the Seen flag untouched
+REPLY_HEADER_FETCH_ITEMS = (
+    "(UID BODY.PEEK[HEADER.FIELDS (FROM IN-REPLY-TO REFERENCES MESSAGE-ID SUBJECT DATE "
+    + " ".join(name.upper() for name in AUTO_REPLY_HEADER_NAMES) + ")])"
+)
+BODYSTRUCTURE_FETCH_ITEMS = "(UID BODYSTRUCTURE)"
+FULL_MESSAGE_FETCH_ITEMS = "(UID BODY.PEEK[])" # Only when a server returns no usable BODYSTRUCTURE
+
+
 class ImapReplyAgent:
     def __init__(self):
         logger.info("ImapReplyAgent: Initializing...")
@@ -26,6 +47,24 @@ class ImapReplyAgent:
         except Exception as e:
             logger.error(f"ImapReplyAgent: Failed to instantiate ReplyClassifierAgent: {e}", exc_info=True)
             self.reply_classifier = None
+        # LLM classification is queued for this pool while it runs (started by the app, see main.py)
+        self.classification_pool = ReplyClassificationWorkerPool(self.reply_classifier) \
+            if self.reply_classifier and getattr(settings, "ENABLE_REPLY_CLASSIFICATION_WORKERS", True) else None
+        self.max_poll_workers = int(getattr(settings, "IMAP_POLL_MAX_WORKERS", 8))
+        self.imap_timeout_seconds = float(getattr(settings, "IMAP_TIMEOUT_SECONDS", 30))
+        self.poll_cycle_budget_seconds = float(getattr(settings, "IMAP_POLL_CYCLE_BUDGET_SECONDS", 300))
+        self.fetch_batch_size = int(getattr(settings, "IMAP_FETCH_BATCH_SIZE", 200))
+        self.max_text_part_bytes = int(getattr(settings, "IMAP_MAX_TEXT_PART_BYTES", 262144))
+        self.max_clean_scan_bytes = int(getattr(settings, "REPLY_CLEANER_MAX_SCAN_BYTES", 65536))
+        self.enable_rule_classification = bool(getattr(settings, "ENABLE_RULE_BASED_REPLY_CLASSIFICATION", True))
+        self.message_id_cache = MessageIdLinkCache(
+            max_entries_per_org=int(getattr(settings, "IMAP_MESSAGE_ID_CACHE_SIZE", 10000)),
+            miss_ttl_seconds=float(getattr(settings, "IMAP_MESSAGE_ID_MISS_TTL_SECONDS", 3600)),
+        )
+        # Orgs whose inbox is being processed: poll workers (possibly left over from a cycle that
+        # ran out of budget) and IDLE sessions, see claim_organization
+        self._orgs_in_flight: set = set()
+        self._orgs_in_flight_lock = threading.Lock()
 
     # (Keep your _decode_email_header and _get_cleaned_email_body_text methods as they are)
     def _decode_email_header(self, header_value: Any) -> str:
@@ -57,6 +96,10 @@ class ImapReplyAgent:
             return header_value
         return "".join(decoded_parts)
 
+    def _clean_reply_text(self, text: str) -> str:
+        """Cuts a reply's text at the quoted original or the signature separator."""
+        return clean_reply_text(text, self.max_clean_scan_bytes)
+
     def _get_cleaned_email_body_text(self, msg: email.message.Message) -> str:
         body = ""
         if msg.is_multipart():
@@ -67,9 +110,8 @@ class ImapReplyAgent:
                     try:
                         payload = part.get_payload(decode=True)
                         charset = part.get_content_charset() or 'utf-8'
-                        part_body = payload.decode(charset, 'replace')
-                        cleaned_part = re.split(r'\n\s*(?:On|El|Le)\s+.*\s+(?:wrote|écrit|escribió):|\n\s*--\s*\n?>', part_body, 1)[0]
-                        body = cleaned_part.strip()
+                        part_body = payload[:self.max_clean_scan_bytes].decode(charset, 'replace')
+                        body = self._clean_reply_text(part_body)
                         if body: break
                     except Exception as e:
                         logger.warning(f"ImapReplyAgent: Error decoding/cleaning multipart text part: {e}")
@@ -79,9 +121,8 @@ class ImapReplyAgent:
                 try:
                     payload = msg.get_payload(decode=True)
                     charset = msg.get_content_charset() or 'utf-8'
-                    part_body = payload.decode(charset, 'replace')
-                    cleaned_part = re.split(r'\n\s*(?:On|El|Le)\s+.*\s+(?:wrote|écrit|escribió):|\n\s*--\s*\n?>', part_body, 1)[0]
-                    body = cleaned_part.strip()
+                    part_body = payload[:self.max_clean_scan_bytes].decode(charset, 'replace')
+                    body = self._clean_reply_text(part_body)
                 except Exception as e:
                     logger.warning(f"ImapReplyAgent: Error decoding/cleaning non-multipart text: {e}")
         if not body and msg.is_multipart(): # Fallback
@@ -90,300 +131,531 @@ class ImapReplyAgent:
                     try:
                         payload = part.get_payload(decode=True)
                         charset = part.get_content_charset() or 'utf-8'
-                        body = payload.decode(charset, 'replace').strip()
+                        body = payload[:self.max_clean_scan_bytes].decode(charset, 'replace').strip()
                         if body: break
                     except Exception: continue
         return body
 
 
-    def _process_single_inbox(self, db: Session, org_settings_obj: models.OrganizationEmailSettings):
-        # org_settings_obj is now an ORM object, not a dict
-        # The db session is passed in
-        organization_id = org_settings_obj.organization_id
-        logger.info(f"ImapReplyAgent: Processing inbox for Org ID: {organization_id}, User: {org_settings_obj.imap_username}")
+    def _parse_reply_headers(self, email_message: email.message.Message) -> Dict[str, Any]:
+        """Header fields the agent needs to link and store a reply; works on a header-only message."""
+        message_id_header = self._decode_email_header(email_message.get("Message-ID"))
+        in_reply_to_header = self._decode_email_header(email_message.get("In-Reply-To"))
+        references_header = self._decode_email_header(email_message.get("References"))
+        from_address_full = self._decode_email_header(email_message.get("From"))
+        from_address_email_match = re.search(r'<([^>]+)>', from_address_full)
+        from_address_email = from_address_email_match.group(1).strip() if from_address_email_match else from_address_full.strip()
+        date_str = email_message.get("Date")
+        try:
+            received_at_dt = parsedate_to_datetime(date_str) if date_str else datetime.now(timezone.utc)
+        except (TypeError, ValueError):
+            received_at_dt = datetime.now(timezone.utc)
+        if received_at_dt.tzinfo is None:
+            received_at_dt = received_at_dt.replace(tzinfo=timezone.utc)
+        else:
+            received_at_dt = received_at_dt.astimezone(timezone.utc)
+
+        # Bare ids this reply may answer, most specific first: In-Reply-To, then References newest to oldest
+        referenced_message_ids: List[str] = []
+        for candidate in in_reply_to_header.split()[:1] + references_header.split()[::-1]:
+            message_id = candidate.strip("<> ")
+            if message_id and message_id not in referenced_message_ids:
+                referenced_message_ids.append(message_id)
+
+        return {
+            "message_id_header": message_id_header,
+            "from_address_email": from_address_email,
+            "reply_subject": self._decode_email_header(email_message.get("Subject")),
+            "received_at": received_at_dt,
+            "referenced_message_ids": referenced_message_ids,
+            "auto_reply_headers": {name: str(email_message.get(name)) for name in AUTO_REPLY_HEADER_NAMES if email_message.get(name) is not None},
+        }
+
+    def _link_reply_by_from_address(self, db: Session, organization_id: int, reply_headers: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Fallback for replies whose Message-ID references match no outgoing email: link by the From address."""
+        from_address_email = reply_headers["from_address_email"]
+        logger.debug(f"ImapReplyAgent: Could not link by Message-ID. Trying to link by From: {from_address_email}")
+        potential_lead_orm = db_ops.get_lead_by_email(db, from_address_email, organization_id)
+        if not potential_lead_orm:
+            logger.info(f"ImapReplyAgent: Could not link reply from {from_address_email} to any known lead for org {organization_id}.")
+            return None
+
+        lead_id = potential_lead_orm.id
+        campaign_id, lcs_id = None, None
+        # Get their most recent *active* campaign status (or any status for context)
+        # This might need a more specific DB function if you only want "active"
+        status_rec_orm = db_ops.get_lead_campaign_status(db, lead_id, organization_id)
+        if status_rec_orm:
+            campaign_id = status_rec_orm.campaign_id
+            lcs_id = status_rec_orm.id
+            logger.info(f"ImapReplyAgent: Reply from {from_address_email} linked to Lead {lead_id}, Campaign {campaign_id} (LCS ID: {lcs_id}) via From address.")
+        else:
+            logger.info(f"ImapReplyAgent: Lead {lead_id} (from {from_address_email}) found, but no campaign status record. Storing reply linked to lead only.")
+        return {
+            "lead_id": lead_id,
+            "campaign_id": campaign_id,
+            "lcs_id": lcs_id,
+            "outgoing_email_log_id": None,
+            "lead_name": potential_lead_orm.name or "Valued Prospect",
+        }
+
+    def _link_replies_to_leads(self, db: Session, organization_id: int,
+                               reply_headers_by_uid: Dict[int, Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+        """
+        Links a batch of replies to leads. Every In-Reply-To/References Message-ID in the batch is
+        resolved at once: from the Message-ID cache where possible, the rest with a single query.
+        Replies that match no outgoing email fall back to their From address. Returns UID -> link
+        (lead_id, campaign_id, lcs_id, outgoing_email_log_id, lead_name); unlinked replies are
+        omitted and their bodies are never downloaded.
+        """
+        wanted_message_ids = {
+            message_id for reply_headers in reply_headers_by_uid.values()
+            for message_id in reply_headers["referenced_message_ids"]
+        }
+        links_by_message_id, cached_misses = self.message_id_cache.lookup(organization_id, wanted_message_ids)
+        unresolved_message_ids = wanted_message_ids - set(links_by_message_id) - cached_misses
+        if unresolved_message_ids:
+            resolved = db_ops.get_reply_links_by_message_ids(db, organization_id, list(unresolved_message_ids))
+            if resolved is not None: # On a DB error nothing is cached and the From fallback still applies
+                self.message_id_cache.store(organization_id, resolved, unresolved_message_ids - set(resolved))
+                links_by_message_id.update(resolved)
+        logger.debug(f"ImapReplyAgent: Resolved {len(wanted_message_ids)} referenced Message-ID(s) for Org ID {organization_id}; "
+                     f"{len(wanted_message_ids) - len(unresolved_message_ids)} from cache.")
+
+        links: Dict[int, Dict[str, Any]] = {}
+        for email_uid, reply_headers in reply_headers_by_uid.items():
+            link = next((links_by_message_id[message_id] for message_id in reply_headers["referenced_message_ids"]
+                         if message_id in links_by_message_id), None)
+            if link is not None:
+                link = {**link, "lead_name": link["lead_name"] or "Valued Prospect"} # Cached dicts are shared
+                logger.info(f"ImapReplyAgent: Reply from {reply_headers['from_address_email']} linked to Lead {link['lead_id']}, Campaign {link['campaign_id']} via Message-ID.")
+            else:
+                link = self._link_reply_by_from_address(db, organization_id, reply_headers)
+            if link is not None:
+                links[email_uid] = link
+        return links
+
+    def _uid_fetch(self, imap_conn: Any, uids: List[int], message_parts: str, organization_id: int) -> Dict[int, bytes]:
+        """One UID FETCH per chunk of IMAP_FETCH_BATCH_SIZE UIDs; returns the fetched literal per UID."""
+        fetched: Dict[int, bytes] = {}
+        for chunk_start in range(0, len(uids), self.fetch_batch_size):
+            uid_set = compress_uid_set(uids[chunk_start:chunk_start + self.fetch_batch_size])
+            status, fetch_data = imap_conn.uid('fetch', uid_set, message_parts)
+            if status != 'OK' or not fetch_data:
+                logger.error(f"ImapReplyAgent: UID FETCH {message_parts} failed for UIDs {uid_set} (Org ID {organization_id}): {fetch_data}")
+                continue
+            fetched.update(parse_uid_fetch_literals(fetch_data))
+        return fetched
+
+    def _mark_seen(self, imap_conn: Any, uids: List[int], organization_id: int):
+        """Sets \\Seen on the given UIDs with one UID STORE per chunk of IMAP_FETCH_BATCH_SIZE."""
+        uids = sorted(uids)
+        for chunk_start in range(0, len(uids), self.fetch_batch_size):
+            uid_set = compress_uid_set(uids[chunk_start:chunk_start + self.fetch_batch_size])
+            status, store_response = imap_conn.uid('store', uid_set, '+FLAGS.SILENT', '(\\Seen)')
+            if status != 'OK':
+                logger.error(f"ImapReplyAgent: UID STORE \\Seen failed for UIDs {uid_set} (Org ID {organization_id}): {store_response}")
+        logger.debug(f"ImapReplyAgent: Marked {len(uids)} email(s) as Seen for Org ID {organization_id}.")
+
+    def _fetch_reply_texts(self, imap_conn: Any, uids: List[int], organization_id: int) -> Dict[int, str]:
+        """
+        Returns UID -> reply text without downloading attachments: BODYSTRUCTURE locates the
+        text/plain part (text/html as fallback, converted to text) and only that section is
+        fetched, capped at IMAP_MAX_TEXT_PART_BYTES. Messages without any inline text part map to "".
+        """
+        if not uids:
+            return {}
+        structures: Dict[int, Dict[str, Any]] = {}
+        for chunk_start in range(0, len(uids), self.fetch_batch_size):
+            uid_set = compress_uid_set(uids[chunk_start:chunk_start + self.fetch_batch_size])
+            status, fetch_data = imap_conn.uid('fetch', uid_set, BODYSTRUCTURE_FETCH_ITEMS)
+            if status != 'OK' or not fetch_data:
+                logger.error(f"ImapReplyAgent: UID FETCH BODYSTRUCTURE failed for UIDs {uid_set} (Org ID {organization_id}): {fetch_data}")
+                continue
+            try:
+                structures.update(parse_uid_fetch_items(fetch_data))
+            except ValueError as e_parse:
+                logger.warning(f"ImapReplyAgent: Could not parse BODYSTRUCTURE for UIDs {uid_set} (Org ID {organization_id}): {e_parse}")
+
+        reply_texts: Dict[int, str] = {}
+        uids_by_location: Dict[Any, List[int]] = {}
+        unstructured_uids: List[int] = []
+        for uid in uids:
+            bodystructure = structures.get(uid, {}).get("BODYSTRUCTURE")
+            if not isinstance(bodystructure, list):
+                unstructured_uids.append(uid)
+                continue
+            location = find_text_part(bodystructure)
+            if location is None:
+                reply_texts[uid] = "" # Only attachments/images: nothing to classify
+                continue
+            uids_by_location.setdefault(location, []).append(uid)
+
+        # One command per distinct section path/encoding (usually just "1" and "1.1")
+        for location, location_uids in uids_by_location.items():
+            section_items = f"(UID BODY.PEEK[{location.section}]<0.{self.max_text_part_bytes}>)"
+            for uid, section_bytes in self._uid_fetch(imap_conn, location_uids, section_items, organization_id).items():
+                text = decode_text_part(section_bytes, location)
+                reply_texts[uid] = html_to_text(text) if location.subtype == "html" else text
+
+        if unstructured_uids:
+            logger.warning(f"ImapReplyAgent: No usable BODYSTRUCTURE for {len(unstructured_uids)} email(s) (Org ID {organization_id}); fetching them whole.")
+            for uid, raw_email_bytes in self._uid_fetch(imap_conn, unstructured_uids, FULL_MESSAGE_FETCH_ITEMS, organization_id).items():
+                reply_texts[uid] = self._get_cleaned_email_body_text(email.message_from_bytes(raw_email_bytes))
+        return reply_texts
+
+    def _store_and_classify_reply(self, db: Session, organization_id: int, reply_headers: Dict[str, Any],
+                                  link: Dict[str, Any], reply_text: str, raw_body_text: str) -> bool:
+        """Stores one linked reply, classified by rules, queued for the worker pool or classified inline; returns False if it could not be stored."""
+        lead_id = link["lead_id"]
+        lcs_id = link["lcs_id"]
+        from_address_email = reply_headers["from_address_email"]
+        received_at_dt = reply_headers["received_at"]
+        reply_data_to_store = {
+            "message_id_header_of_reply": reply_headers["message_id_header"],
+            "outgoing_email_log_id": link["outgoing_email_log_id"],
+            "lead_campaign_status_id": lcs_id,
+            "organization_id": organization_id,
+            "lead_id": lead_id,
+            "campaign_id": link["campaign_id"],
+            "received_at": received_at_dt,
+            "from_email": from_address_email,
+            "reply_subject": reply_headers["reply_subject"],
+            "raw_body_text": raw_body_text,
+        }
+
+        cleaned_body = self._clean_reply_text(reply_text)
+        if not cleaned_body.strip(): # Handle empty reply
+            logger.info(f"ImapReplyAgent: Reply from {from_address_email} (Lead {lead_id}) has empty cleaned body. Storing as 'empty_reply'.")
+            return db_ops.store_email_reply(db, {
+                **reply_data_to_store,
+                "cleaned_reply_text": "",
+                "ai_classification": "EMPTY_REPLY",
+                "is_actioned_by_user": True
+            }) is not None
+
+        classification_result = None
+        if self.enable_rule_classification:
+            # Auto-replies, unsubscribes and one-line thanks don't need an LLM call
+            classification_result = classify_reply_by_rules(cleaned_body, reply_headers["auto_reply_headers"], reply_headers["reply_subject"])
+            if classification_result:
+                logger.info(f"ImapReplyAgent: Reply from {from_address_email} (Lead {lead_id}) classified as '{classification_result['category']}' by {classification_result['classified_by']}.")
+
+        reply_data_to_store.update({"cleaned_reply_text": cleaned_body, "is_actioned_by_user": False})
+        if classification_result is None and self.classification_pool and self.classification_pool.running:
+            # Don't wait on the LLM here: the worker pool classifies it and updates the lead
+            stored_reply_orm = db_ops.store_email_reply(db, {**reply_data_to_store, "classification_status": models.REPLY_CLASSIFICATION_PENDING})
+            if stored_reply_orm:
+                logger.info(f"ImapReplyAgent: Stored reply ID {stored_reply_orm.id} for Lead {lead_id}; queued for classification.")
+                self.classification_pool.notify()
+            else:
+                logger.error(f"ImapReplyAgent: Failed to store processed reply from {from_address_email} for Lead {lead_id}.")
+            return stored_reply_orm is not None
 
+        if classification_result is None and self.reply_classifier:
+            try:
+                classification_result = self.reply_classifier.classify_reply_text(cleaned_body, link["lead_name"], db=db)
+            except Exception as class_e: logger.error(f"ImapReplyAgent: Error during reply classification for Lead {lead_id}: {class_e}", exc_info=True)
+        elif classification_result is None: logger.warning("ImapReplyAgent: ReplyClassifierAgent not available.")
+
+        reply_data_to_store.update({
+            "ai_classification": classification_result.get("category") if classification_result else "CLASSIFICATION_FAILED",
+            "ai_summary": classification_result.get("summary") if classification_result else None,
+            "ai_extracted_entities": classification_result.get("extracted_info") if classification_result else None,
+            "classification_status": models.REPLY_CLASSIFICATION_DONE if classification_result else models.REPLY_CLASSIFICATION_FAILED,
+        })
+        stored_reply_orm = db_ops.store_email_reply(db, reply_data_to_store)
+
+        if stored_reply_orm and classification_result:
+            logger.info(f"ImapReplyAgent: Stored reply ID {stored_reply_orm.id} for Lead {lead_id} with AI class '{classification_result.get('category')}'")
+            apply_classification_to_lead(db, lcs_id, organization_id, lead_id, classification_result.get("category"), received_at_dt)
+        elif stored_reply_orm:
+            logger.info(f"ImapReplyAgent: Stored reply ID {stored_reply_orm.id} for Lead {lead_id} (LCS ID: {lcs_id}, Classification: {classification_result is not None}).")
+        else:
+            logger.error(f"ImapReplyAgent: Failed to store processed reply from {from_address_email} for Lead {lead_id}.")
+        return stored_reply_orm is not None
+
+    def open_mailbox(self, org_settings_obj: models.OrganizationEmailSettings) -> Optional[Tuple[Any, Optional[str]]]:
+        """Connects, logs in and selects INBOX. Returns (imap_conn, UIDVALIDITY) or None on failure."""
+        organization_id = org_settings_obj.organization_id
         imap_host = org_settings_obj.imap_host
         default_port = 993 if org_settings_obj.imap_use_ssl else 143
         imap_port = org_settings_obj.imap_port if org_settings_obj.imap_port is not None else default_port
         imap_user = org_settings_obj.imap_username
 
         # imap_password should be a decrypted transient attribute on org_settings_obj
-        # set by get_organizations_with_imap_enabled
+        # set by get_organizations_with_imap_enabled / get_org_email_settings_from_db
         imap_password = getattr(org_settings_obj, 'imap_password', None) # Access the decrypted password
-
         use_ssl = org_settings_obj.imap_use_ssl
-        last_processed_uid_str = org_settings_obj.last_imap_poll_uid # String or None
 
         if not all([imap_host, imap_user, imap_password]):
             logger.error(f"ImapReplyAgent: Incomplete IMAP credentials for Org ID {organization_id}. Skipping. Host: {imap_host}, User: {imap_user}, PassSet: {imap_password is not None}")
-            return
+            return None
 
         imap_conn: Optional[imaplib.IMAP4_SSL | imaplib.IMAP4] = None
         try:
             logger.debug(f"ImapReplyAgent: Connecting to IMAP {imap_host}:{imap_port} for Org ID {organization_id} (SSL: {use_ssl})")
+            # The timeout applies to every socket operation, so one slow server can't hold a worker indefinitely
             if use_ssl:
-                imap_conn = imaplib.IMAP4_SSL(imap_host, imap_port)
+                imap_conn = imaplib.IMAP4_SSL(imap_host, imap_port, timeout=self.imap_timeout_seconds)
             else:
-                imap_conn = imaplib.IMAP4(imap_host, imap_port)
+                imap_conn = imaplib.IMAP4(imap_host, imap_port, timeout=self.imap_timeout_seconds)
 
             status, login_response = imap_conn.login(imap_user, imap_password)
             if status != 'OK':
                 logger.error(f"ImapReplyAgent: IMAP login failed for Org ID {organization_id}. Response: {login_response}")
-                return
+                self.close_mailbox(imap_conn, organization_id)
+                return None
             logger.info(f"ImapReplyAgent: IMAP login successful for Org ID {organization_id}.")
 
             status, select_response = imap_conn.select("INBOX", readonly=False)
             if status != 'OK':
                 logger.error(f"ImapReplyAgent: Failed to select INBOX for Org ID {organization_id}. Response: {select_response}")
-                return
-
-            search_criteria = '(UNSEEN)'
-            if last_processed_uid_str and last_processed_uid_str.isdigit():
-                # More robust: Fetch only UIDs greater than the last one
-                # Consider UIDVALIDITY checks for full robustness (omitted for brevity here)
-                search_criteria = f'(UID {int(last_processed_uid_str) + 1}:*)'
-                logger.info(f"ImapReplyAgent: Searching with UID criteria: {search_criteria}")
-
-
-            logger.debug(f"ImapReplyAgent: Searching INBOX with criteria: {search_criteria} for Org ID {organization_id}")
-            status, message_uids_bytes_list = imap_conn.uid('search', None, search_criteria)
-            if status != 'OK':
-                logger.error(f"ImapReplyAgent: IMAP search failed for Org ID {organization_id}. Response: {message_uids_bytes_list}")
-                return
-
-            email_uids_to_fetch_str = message_uids_bytes_list[0].decode().split()
-            if not email_uids_to_fetch_str:
-                logger.info(f"ImapReplyAgent: No new emails matching criteria for Org ID {organization_id} using '{search_criteria}'.")
-                # If UID search returned nothing, but UNSEEN might have older unseen, consider a fallback UNSEEN search
-                # For now, we'll proceed if the current criteria finds nothing.
-                return
-            logger.info(f"ImapReplyAgent: Found {len(email_uids_to_fetch_str)} email(s) for Org ID {organization_id} using '{search_criteria}'.")
-
-            new_max_uid_processed_this_cycle = int(last_processed_uid_str or 0)
-
-            for email_uid_str in email_uids_to_fetch_str:
-                email_uid_bytes = email_uid_str.encode()
-                current_email_uid_int = int(email_uid_str)
-                
-                # If using UID-based search, we assume all fetched UIDs are "new" relative to last_processed_uid_str.
-                # If using UNSEEN, this check is more relevant to avoid reprocessing if an email was marked SEEN by another client.
-                if last_processed_uid_str and current_email_uid_int <= int(last_processed_uid_str) and search_criteria == '(UNSEEN)':
-                    logger.debug(f"ImapReplyAgent: Skipping UID {email_uid_str} as it's less than or equal to last processed UID {last_processed_uid_str} during UNSEEN scan.")
-                    imap_conn.uid('store', email_uid_bytes, '+FLAGS', '(\\Seen)') # Mark it seen anyway
-                    continue
-
-                new_max_uid_processed_this_cycle = max(new_max_uid_processed_this_cycle, current_email_uid_int)
-
-                logger.debug(f"ImapReplyAgent: Fetching email UID {email_uid_str} for Org ID {organization_id}")
-                status, msg_data = imap_conn.uid('fetch', email_uid_bytes, '(RFC822)')
-                # ... (rest of your email parsing logic - keep it) ...
-                if status != 'OK' or not msg_data or msg_data[0] is None:
-                    logger.error(f"ImapReplyAgent: Failed to fetch email UID {email_uid_str} for Org ID {organization_id}")
-                    continue
-                raw_email_bytes = None
-                if isinstance(msg_data[0], tuple) and len(msg_data[0]) == 2 and isinstance(msg_data[0][1], bytes):
-                    raw_email_bytes = msg_data[0][1]
-                elif isinstance(msg_data[0], bytes):
-                    raw_email_bytes = msg_data[0]
-                if not raw_email_bytes:
-                    logger.error(f"ImapReplyAgent: Could not extract raw email bytes for UID {email_uid_str}")
-                    continue
-
-                email_message = email.message_from_bytes(raw_email_bytes)
-                message_id_header = self._decode_email_header(email_message.get("Message-ID"))
-                in_reply_to_header = self._decode_email_header(email_message.get("In-Reply-To"))
-                references_header = self._decode_email_header(email_message.get("References"))
-                from_address_full = self._decode_email_header(email_message.get("From"))
-                from_address_email_match = re.search(r'<([^>]+)>', from_address_full)
-                from_address_email = from_address_email_match.group(1).strip() if from_address_email_match else from_address_full.strip()
-                reply_subject = self._decode_email_header(email_message.get("Subject"))
-                date_str = email_message.get("Date")
-                received_at_dt = parsedate_to_datetime(date_str) if date_str else datetime.now(timezone.utc)
-                if received_at_dt.tzinfo is None:
-                    received_at_dt = received_at_dt.replace(tzinfo=timezone.utc)
-                else:
-                    received_at_dt = received_at_dt.astimezone(timezone.utc)
-
-                original_message_id_to_find = None
-                if in_reply_to_header:
-                    original_message_id_to_find = in_reply_to_header.strip("<> ")
-                elif references_header:
-                    ref_ids = references_header.strip().split()
-                    if ref_ids: original_message_id_to_find = ref_ids[-1].strip("<> ")
-                
-                outgoing_log_entry_orm: Optional[models.OutgoingEmailLog] = None # Changed to ORM type
-                if original_message_id_to_find:
-                    logger.debug(f"ImapReplyAgent: Attempting to link reply via Message-ID: {original_message_id_to_find}")
-                    # Use the passed-in db session
-                    outgoing_log_entry_orm = db_ops.get_outgoing_email_log_by_message_id(
-                        db, organization_id, original_message_id_to_find
-                    )
-
-                lead_id, campaign_id, lcs_id = None, None, None
-                lead_name_for_prompt = "Valued Prospect"
-
-                if outgoing_log_entry_orm:
-                    lead_id = outgoing_log_entry_orm.lead_id
-                    campaign_id = outgoing_log_entry_orm.campaign_id
-                    lcs_id = outgoing_log_entry_orm.lead_campaign_status_id # Directly from log if available
-                    
-                    if lead_id and not lcs_id: # If log doesn't have LCS ID, try to get it
-                        lcs_record_orm = db_ops.get_lead_campaign_status(db, lead_id, organization_id) # Use current session
-                        if lcs_record_orm: lcs_id = lcs_record_orm.id
-
-                    if lead_id:
-                        lead_details_orm = db_ops.get_lead_by_id(db, lead_id, organization_id) # Use current session
-                        if lead_details_orm: lead_name_for_prompt = lead_details_orm.name or lead_name_for_prompt
-                    logger.info(f"ImapReplyAgent: Reply from {from_address_email} linked to Lead {lead_id}, Campaign {campaign_id} via Message-ID.")
-                else: # Try to link by From address
-                    logger.debug(f"ImapReplyAgent: Could not link by Message-ID. Trying to link by From: {from_address_email}")
-                    potential_lead_orm = db_ops.get_lead_by_email(db, from_address_email, organization_id) # Use current session
-                    if potential_lead_orm:
-                        lead_id = potential_lead_orm.id
-                        lead_name_for_prompt = potential_lead_orm.name or lead_name_for_prompt
-                        # Get their most recent *active* campaign status (or any status for context)
-                        # This might need a more specific DB function if you only want "active"
-                        status_rec_orm = db_ops.get_lead_campaign_status(db, lead_id, organization_id) # Use current session
-                        if status_rec_orm:
-                            campaign_id = status_rec_orm.campaign_id
-                            lcs_id = status_rec_orm.id
-                            logger.info(f"ImapReplyAgent: Reply from {from_address_email} linked to Lead {lead_id}, Campaign {campaign_id} (LCS ID: {lcs_id}) via From address.")
-                        else:
-                            logger.info(f"ImapReplyAgent: Lead {lead_id} (from {from_address_email}) found, but no campaign status record. Storing reply linked to lead only.")
-                    else:
-                        logger.info(f"ImapReplyAgent: Could not link reply from {from_address_email} to any known lead for org {organization_id}.")
-                        imap_conn.uid('store', email_uid_bytes, '+FLAGS', '(\\Seen)')
-                        continue
-                
-                if not lead_id: # If still no lead_id, cannot proceed
-                    logger.warning(f"ImapReplyAgent: Essential linking info (lead_id) missing for reply from {from_address_email}. Skipping classification.")
-                    imap_conn.uid('store', email_uid_bytes, '+FLAGS', '(\\Seen)')
-                    continue
-
-                cleaned_body = self._get_cleaned_email_body_text(email_message)
-                # ... (rest of your classification and storing logic) ...
-                # Ensure all db_ops calls use the passed 'db' session.
-                # Example for storing reply:
-                if not cleaned_body.strip(): # Handle empty reply
-                    logger.info(f"ImapReplyAgent: Reply from {from_address_email} (Lead {lead_id}) has empty cleaned body. Storing as 'empty_reply'.")
-                    db_ops.store_email_reply(db, { # Use passed db session
-                        "message_id_header": message_id_header,
-                        "outgoing_email_log_id": outgoing_log_entry_orm.id if outgoing_log_entry_orm else None,
-                        "lead_campaign_status_id": lcs_id,
-                        "organization_id": organization_id,
-                        "lead_id": lead_id,
-                        "campaign_id": campaign_id,
-                        "received_at": received_at_dt,
-                        "from_email": from_address_email,
-                        "reply_subject": reply_subject,
-                        "raw_body_text": raw_email_bytes.decode('utf-8', 'replace'),
-                        "cleaned_reply_text": "",
-                        "ai_classification": "EMPTY_REPLY",
-                        "is_actioned_by_user": True
-                    })
-                    imap_conn.uid('store', email_uid_bytes, '+FLAGS', '(\\Seen)')
-                    continue
-
-                classification_result = None
-                if self.reply_classifier:
-                    try:
-                        classification_result = self.reply_classifier.classify_text(cleaned_body, lead_name_for_prompt)
-                    except Exception as class_e: logger.error(f"ImapReplyAgent: Error during reply classification for Lead {lead_id}: {class_e}", exc_info=True)
-                else: logger.warning("ImapReplyAgent: ReplyClassifierAgent not available.")
-
-                reply_data_to_store = {
-                    "message_id_header": message_id_header,
-                    "outgoing_email_log_id": outgoing_log_entry_orm.id if outgoing_log_entry_orm else None,
-                    "lead_campaign_status_id": lcs_id,
-                    "organization_id": organization_id,
-                    "lead_id": lead_id,
-                    "campaign_id": campaign_id,
-                    "received_at": received_at_dt,
-                    "from_email": from_address_email,
-                    "reply_subject": reply_subject,
-                    "raw_body_text": raw_email_bytes.decode('utf-8', 'replace'),
-                    "cleaned_reply_text": cleaned_body,
-                    "ai_classification": classification_result.get("category") if classification_result else "CLASSIFICATION_FAILED",
-                    "ai_summary": classification_result.get("summary") if classification_result else None,
-                    "ai_extracted_entities": classification_result.get("extracted_info") if classification_result else None,
-                    "is_actioned_by_user": False
-                }
-                stored_reply_orm = db_ops.store_email_reply(db, reply_data_to_store) # Use passed db session
-
-                if stored_reply_orm and lcs_id and classification_result:
-                    logger.info(f"ImapReplyAgent: Stored reply ID {stored_reply_orm.id} for Lead {lead_id} with AI class '{classification_result.get('category')}'")
-                    status_updates: Dict[str, Any] = {
-                        "last_response_type": classification_result.get("category"),
-                        "last_response_at": received_at_dt,
-                    }
-                    ai_cat = classification_result.get("category", "").upper()
-                    # Simplified status update logic (expand as needed)
-                    if "POSITIVE" in ai_cat or "QUESTION" in ai_cat: status_updates["status"] = "positive_reply_ai_flagged"; status_updates["next_email_due_at"] = None
-                    elif "UNSUBSCRIBE" in ai_cat: status_updates["status"] = "unsubscribed_ai_flagged"; status_updates["next_email_due_at"] = None
-                    elif "NEGATIVE" in ai_cat: status_updates["status"] = "negative_reply_ai_flagged"; status_updates["next_email_due_at"] = None
-                    
-                    if status_updates.get("status"):
-                        db_ops.update_lead_campaign_status(db, lcs_id, organization_id, status_updates) # Use passed db session
-                        logger.info(f"ImapReplyAgent: Updated LCS ID {lcs_id} for Lead {lead_id} to status '{status_updates['status']}'")
-                elif stored_reply_orm:
-                    logger.info(f"ImapReplyAgent: Stored reply ID {stored_reply_orm.id} for Lead {lead_id} (LCS ID: {lcs_id}, Classification: {classification_result is not None}).")
-                else:
-                    logger.error(f"ImapReplyAgent: Failed to store processed reply from {from_address_email} for Lead {lead_id}.")
-
-                imap_conn.uid('store', email_uid_bytes, '+FLAGS', '(\\Seen)')
-                logger.debug(f"ImapReplyAgent: Marked email UID {email_uid_str} as Seen for Org ID {organization_id}.")
-
+                self.close_mailbox(imap_conn, organization_id)
+                return None
+            _, uidvalidity_data = imap_conn.response('UIDVALIDITY')
+            uidvalidity = uidvalidity_data[0].decode() if uidvalidity_data and uidvalidity_data[0] else None
+            return imap_conn, uidvalidity
+        except (imaplib.IMAP4.error, OSError) as e_imap:
+            logger.error(f"ImapReplyAgent: Could not open INBOX for Org ID {organization_id} ({imap_user}): {e_imap}", exc_info=True)
+            if imap_conn:
+                self.close_mailbox(imap_conn, organization_id)
+            return None
+
+    def close_mailbox(self, imap_conn: Any, organization_id: int):
+        try: imap_conn.close()
+        except: pass
+        try: imap_conn.logout()
+        except: pass
+        logger.debug(f"ImapReplyAgent: IMAP Connection actions (close/logout) performed for Org ID {organization_id}")
+
+    def process_mailbox(self, db: Session, imap_conn: Any, org_settings_obj: models.OrganizationEmailSettings,
+                         uidvalidity: Optional[str], deadline: Optional[float] = None):
+        """
+        Processes new mail in an already selected INBOX and advances last_imap_poll_uid.
+        Shared by the interval poller and the IDLE connection manager; IMAP errors propagate.
+        If the mailbox's UIDVALIDITY no longer matches the stored one, its UIDs were renumbered
+        and the stored last_imap_poll_uid is meaningless, so it is reset.
+        """
+        organization_id = org_settings_obj.organization_id
+        last_processed_uid_str = org_settings_obj.last_imap_poll_uid # String or None
+        stored_uidvalidity = getattr(org_settings_obj, 'last_imap_uidvalidity', None)
+        if uidvalidity and uidvalidity != stored_uidvalidity:
+            if stored_uidvalidity:
+                logger.warning(f"ImapReplyAgent: UIDVALIDITY for Org ID {organization_id} changed ({stored_uidvalidity} -> {uidvalidity}); resetting last_imap_poll_uid.")
+                last_processed_uid_str = None
+            db_ops.update_organization_email_settings_field(
+                db, organization_id, {"last_imap_uidvalidity": uidvalidity, "last_imap_poll_uid": last_processed_uid_str}
+            )
+
+        search_criteria = '(UNSEEN)'
+        if last_processed_uid_str and last_processed_uid_str.isdigit():
+            # More robust: Fetch only UIDs greater than the last one (valid while UIDVALIDITY is unchanged)
+            search_criteria = f'(UID {int(last_processed_uid_str) + 1}:*)'
+            logger.info(f"ImapReplyAgent: Searching with UID criteria: {search_criteria}")
+
+
+        logger.debug(f"ImapReplyAgent: Searching INBOX with criteria: {search_criteria} for Org ID {organization_id}")
+        status, message_uids_bytes_list = imap_conn.uid('search', None, search_criteria)
+        if status != 'OK':
+            logger.error(f"ImapReplyAgent: IMAP search failed for Org ID {organization_id}. Response: {message_uids_bytes_list}")
+            return
 
-            # After processing all UIDs in this batch, update last_processed_uid for the org
-            # Only update if we actually processed something new or the max UID changed
-            if new_max_uid_processed_this_cycle > int(last_processed_uid_str or 0):
-                db_ops.update_organization_email_settings_field( # Use passed db session
-                    db,
-                    organization_id,
-                    {"last_imap_poll_uid": str(new_max_uid_processed_this_cycle), "last_imap_poll_timestamp": datetime.now(timezone.utc)}
-                )
-                logger.info(f"ImapReplyAgent: Updated last_imap_poll_uid for Org ID {organization_id} to {new_max_uid_processed_this_cycle}.")
+        email_uids_to_fetch_str = message_uids_bytes_list[0].decode().split()
+        if not email_uids_to_fetch_str:
+            logger.info(f"ImapReplyAgent: No new emails matching criteria for Org ID {organization_id} using '{search_criteria}'.")
+            # If UID search returned nothing, but UNSEEN might have older unseen, consider a fallback UNSEEN search
+            # For now, we'll proceed if the current criteria finds nothing.
+            return
+        logger.info(f"ImapReplyAgent: Found {len(email_uids_to_fetch_str)} email(s) for Org ID {organization_id} using '{search_criteria}'.")
+
+        last_processed_uid = int(last_processed_uid_str) if last_processed_uid_str and last_processed_uid_str.isdigit() else 0
+        candidate_uids: List[int] = []
+        for email_uid_str in email_uids_to_fetch_str:
+            # "UID n:*" always matches the newest message, even when its UID is below n
+            if int(email_uid_str) <= last_processed_uid:
+                logger.debug(f"ImapReplyAgent: Skipping UID {email_uid_str} as it's less than or equal to last processed UID {last_processed_uid_str}.")
+                continue
+            candidate_uids.append(int(email_uid_str))
+        candidate_uids.sort()
+
+        # Phase 1: headers only, for the whole UID set in as few commands as possible
+        headers_by_uid = self._uid_fetch(imap_conn, candidate_uids, REPLY_HEADER_FETCH_ITEMS, organization_id)
+        reply_headers_by_uid: Dict[int, Dict[str, Any]] = {}
+        for email_uid in candidate_uids:
+            header_bytes = headers_by_uid.get(email_uid)
+            if header_bytes is None:
+                logger.error(f"ImapReplyAgent: Failed to fetch headers for email UID {email_uid} for Org ID {organization_id}")
+                continue
+            reply_headers_by_uid[email_uid] = self._parse_reply_headers(email.message_from_bytes(header_bytes))
+
+        # Replies seen before (UIDVALIDITY reset, re-poll) are skipped before any linking, download or LLM call
+        stored_message_ids = db_ops.get_stored_reply_message_ids(
+            db, [reply_headers["message_id_header"].strip() for reply_headers in reply_headers_by_uid.values()]
+        ) or set()
+        duplicate_uids: List[int] = []
+        for email_uid, reply_headers in reply_headers_by_uid.items():
+            reply_message_id = reply_headers["message_id_header"].strip()
+            if reply_message_id in stored_message_ids:
+                duplicate_uids.append(email_uid)
+            elif reply_message_id:
+                stored_message_ids.add(reply_message_id) # The same message twice in one batch is stored once
+        for email_uid in duplicate_uids:
+            del reply_headers_by_uid[email_uid]
+        if duplicate_uids:
+            logger.info(f"ImapReplyAgent: Skipping {len(duplicate_uids)} already stored repl(ies) for Org ID {organization_id}.")
+
+        links_by_uid = self._link_replies_to_leads(db, organization_id, reply_headers_by_uid)
+        linked_replies: Dict[int, tuple] = {
+            email_uid: (reply_headers, links_by_uid[email_uid])
+            for email_uid, reply_headers in reply_headers_by_uid.items() if email_uid in links_by_uid
+        }
+        # Flags are set in one batch at the end, and only for mail whose DB writes succeeded
+        uids_to_mark_seen: List[int] = duplicate_uids + [email_uid for email_uid in reply_headers_by_uid if email_uid not in links_by_uid]
+        logger.info(f"ImapReplyAgent: {len(linked_replies)} of {len(candidate_uids)} email(s) link to a lead for Org ID {organization_id}; fetching bodies for those only.")
+
+        # Phase 2: only the text part of replies that link to a lead
+        reply_texts_by_uid = self._fetch_reply_texts(imap_conn, sorted(linked_replies), organization_id)
+        new_max_uid_processed_this_cycle = candidate_uids[-1] if candidate_uids else last_processed_uid
+        first_unstored_uid: Optional[int] = None # last_imap_poll_uid must stay below it so the next cycle retries it
+        for email_uid, (reply_headers, link) in sorted(linked_replies.items()):
+            if deadline is not None and time.monotonic() >= deadline:
+                # This and later UIDs stay above last_imap_poll_uid and are picked up next cycle
+                logger.warning(f"ImapReplyAgent: Poll cycle budget spent; stopping Org ID {organization_id} before UID {email_uid}.")
+                new_max_uid_processed_this_cycle = max([last_processed_uid] + [uid for uid in candidate_uids if uid < email_uid])
+                break
+            reply_text = reply_texts_by_uid.get(email_uid)
+            if reply_text is None:
+                logger.error(f"ImapReplyAgent: Could not fetch the text of email UID {email_uid}")
+                first_unstored_uid = first_unstored_uid or email_uid
+                continue
+
+            # Attachments are never downloaded, so the stored raw body is the headers plus the text part
+            raw_body_text = headers_by_uid[email_uid].decode('utf-8', 'replace').rstrip() + "\r\n\r\n" + reply_text
+            try:
+                stored = self._store_and_classify_reply(db, organization_id, reply_headers, link, reply_text, raw_body_text)
+            except Exception as store_e:
+                logger.error(f"ImapReplyAgent: Error storing reply in email UID {email_uid} for Org ID {organization_id}: {store_e}", exc_info=True)
+                stored = False
+            if stored:
+                uids_to_mark_seen.append(email_uid)
+            else:
+                logger.warning(f"ImapReplyAgent: Leaving email UID {email_uid} unseen for Org ID {organization_id}: its reply was not stored.")
+                first_unstored_uid = first_unstored_uid or email_uid
+
+        if first_unstored_uid is not None:
+            # Later replies that were stored are skipped as duplicates (by Message-ID) when re-polled
+            new_max_uid_processed_this_cycle = min(
+                new_max_uid_processed_this_cycle,
+                max([last_processed_uid] + [uid for uid in candidate_uids if uid < first_unstored_uid]),
+            )
+
+        # After processing all UIDs in this batch, update last_processed_uid for the org
+        # Only update if we actually processed something new or the max UID changed
+        if new_max_uid_processed_this_cycle > last_processed_uid:
+            db_ops.update_organization_email_settings_field( # Use passed db session
+                db,
+                organization_id,
+                {"last_imap_poll_uid": str(new_max_uid_processed_this_cycle), "last_imap_poll_timestamp": datetime.now(timezone.utc)}
+            )
+            logger.info(f"ImapReplyAgent: Updated last_imap_poll_uid for Org ID {organization_id} to {new_max_uid_processed_this_cycle}.")
+
+        if uids_to_mark_seen:
+            self._mark_seen(imap_conn, uids_to_mark_seen, organization_id)
+
+
+    def _process_single_inbox(self, db: Session, org_settings_obj: models.OrganizationEmailSettings, deadline: Optional[float] = None):
+        # org_settings_obj is now an ORM object, not a dict
+        # The db session is passed in; it belongs to the calling worker thread
+        # deadline (time.monotonic()) stops the message loop when the cycle's budget is spent
+        organization_id = org_settings_obj.organization_id
+        logger.info(f"ImapReplyAgent: Processing inbox for Org ID: {organization_id}, User: {org_settings_obj.imap_username}")
 
+        opened = self.open_mailbox(org_settings_obj)
+        if opened is None:
+            return
+        imap_conn, uidvalidity = opened
+        try:
+            self.process_mailbox(db, imap_conn, org_settings_obj, uidvalidity, deadline)
         except imaplib.IMAP4.error as e_imap:
-            logger.error(f"ImapReplyAgent: IMAP4 error for Org ID {organization_id} ({imap_user}): {e_imap}", exc_info=True)
+            logger.error(f"ImapReplyAgent: IMAP4 error for Org ID {organization_id} ({org_settings_obj.imap_username}): {e_imap}", exc_info=True)
         except Exception as e_main:
             logger.error(f"ImapReplyAgent: General error processing inbox for Org ID {organization_id}: {e_main}", exc_info=True)
         finally:
-            if imap_conn:
-                try: imap_conn.close()
-                except: pass
-                try: imap_conn.logout()
-                except: pass
-                logger.debug(f"ImapReplyAgent: IMAP Connection actions (close/logout) performed for Org ID {organization_id}")
+            self.close_mailbox(imap_conn, organization_id)
+
+    def claim_organization(self, organization_id: int) -> bool:
+        """Marks an org's inbox as being processed; False if a poll worker or IDLE session already has it."""
+        with self._orgs_in_flight_lock:
+            if organization_id in self._orgs_in_flight:
+                return False
+            self._orgs_in_flight.add(organization_id)
+            return True
+
+    def release_organization(self, organization_id: int):
+        with self._orgs_in_flight_lock:
+            self._orgs_in_flight.discard(organization_id)
+
+    def _poll_organization(self, organization_id: int, deadline: float):
+        """Worker: polls one organization's inbox on its own DB session."""
+        db_session: Session = next(get_db()) # Sessions aren't thread-safe; one per worker
+        try:
+            org_settings_orm_obj = db_ops.get_org_email_settings_from_db(db_session, organization_id) # Decrypts imap_password
+            if org_settings_orm_obj and org_settings_orm_obj.is_configured and org_settings_orm_obj.enable_reply_detection:
+                self._process_single_inbox(db_session, org_settings_orm_obj, deadline)
+            else:
+                logger.warning(f"ImapReplyAgent: Skipping org ID {organization_id}: IMAP settings missing or no longer enabled.")
+        except Exception as e:
+            logger.error(f"ImapReplyAgent: Unhandled error polling Org ID {organization_id}: {e}", exc_info=True)
+        finally:
+            db_session.close()
+            self.release_organization(organization_id)
 
     def trigger_imap_polling_for_all_orgs(self):
+        """
+        Polls every configured organization's inbox in parallel on a bounded thread pool
+        (IMAP_POLL_MAX_WORKERS). Each worker has its own DB session and IMAP socket timeout,
+        and the cycle as a whole stops waiting after IMAP_POLL_CYCLE_BUDGET_SECONDS.
+        """
         logger.info("ImapReplyAgent: Starting polling cycle for all configured organizations.")
-        
-        db_session: Session = next(get_db()) # <--- GET ONE SESSION FOR THE WHOLE POLLING CYCLE
-        organizations_to_poll: List[models.OrganizationEmailSettings] = []
+        cycle_started = time.monotonic()
+        deadline = cycle_started + self.poll_cycle_budget_seconds
+
+        db_session: Session = next(get_db()) # Only used to list the organizations to poll
         try:
-            # This function now takes 'db' and returns ORM objects with decrypted imap_password
-            organizations_to_poll = db_ops.get_organizations_with_imap_enabled(db_session) # Pass the session
-
-            if not organizations_to_poll:
-                logger.info("ImapReplyAgent: No organizations found with IMAP reply detection enabled and configured.")
-                return
-
-            for org_settings_orm_obj in organizations_to_poll: # This is now an ORM object
-                # org_id is org_settings_orm_obj.organization_id
-                # imap_is_configured is org_settings_orm_obj.is_configured (or a specific imap_is_configured field if you add one)
-                if org_settings_orm_obj.organization_id and org_settings_orm_obj.is_configured and org_settings_orm_obj.enable_reply_detection:
-                    # Pass the SAME db_session and the ORM object to _process_single_inbox
-                    self._process_single_inbox(db_session, org_settings_orm_obj)
-                else:
-                    logger.warning(f"ImapReplyAgent: Skipping org ID {org_settings_orm_obj.organization_id} due to missing ID or IMAP not configured/enabled.")
-            
+            organizations_to_poll: List[models.OrganizationEmailSettings] = db_ops.get_organizations_with_imap_enabled(db_session)
+            organization_ids = [
+                org_settings_orm_obj.organization_id for org_settings_orm_obj in organizations_to_poll
+                if org_settings_orm_obj.organization_id and org_settings_orm_obj.is_configured and org_settings_orm_obj.enable_reply_detection
+            ]
         except Exception as e:
-            logger.error(f"ImapReplyAgent: Failed to get/process organizations for IMAP polling: {e}", exc_info=True)
+            logger.error(f"ImapReplyAgent: Failed to get organizations for IMAP polling: {e}", exc_info=True)
+            return
         finally:
-            db_session.close() # <--- CLOSE THE SESSION AT THE END OF THE CYCLE
-            
-        logger.info("ImapReplyAgent: Finished polling cycle for all organizations.")
+            db_session.close()
+
+        if not organization_ids:
+            logger.info("ImapReplyAgent: No organizations found with IMAP reply detection enabled and configured.")
+            return
+
+        still_running = [org_id for org_id in organization_ids if not self.claim_organization(org_id)]
+        organization_ids = [org_id for org_id in organization_ids if org_id not in still_running]
+        if still_running:
+            logger.info(f"ImapReplyAgent: Skipping orgs still being processed by a previous cycle or an IDLE session: {still_running}")
+
+        executor = ThreadPoolExecutor(max_workers=self.max_poll_workers, thread_name_prefix="imap-poll")
+        futures = {executor.submit(self._poll_organization, org_id, deadline): org_id for org_id in organization_ids}
+        done, not_done = wait(futures, timeout=self.poll_cycle_budget_seconds)
+        # Don't block on stragglers: queued orgs are cancelled, running ones stop at their next message
+        executor.shutdown(wait=False, cancel_futures=True)
+        for future in not_done:
+            if future.cancelled():
+                self.release_organization(futures[future])
+        if not_done:
+            logger.warning(f"ImapReplyAgent: Poll cycle budget of {self.poll_cycle_budget_seconds:.0f}s spent; "
+                           f"{len(not_done)} org(s) not finished: {sorted(futures[future] for future in not_done)}")
+
+        logger.info(f"ImapReplyAgent: Finished polling cycle for {len(done)}/{len(organization_ids)} organizations in {time.monotonic() - cycle_started:.1f}s.")
 
     def run(self): # Method that APScheduler will call
         logger.info("ImapReplyAgent: Scheduled run triggered.")
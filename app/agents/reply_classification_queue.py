@@ -0,0 +1,152 @@
+# app/agents/reply_classification_queue.py
+
+import asyncio
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.orm import Session # For type hinting
+
+from app.utils.config import settings
+from app.utils.logger import logger
+from app.db import database as db_ops
+from app.db.database import get_db
+from app.db import models
+
+# ImapReplyAgent stores replies as pending_classification and marks them Seen straight away;
+# the pool below drains that queue with a bounded number of concurrent LLM calls, so an
+# inbox is no longer processed one LLM round-trip at a time. The email_replies rows are the
+# queue: claims are leases (FOR UPDATE SKIP LOCKED), so several app processes can share it
+# and replies claimed by a process that died are picked up again when the lease expires.
+
+
+def lead_status_updates_for_classification(category: Optional[str], received_at: datetime) -> Dict[str, Any]:
+    """LeadCampaignStatus updates for a classified reply; empty if the category doesn't change the lead's status."""
+    ai_cat = (category or "").upper()
+    # Simplified status update logic (expand as needed)
+    if "POSITIVE" in ai_cat or "QUESTION" in ai_cat: status = "positive_reply_ai_flagged"
+    elif "UNSUBSCRIBE" in ai_cat: status = "unsubscribed_ai_flagged"
+    elif "NEGATIVE" in ai_cat: status = "negative_reply_ai_flagged"
+    else: return {}
+    return {"status": status, "next_email_due_at": None, "last_response_type": category, "last_response_at": received_at}
+
+
+def apply_classification_to_lead(db: Session, lcs_id: Optional[int], organization_id: int, lead_id: int,
+                                 category: Optional[str], received_at: datetime):
+    if not lcs_id:
+        return
+    status_updates = lead_status_updates_for_classification(category, received_at)
+    if status_updates:
+        db_ops.update_lead_campaign_status(db, lcs_id, organization_id, status_updates)
+        logger.info(f"ReplyClassificationWorkerPool: Updated LCS ID {lcs_id} for Lead {lead_id} to status '{status_updates['status']}'")
+
+
+class ReplyClassificationWorkerPool:
+    """
+    Classifies queued replies with up to max_concurrency LLM calls in flight, each covering up
+    to batch_size replies. run() is a long-running coroutine on the app's event loop; each
+    batch is classified in a worker thread with its own DB session. notify() is safe to call
+    from IMAP worker threads and only shortens the wait - the DB is polled every
+    poll_interval_seconds regardless.
+    """
+    def __init__(self, reply_classifier):
+        self.reply_classifier = reply_classifier
+        self.max_concurrency = int(getattr(settings, "REPLY_CLASSIFICATION_MAX_CONCURRENCY", 8))
+        self.max_attempts = int(getattr(settings, "REPLY_CLASSIFICATION_MAX_ATTEMPTS", 5))
+        self.retry_delay_seconds = float(getattr(settings, "REPLY_CLASSIFICATION_RETRY_DELAY_SECONDS", 30))
+        self.lease_seconds = float(getattr(settings, "REPLY_CLASSIFICATION_LEASE_SECONDS", 600))
+        self.poll_interval_seconds = float(getattr(settings, "REPLY_CLASSIFICATION_POLL_INTERVAL_SECONDS", 15))
+        self.batch_size = max(1, getattr(reply_classifier, "batch_size", 1)) # Replies per classification slot
+        # After a notify(), wait this long so replies stored in the same poll cycle share a batch
+        self.batch_wait_seconds = float(getattr(settings, "REPLY_CLASSIFICATION_BATCH_WAIT_SECONDS", 2)) if self.batch_size > 1 else 0.0
+        self.running = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._in_flight: set = set()
+
+    def notify(self):
+        """Wakes the pool to claim newly queued replies."""
+        if self._loop is not None and self._wakeup is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _claim(self, limit: int):
+        db = next(get_db())
+        try:
+            return db_ops.claim_pending_reply_classifications(db, limit, self.lease_seconds)
+        finally:
+            db.close()
+
+    def _classify_and_apply(self, queued_replies: List[Dict[str, Any]]):
+        """Classifies claimed replies (one batch request where possible) and stores each result."""
+        db = next(get_db())
+        try:
+            try:
+                results = self.reply_classifier.classify_reply_texts(
+                    [(queued_reply["id"], queued_reply["cleaned_reply_text"] or "", queued_reply["lead_name"]) for queued_reply in queued_replies], db=db
+                )
+            except Exception as class_e:
+                logger.error(f"ReplyClassificationWorkerPool: Error classifying {len(queued_replies)} replies: {class_e}", exc_info=True)
+                results = {}
+            for queued_reply in queued_replies:
+                self._record_result(db, queued_reply, results.get(queued_reply["id"]))
+        finally:
+            db.close()
+
+    def _record_result(self, db: Session, queued_reply: Dict[str, Any], classification_result: Optional[Dict[str, Any]]):
+        reply_id = queued_reply["id"]
+        if classification_result is None:
+            new_status = db_ops.fail_reply_classification(db, reply_id, self.max_attempts, self.retry_delay_seconds)
+            log = logger.error if new_status == models.REPLY_CLASSIFICATION_FAILED else logger.warning
+            log(f"ReplyClassificationWorkerPool: Classification of reply {reply_id} failed (attempt {queued_reply['classification_attempts']}/{self.max_attempts}); now '{new_status}'.")
+            return
+
+        if not db_ops.complete_reply_classification(db, reply_id, classification_result):
+            return # Still leased; claimed again when the lease expires
+        logger.info(f"ReplyClassificationWorkerPool: Reply {reply_id} for Lead {queued_reply['lead_id']} classified as '{classification_result.get('category')}'.")
+        apply_classification_to_lead(db, queued_reply["lead_campaign_status_id"], queued_reply["organization_id"],
+                                     queued_reply["lead_id"], classification_result.get("category"), queued_reply["received_at"])
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self.running = True
+        logger.info(f"ReplyClassificationWorkerPool: Started with {self.max_concurrency} concurrent classifications.")
+        try:
+            while True:
+                try:
+                    free_slots = self.max_concurrency - len(self._in_flight)
+                    claim_limit = free_slots * self.batch_size
+                    claimed = (await asyncio.to_thread(self._claim, claim_limit) if free_slots > 0 else []) or []
+                    for offset in range(0, len(claimed), self.batch_size):
+                        batch = claimed[offset:offset + self.batch_size]
+                        task = asyncio.create_task(asyncio.to_thread(self._classify_and_apply, batch))
+                        self._in_flight.add(task)
+                        task.add_done_callback(self._in_flight.discard)
+                    if claimed and len(claimed) == claim_limit:
+                        # Pool is full: claim again as soon as a slot frees up
+                        await asyncio.wait(self._in_flight, return_when=asyncio.FIRST_COMPLETED)
+                        continue
+                    await self._wait_for_work()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e_loop:
+                    logger.error(f"ReplyClassificationWorkerPool: Error in worker loop: {e_loop}", exc_info=True)
+                    await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            # Classifications already in their threads finish; unclaimed work waits for the next start
+            logger.info("ReplyClassificationWorkerPool: Stopped.")
+            raise
+        finally:
+            self.running = False
+
+    async def _wait_for_work(self):
+        """Sleeps until notify(), a finished classification (slots or retries may be due) or the poll interval."""
+        waiters = set(self._in_flight)
+        wakeup_task = asyncio.create_task(self._wakeup.wait())
+        waiters.add(wakeup_task)
+        try:
+            await asyncio.wait(waiters, timeout=self.poll_interval_seconds, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            wakeup_task.cancel()
+        if self._wakeup.is_set() and self.batch_wait_seconds > 0:
+            await asyncio.sleep(self.batch_wait_seconds)
+        self._wakeup.clear()
@@ -1,12 +1,19 @@
 # app/agents/reply_classifier_agent.py
+import hashlib
 import json
-from typing import Dict, Any, Optional, List # Ensure List is imported for categories
+import re
+import threading
+from datetime import timedelta
+from typing import Dict, Any, Optional, List, Tuple # Ensure List is imported for categories
 
 from openai import OpenAI, APIError # Import specific errors if desired for more granular handling
 # from tenacity import retry, stop_after_attempt, wait_random_exponential # Optional for API calls
 
+from sqlalchemy.orm import Session # For type hinting
+
 from app.utils.logger import logger
 from app.utils.config import settings # To get API keys, model names
+from app.db import database as db_ops
 
 # Define the categories you want the LLM to use
 # Using an Enum can be good for consistency, but a list of strings is fine for the prompt
@@ -24,10 +31,69 @@ REPLY_CATEGORIES = [
     "CANNOT_CLASSIFY_GIBBERISH"     # If the reply is unintelligible or clearly not relevant.
 ]
 
+# Part of every classification cache key: bump it whenever _construct_prompt changes meaningfully
+PROMPT_VERSION = "1"
+
+# Categories whose result doesn't depend on numbers in the text (dates, times, phone numbers),
+# so they are also cached under a digit-insensitive key that matches templated auto-replies
+TEMPLATE_CACHEABLE_CATEGORIES = {"OUT_OF_OFFICE_AUTO_REPLY", "NEUTRAL_AUTO_REPLY_OTHER", "NEUTRAL_ACKNOWLEDGEMENT"}
+# A template-key hit comes from a different message (other dates, numbers, contacts), so only
+# its category is reused; summary and extracted_info are replaced with these generic ones
+TEMPLATE_HIT_SUMMARIES = {
+    "OUT_OF_OFFICE_AUTO_REPLY": "Automatic out-of-office reply.",
+    "NEUTRAL_AUTO_REPLY_OTHER": "Automatic reply.",
+    "NEUTRAL_ACKNOWLEDGEMENT": "Short acknowledgement with no further request.",
+}
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_DIGITS_PATTERN = re.compile(r"\d+")
+
+
+def classification_cache_keys(cleaned_reply_text: str, llm_model: str) -> List[str]:
+    """[exact key, digit-insensitive template key] for a reply; text is compared case- and whitespace-insensitively."""
+    normalized = _WHITESPACE_PATTERN.sub(" ", cleaned_reply_text).strip().lower()
+    templated = _DIGITS_PATTERN.sub("#", normalized)
+    return [
+        hashlib.sha256(f"{llm_model}|{PROMPT_VERSION}|{kind}|{text}".encode("utf-8")).hexdigest()
+        for kind, text in (("exact", normalized), ("template", templated))
+    ]
+
+
+class ClassificationCacheStats:
+    """Process-wide hit/miss counters for the reply classification cache."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "lookups": lookups,
+                    "hit_rate": round(self.hits / lookups, 4) if lookups else None}
+
+
+classification_cache_stats = ClassificationCacheStats()
+
 class ReplyClassifierAgent:
     def __init__(self, llm_model: Optional[str] = None):
         self.llm_model = llm_model or getattr(settings, "OPENAI_REPLY_CLASSIFICATION_MODEL", "gpt-3.5-turbo") # Default model
         self.openai_api_key = getattr(settings, "OPENAI_API_KEY", None)
+        self.cache_enabled = bool(getattr(settings, "ENABLE_REPLY_CLASSIFICATION_CACHE", True))
+        self.cache_ttl = timedelta(days=float(getattr(settings, "REPLY_CLASSIFICATION_CACHE_TTL_DAYS", 30)))
+        self.cache_max_entries = int(getattr(settings, "REPLY_CLASSIFICATION_CACHE_MAX_ENTRIES", 50000))
+        self._cache_writes_since_prune = 0
+        self._cache_writes_lock = threading.Lock() # Classification worker pool threads share this agent
+        # Replies per LLM request in classify_reply_texts, bounded by their combined length
+        self.batch_size = int(getattr(settings, "REPLY_CLASSIFICATION_BATCH_SIZE", 10))
+        self.batch_max_chars = int(getattr(settings, "REPLY_CLASSIFICATION_BATCH_MAX_CHARS", 16000))
 
         if not self.openai_api_key:
             logger.error("ReplyClassifierAgent: OPENAI_API_KEY not found in settings. Classification will fail.")
@@ -101,18 +167,21 @@ class ReplyClassifierAgent:
         """
         return prompt.strip()
 
-    # Consider adding @retry from tenacity for robustness if not handled by OpenAI's SDK v1+ by default for some errors
-    def classify_reply_text(self, cleaned_reply_text: str, lead_name: Optional[str] = None) -> Optional[Dict[str, Any]]:
-        if not self.client:
-            logger.error("ReplyClassifierAgent: OpenAI client not initialized. Cannot classify reply.")
-            return None
-        if not cleaned_reply_text or not cleaned_reply_text.strip():
-            logger.warning("ReplyClassifierAgent: Received empty or whitespace-only reply text. Cannot classify.")
-            return {"category": "CANNOT_CLASSIFY_GIBBERISH", "summary": "Reply was empty.", "extracted_info": {}}
-
-        prompt = self._construct_prompt(cleaned_reply_text, lead_name)
-        logger.debug(f"ReplyClassifierAgent: Sending prompt to LLM for classification (length: {len(prompt)}). Reply snippet: {cleaned_reply_text[:100]}...")
+    def _cache_classification(self, db: Session, cache_keys: List[str], classification_result: Dict[str, Any]):
+        keys_to_store = cache_keys if classification_result["category"] in TEMPLATE_CACHEABLE_CATEGORIES else cache_keys[:1]
+        if not db_ops.store_reply_classification(db, keys_to_store, self.llm_model, PROMPT_VERSION, classification_result):
+            return
+        with self._cache_writes_lock:
+            self._cache_writes_since_prune += 1
+            prune_due = self._cache_writes_since_prune >= 500 # Pruning scans the table, so it runs occasionally
+            if prune_due:
+                self._cache_writes_since_prune = 0
+        if prune_due:
+            pruned = db_ops.prune_reply_classification_cache(db, self.cache_max_entries, self.cache_ttl)
+            logger.info(f"ReplyClassifierAgent: Pruned {pruned} reply classification cache entries.")
 
+    def _request_classification_json(self, prompt: str) -> Optional[str]:
+        """Sends one JSON-mode chat completion; returns the raw response content or None on failure."""
         try:
             response = self.client.chat.completions.create(
                 model=self.llm_model,
@@ -124,45 +193,14 @@ class ReplyClassifierAgent:
                 # max_tokens=300, # Adjust based on expected JSON size
                 response_format={"type": "json_object"} # Request JSON output
             )
-            
+
             response_content = response.choices[0].message.content
             logger.debug(f"ReplyClassifierAgent: LLM raw response: {response_content}")
 
             if not response_content:
                 logger.error("ReplyClassifierAgent: LLM returned empty content.")
                 return None
-
-            try:
-                classification_result = json.loads(response_content)
-                # Validate the structure
-                if not isinstance(classification_result, dict) or \
-                   "category" not in classification_result or \
-                   "summary" not in classification_result:
-                    logger.error(f"ReplyClassifierAgent: LLM response missing mandatory fields 'category' or 'summary'. Response: {response_content}")
-                    return None # Or a default error classification
-                
-                if classification_result["category"] not in REPLY_CATEGORIES:
-                    logger.warning(f"ReplyClassifierAgent: LLM returned an unknown category '{classification_result['category']}'. Defaulting or flagging. Response: {response_content}")
-                    # Optionally, remap or handle unknown categories. For now, accept it if LLM hallucinates a new one despite instructions.
-                    # Or, be stricter:
-                    # return {"category": "CANNOT_CLASSIFY_GIBBERISH", "summary": f"LLM returned unkown category: {classification_result['category']}", "extracted_info": {}}
-
-
-                # Ensure extracted_info is a dict if present
-                if "extracted_info" in classification_result and not isinstance(classification_result["extracted_info"], dict):
-                    logger.warning(f"ReplyClassifierAgent: LLM 'extracted_info' is not a dict. Normalizing. Original: {classification_result['extracted_info']}")
-                    classification_result["extracted_info"] = {} # Normalize to empty dict
-
-                logger.info(f"ReplyClassifierAgent: Classified reply for lead '{lead_name if lead_name else 'Unknown'}' as '{classification_result.get('category')}'. Summary: '{classification_result.get('summary')}'")
-                return classification_result
-
-            except json.JSONDecodeError as e:
-                logger.error(f"ReplyClassifierAgent: Failed to parse LLM JSON response: {e}. Response: {response_content}", exc_info=True)
-                return None
-            except Exception as e_parse: # Catch other potential errors during parsing/validation
-                logger.error(f"ReplyClassifierAgent: Error processing LLM response content: {e_parse}. Response: {response_content}", exc_info=True)
-                return None
-
+            return response_content
 
         except APIError as e: # More specific OpenAI errors
             logger.error(f"ReplyClassifierAgent: OpenAI API error: {e.status_code} - {e.message}", exc_info=True)
@@ -170,3 +208,215 @@ class ReplyClassifierAgent:
         except Exception as e: # Catch-all for other issues like network problems
             logger.error(f"ReplyClassifierAgent: Unexpected error during LLM call: {e}", exc_info=True)
             return None
+
+    def _validated_classification(self, classification_result: Any, response_content: str) -> Optional[Dict[str, Any]]:
+        """One parsed classification checked for the mandatory fields, or None."""
+        # Validate the structure
+        if not isinstance(classification_result, dict) or \
+           "category" not in classification_result or \
+           "summary" not in classification_result:
+            logger.error(f"ReplyClassifierAgent: LLM response missing mandatory fields 'category' or 'summary'. Response: {response_content}")
+            return None # Or a default error classification
+
+        if classification_result["category"] not in REPLY_CATEGORIES:
+            logger.warning(f"ReplyClassifierAgent: LLM returned an unknown category '{classification_result['category']}'. Defaulting or flagging. Response: {response_content}")
+            # Optionally, remap or handle unknown categories. For now, accept it if LLM hallucinates a new one despite instructions.
+            # Or, be stricter:
+            # return {"category": "CANNOT_CLASSIFY_GIBBERISH", "summary": f"LLM returned unkown category: {classification_result['category']}", "extracted_info": {}}
+
+
+        # Ensure extracted_info is a dict if present
+        if "extracted_info" in classification_result and not isinstance(classification_result["extracted_info"], dict):
+            logger.warning(f"ReplyClassifierAgent: LLM 'extracted_info' is not a dict. Normalizing. Original: {classification_result['extracted_info']}")
+            classification_result["extracted_info"] = {} # Normalize to empty dict
+        return classification_result
+
+    # Consider adding @retry from tenacity for robustness if not handled by OpenAI's SDK v1+ by default for some errors
+    def classify_reply_text(self, cleaned_reply_text: str, lead_name: Optional[str] = None,
+                            db: Optional[Session] = None) -> Optional[Dict[str, Any]]:
+        """
+        Classifies a reply with the LLM. When a DB session is given, identical replies (and, for
+        auto-reply categories, replies differing only in numbers) are answered from the
+        classification cache instead; cached results carry "classified_by": "cache".
+        """
+        if not cleaned_reply_text or not cleaned_reply_text.strip():
+            logger.warning("ReplyClassifierAgent: Received empty or whitespace-only reply text. Cannot classify.")
+            return {"category": "CANNOT_CLASSIFY_GIBBERISH", "summary": "Reply was empty.", "extracted_info": {}}
+
+        use_cache = self.cache_enabled and db is not None
+        cache_keys = classification_cache_keys(cleaned_reply_text, self.llm_model) if use_cache else []
+        if use_cache:
+            cached_result = self._cached_classification(db, cache_keys, lead_name)
+            if cached_result is not None:
+                return cached_result
+
+        if not self.client:
+            logger.error("ReplyClassifierAgent: OpenAI client not initialized. Cannot classify reply.")
+            return None
+
+        prompt = self._construct_prompt(cleaned_reply_text, lead_name)
+        logger.debug(f"ReplyClassifierAgent: Sending prompt to LLM for classification (length: {len(prompt)}). Reply snippet: {cleaned_reply_text[:100]}...")
+
+        response_content = self._request_classification_json(prompt)
+        if not response_content:
+            return None
+        try:
+            classification_result = self._validated_classification(json.loads(response_content), response_content)
+        except json.JSONDecodeError as e:
+            logger.error(f"ReplyClassifierAgent: Failed to parse LLM JSON response: {e}. Response: {response_content}", exc_info=True)
+            return None
+        if classification_result is None:
+            return None
+
+        logger.info(f"ReplyClassifierAgent: Classified reply for lead '{lead_name if lead_name else 'Unknown'}' as '{classification_result.get('category')}'. Summary: '{classification_result.get('summary')}'")
+        if use_cache and classification_result["category"] in REPLY_CATEGORIES:
+            self._cache_classification(db, cache_keys, classification_result)
+        return classification_result
+
+    def _cached_classification(self, db: Session, cache_keys: List[str], lead_name: Optional[str]) -> Optional[Dict[str, Any]]:
+        cached_result = db_ops.get_cached_reply_classification(db, cache_keys, self.cache_ttl)
+        classification_cache_stats.record(hit=cached_result is not None)
+        if cached_result is None:
+            return None
+        logger.info(f"ReplyClassifierAgent: Classification cache hit for lead '{lead_name if lead_name else 'Unknown'}': '{cached_result['category']}'.")
+        if cached_result.pop("cache_key") != cache_keys[0]:
+            # Digit-insensitive template match: another message's summary and details don't apply
+            if cached_result["category"] not in TEMPLATE_HIT_SUMMARIES:
+                return None
+            cached_result["summary"] = TEMPLATE_HIT_SUMMARIES[cached_result["category"]]
+            cached_result["extracted_info"] = {}
+        return {**cached_result, "classified_by": "cache"}
+
+    def _construct_batch_prompt(self, replies: List[Tuple[str, str, Optional[str]]]) -> str:
+        """One prompt for several replies, given as (batch id, cleaned text, lead name); the instructions are sent once."""
+        categories_str = ", ".join([f"'{cat}'" for cat in REPLY_CATEGORIES])
+        replies_str = "\n\n".join(
+            f'Reply id "{batch_id}" from {lead_name or "a prospect"}:\n---\n{text}\n---'
+            for batch_id, text, lead_name in replies
+        )
+
+        prompt = f"""
+        You are an expert assistant tasked with classifying email replies received during a B2B sales outreach campaign.
+        The goal is to accurately categorize the intent of each reply and extract key information.
+        Below are {len(replies)} independent replies from different prospects, each with an id. Classify each one on its own.
+
+        {replies_str}
+
+        Instructions for EACH reply:
+        1. Classify the reply into ONE of the following categories: {categories_str}.
+           Choose the category that best represents the primary intent of the reply.
+        2. Provide a concise 1-2 sentence summary of the reply's main point.
+        3. If the reply contains any specific scheduling suggestions, questions about the product/service, or objections, try to extract them
+           (e.g. {{"meeting_suggestion": "next week"}}, {{"questions_asked": ["What is the pricing?"]}}, {{"referred_to": "john.doe@example.com"}}).
+
+        Output Format:
+        Respond ONLY with a single valid JSON object with one key, "results": an array holding one object per reply, each with:
+        - "id": (string) The reply's id exactly as given above. This field is mandatory.
+        - "category": (string) One of the predefined categories listed above. This field is mandatory.
+        - "summary": (string) A brief 1-2 sentence summary of the reply. This field is mandatory.
+        - "extracted_info": (object) Relevant extracted details, or an empty object.
+
+        Example for two replies "r1" and "r2":
+        {{
+            "results": [
+                {{"id": "r1", "category": "POSITIVE_MEETING_INTEREST", "summary": "The prospect suggested meeting next week.", "extracted_info": {{"meeting_suggestion": "next week"}}}},
+                {{"id": "r2", "category": "NEGATIVE_NOT_INTERESTED", "summary": "The prospect is not interested at this time.", "extracted_info": {{}}}}
+            ]
+        }}
+
+        Ensure the entire response is only the JSON object.
+        """
+        return prompt.strip()
+
+    def _batch_chunks(self, replies: List[Tuple[Any, str, Optional[str]]]) -> List[List[Tuple[Any, str, Optional[str]]]]:
+        """Splits replies into batches of at most batch_size replies and batch_max_chars characters of reply text."""
+        chunks: List[List[Tuple[Any, str, Optional[str]]]] = []
+        current: List[Tuple[Any, str, Optional[str]]] = []
+        current_chars = 0
+        for reply in replies:
+            reply_chars = len(reply[1])
+            if current and (len(current) >= self.batch_size or current_chars + reply_chars > self.batch_max_chars):
+                chunks.append(current)
+                current, current_chars = [], 0
+            current.append(reply)
+            current_chars += reply_chars
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _classify_batch(self, replies: List[Tuple[Any, str, Optional[str]]]) -> Dict[Any, Dict[str, Any]]:
+        """
+        Classifies several replies with one LLM request. Returns the valid results by reply key;
+        replies missing from the response or with an invalid result are left out.
+        """
+        batch_ids = {f"r{position}": key for position, (key, _, _) in enumerate(replies, start=1)}
+        prompt = self._construct_batch_prompt([(batch_id, text, lead_name) for batch_id, (_, text, lead_name) in zip(batch_ids, replies)])
+        logger.debug(f"ReplyClassifierAgent: Sending batch prompt for {len(replies)} replies to LLM (length: {len(prompt)}).")
+
+        response_content = self._request_classification_json(prompt)
+        if not response_content:
+            return {}
+        try:
+            batch_results = json.loads(response_content).get("results")
+        except (json.JSONDecodeError, AttributeError) as e:
+            logger.error(f"ReplyClassifierAgent: Failed to parse LLM batch JSON response: {e}. Response: {response_content}")
+            return {}
+        if not isinstance(batch_results, list):
+            logger.error(f"ReplyClassifierAgent: LLM batch response has no 'results' array. Response: {response_content}")
+            return {}
+
+        results_by_key: Dict[Any, Dict[str, Any]] = {}
+        for item in batch_results:
+            key = batch_ids.get(str(item.get("id"))) if isinstance(item, dict) else None
+            if key is None or key in results_by_key:
+                logger.warning(f"ReplyClassifierAgent: Ignoring batch result with an unknown or repeated id: {item}")
+                continue
+            classification_result = self._validated_classification(
+                {field: value for field, value in item.items() if field != "id"}, response_content
+            )
+            if classification_result is not None:
+                results_by_key[key] = classification_result
+        return results_by_key
+
+    def classify_reply_texts(self, replies: List[Tuple[Any, str, Optional[str]]],
+                             db: Optional[Session] = None) -> Dict[Any, Optional[Dict[str, Any]]]:
+        """
+        Classifies many replies, given as (key, cleaned text, lead name), and returns results by
+        key (None where classification failed). Cache hits are answered without the LLM; the rest
+        go out batch_size replies per request, so the instructions are sent once per batch.
+        Replies a batch response doesn't classify validly fall back to classify_reply_text.
+        """
+        results: Dict[Any, Optional[Dict[str, Any]]] = {}
+        use_cache = self.cache_enabled and db is not None
+        cache_keys_by_key: Dict[Any, List[str]] = {}
+        to_classify: List[Tuple[Any, str, Optional[str]]] = []
+        for key, cleaned_reply_text, lead_name in replies:
+            if not cleaned_reply_text or not cleaned_reply_text.strip() or self.batch_size <= 1:
+                results[key] = self.classify_reply_text(cleaned_reply_text, lead_name, db=db)
+                continue
+            if use_cache:
+                cache_keys_by_key[key] = classification_cache_keys(cleaned_reply_text, self.llm_model)
+                cached_result = self._cached_classification(db, cache_keys_by_key[key], lead_name)
+                if cached_result is not None:
+                    results[key] = cached_result
+                    continue
+            to_classify.append((key, cleaned_reply_text, lead_name))
+
+        if to_classify and not self.client:
+            logger.error("ReplyClassifierAgent: OpenAI client not initialized. Cannot classify replies.")
+            return {**results, **{key: None for key, _, _ in to_classify}}
+
+        for chunk in self._batch_chunks(to_classify):
+            batch_results = self._classify_batch(chunk) if len(chunk) > 1 else {}
+            if len(chunk) > 1:
+                logger.info(f"ReplyClassifierAgent: Classified {len(batch_results)} of {len(chunk)} replies in one batch request.")
+            for key, cleaned_reply_text, lead_name in chunk:
+                classification_result = batch_results.get(key)
+                if classification_result is None:
+                    # Left out of (or malformed in) the batch response: classify it on its own.
+                    # Its cache lookup already missed, so it is cached below rather than looked up again.
+                    classification_result = self.classify_reply_text(cleaned_reply_text, lead_name)
+                if use_cache and classification_result and classification_result["category"] in REPLY_CATEGORIES:
+                    self._cache_classification(db, cache_keys_by_key[key], classification_result)
+                results[key] = classification_result
+        return results
@@ -0,0 +1,142 @@
+# app/agents/reply_rule_classifier.py
+
+import re
+from typing import Any, Dict, List, Mapping, Optional
+
+# Deterministic fast path ahead of ReplyClassifierAgent: replies whose intent is unambiguous
+# (auto-replies, out-of-office notices, short unsubscribe requests, one-line thanks) are
+# classified here without an LLM call. Anything else returns None and goes to the LLM.
+# Categories are the ones in reply_classifier_agent.REPLY_CATEGORIES.
+
+# Headers fetched with each reply so auto-replies can be recognized (see ImapReplyAgent)
+AUTO_REPLY_HEADER_NAMES = ("Auto-Submitted", "X-Autoreply", "X-Autorespond", "Precedence")
+
+_AUTO_REPLY_PRECEDENCE = {"auto_reply", "bulk", "junk"}
+_AUTO_REPLY_SUBJECT_PATTERN = re.compile(
+    r"^\s*(?:automatic reply|auto(?:matic)?[ -]?response|auto[ -]?reply|autoreply|out of (?:the )?office|ooo\b"
+    r"|abwesenheitsnotiz|automatische antwort|réponse automatique|respuesta automática|risposta automatica"
+    r"|automatisch antwoord|auto:)",
+)
+_OUT_OF_OFFICE_PATTERN = re.compile(
+    r"\b(?:out of (?:the )?office|on (?:annual |parental |maternity |paternity |sick )?leave|on (?:vacation|holiday)"
+    r"|away from (?:the |my )?(?:office|desk)|limited access to (?:my )?e-?mail|(?:i will|i'll) be back"
+    r"|(?:i will|i'll) (?:return|be returning)|returning (?:on|to the office)|back in the office"
+    r"|nicht im büro|abwesend|absent du bureau|en congés?|fuera de la oficina|de vacaciones|fuori ufficio)\b"
+)
+_LEFT_COMPANY_PATTERN = re.compile(
+    r"\b(?:(?:is|are) no longer (?:with|at|employed (?:at|by|with)) (?:the|our|this) (?:company|organi[sz]ation|firm|business)"
+    r"|is no longer employed|(?:has|have) left (?:the|our) (?:company|organi[sz]ation|firm|business)"
+    r"|(?:he|she|they) (?:no longer works?|(?:does|do)(?: not|n't) work) (?:at|for|here)"
+    r"|this (?:e-?mail )?(?:address|mailbox) is no longer (?:monitored|active|in use))\b"
+)
+# A left-company reply that names someone else to talk to is a referral, not a dead end: it goes
+# to the LLM so the new contact is extracted instead of the lead being closed as wrong person.
+_REFERRAL_PATTERN = re.compile(
+    r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+|\b(?:reach out to|contact|get in touch with|speak (?:to|with)|talk to|write to"
+    r"|(?:please )?e-?mail (?:him|her|them|my|our)|forward(?:ed|ing)?|redirect(?:ed)?|instead|successor|replacement"
+    r"|(?:has|have) taken over|(?:is|are) taking over|in (?:my|his|her|their) place|point of contact|cc'?d|copied)\b"
+)
+_UNSUBSCRIBE_PATTERN = re.compile(
+    r"\b(?:unsubscribe|opt(?:-| )?out|remove me|take me off|stop (?:e-?mailing|contacting|sending)|do not (?:e-?mail|contact)"
+    r"|don't (?:e-?mail|contact)|not contact me again|no more e-?mails?)\b"
+)
+# Only a reply that is essentially just the opt-out is short-circuited: once the opt-out
+# phrases and filler words are removed, at most a signature-sized remainder may be left.
+# Anything with a qualifier ("call me instead", "until Q3", a phone number or date) or a
+# negated opt-out ("no need to remove me") goes to the LLM.
+_UNSUBSCRIBE_FILLER_WORDS = {
+    "please", "pls", "kindly", "thanks", "thank", "you", "thx", "me", "us", "from", "your", "the", "this", "my",
+    "our", "list", "lists", "mailing", "email", "emails", "e-mail", "e-mails", "mail", "messages", "any", "more",
+    "further", "all", "future", "and", "again", "now", "hi", "hello", "regards", "best", "sincerely", "cheers",
+}
+_MAX_UNSUBSCRIBE_OTHER_WORDS = 3 # e.g. "Dana Lee"
+_UNSUBSCRIBE_QUALIFIER_PATTERN = re.compile(
+    r"\d|\b(?:until|unless|instead|rather|call|phone|text|reach|later|after|before|next|but|except|only|if|when"
+    r"|colleague|someone|contact (?:him|her|them)|q[1-4]|week|month|quarter|year)\b"
+)
+_UNSUBSCRIBE_NEGATION_PATTERN = re.compile(
+    r"\b(?:not|don't|do not|no need to|never|didn't|did not)\s+(?:\w+\s+){0,2}?(?:unsubscribe|opt|remove|take me off)"
+)
+_WORD_PATTERN = re.compile(r"[\w'-]+")
+_ACKNOWLEDGEMENT_PATTERN = re.compile(
+    r"(?:(?:many |great, )?thanks?(?: (?:you|a lot|so much|very much))*|thank you(?: (?:so|very) much)?|thx|ty"
+    r"|got it|ok(?:ay)?|noted|received|cheers|will do|much appreciated|appreciate it)"
+    r"(?:[ ,]+(?:thanks?|thank you|cheers))?[\s!.,:)]*"
+)
+# Lines allowed under a one-line acknowledgement: a sign-off, optionally followed by a name
+# ("Best,\nDana Lee"), a dashed name ("- Dana") or a first name after a comma ("Thanks,\nDana").
+# Any other line ("Ok\nSend pricing") may carry intent, so the reply goes to the LLM.
+_SIGNOFF_PATTERN = re.compile(
+    r"(?:best(?: regards| wishes)?|(?:kind |warm |many )?regards|cheers|thanks|thank you|many thanks|sincerely|br|rgds"
+    r"|all the best)[\s,!.]*"
+)
+_NAME_LINE_PATTERN = re.compile(r"-?[ \t]*[^\W\d_][\w.'-]*(?: [^\W\d_][\w.'-]*)?") # One or two words
+_FIRST_NAME_LINE_PATTERN = re.compile(r"[^\W\d_][\w.-]*")
+
+
+def _result(category: str, summary: str, rule: str) -> Dict[str, Any]:
+    return {"category": category, "summary": summary, "extracted_info": {}, "classified_by": f"rules:{rule}"}
+
+
+def _is_auto_reply(headers: Mapping[str, str]) -> bool:
+    values = {name.lower(): (value or "").strip().lower() for name, value in headers.items()}
+    auto_submitted = values.get("auto-submitted")
+    if auto_submitted and auto_submitted != "no": # RFC 3834: "auto-replied", "auto-generated"
+        return True
+    if values.get("x-autoreply") or values.get("x-autorespond"):
+        return True
+    return values.get("precedence") in _AUTO_REPLY_PRECEDENCE
+
+
+def _is_opt_out_only(text: str) -> bool:
+    if "?" in text or _UNSUBSCRIBE_QUALIFIER_PATTERN.search(text) or _UNSUBSCRIBE_NEGATION_PATTERN.search(text):
+        return False
+    remainder = _UNSUBSCRIBE_PATTERN.sub(" ", text)
+    other_words = [word for word in _WORD_PATTERN.findall(remainder) if word not in _UNSUBSCRIBE_FILLER_WORDS]
+    return len(other_words) <= _MAX_UNSUBSCRIBE_OTHER_WORDS
+
+
+def _is_signoff(lines: List[str], after_comma: bool) -> bool:
+    if not lines:
+        return True
+    if _SIGNOFF_PATTERN.fullmatch(lines[0]):
+        return len(lines) == 1 or (len(lines) == 2 and _NAME_LINE_PATTERN.fullmatch(lines[1]) is not None)
+    if len(lines) != 1:
+        return False
+    if lines[0].startswith("-"): # "- Dana Lee"
+        return _NAME_LINE_PATTERN.fullmatch(lines[0]) is not None
+    return after_comma and _FIRST_NAME_LINE_PATTERN.fullmatch(lines[0]) is not None
+
+
+def _is_acknowledgement(text: str) -> bool:
+    lines = [line.strip() for line in text.split("\n") if line.strip()]
+    if not lines or _ACKNOWLEDGEMENT_PATTERN.fullmatch(lines[0]) is None:
+        return False
+    return _is_signoff(lines[1:], after_comma=lines[0].endswith(","))
+
+
+def classify_reply_by_rules(cleaned_reply_text: str, headers: Optional[Mapping[str, str]] = None,
+                            subject: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Classifies a reply without an LLM when its intent is unambiguous. Returns the same shape as
+    ReplyClassifierAgent.classify_reply_text (plus "classified_by"), or None for the LLM.
+    headers: the AUTO_REPLY_HEADER_NAMES values of the reply, if known.
+    """
+    text = (cleaned_reply_text or "").lower()
+    subject_text = (subject or "").lower()
+    auto_reply = _is_auto_reply(headers or {}) or _AUTO_REPLY_SUBJECT_PATTERN.match(subject_text) is not None
+
+    if _LEFT_COMPANY_PATTERN.search(text):
+        if _REFERRAL_PATTERN.search(text):
+            return None
+        # Usually an auto-reply too, but the useful signal is that this contact is gone
+        return _result("NEGATIVE_WRONG_PERSON", "The contact is no longer with the company.", "left_company")
+    if auto_reply:
+        if _OUT_OF_OFFICE_PATTERN.search(text) or _OUT_OF_OFFICE_PATTERN.search(subject_text):
+            return _result("OUT_OF_OFFICE_AUTO_REPLY", "Automatic out-of-office reply.", "out_of_office")
+        return _result("NEUTRAL_AUTO_REPLY_OTHER", "Automatic reply.", "auto_reply")
+    if _UNSUBSCRIBE_PATTERN.search(text) and _is_opt_out_only(text):
+        return _result("NEGATIVE_UNSUBSCRIBE", "The prospect asked to be removed from the mailing list.", "unsubscribe")
+    if _is_acknowledgement(text):
+        return _result("NEUTRAL_ACKNOWLEDGEMENT", "Short acknowledgement with no further request.", "acknowledgement")
+    return None
@@ -0,0 +1,90 @@
+# app/db/batch_writer.py
+
+import time
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from app.db import database
+from app.utils.logger import logger
+
+
+class LeadCampaignStatusBatchWriter:
+    """
+    Write-behind buffer for lead_campaign_status transitions made during a scheduler cycle,
+    together with the outgoing_email_log rows for the emails that caused them.
+    Updates are merged per status row; a flush commits the pending log rows with one
+    multi-row INSERT, then writes the transitions with one bulk UPDATE, once max_rows
+    rows are pending or the oldest pending update is max_delay_ms old.
+    Callers must flush() before releasing their claims on the buffered rows.
+    """
+    def __init__(self, db: Session, max_rows: int = 200, max_delay_ms: int = 1000):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_delay_ms = max_delay_ms
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._pending_sent_logs: List[Dict[str, Any]] = []
+        self._oldest_pending_at: Optional[float] = None
+        self.flush_count = 0
+
+    def add(self, status_id: int, organization_id: int, updates: Dict[str, Any]):
+        entry = self._pending.get(status_id)
+        if entry is None:
+            self._pending[status_id] = {"status_id": status_id, "organization_id": organization_id, "updates": dict(updates)}
+        else:
+            entry["updates"].update(updates)
+        if self._oldest_pending_at is None:
+            self._oldest_pending_at = time.monotonic()
+
+    def add_sent_email_log(self, log_row: Dict[str, Any]):
+        """Buffers an outgoing_email_log row (see database.log_sent_emails for the expected keys)."""
+        self._pending_sent_logs.append(log_row)
+        if self._oldest_pending_at is None:
+            self._oldest_pending_at = time.monotonic()
+
+    @property
+    def pending_count(self) -> int:
+        return max(len(self._pending), len(self._pending_sent_logs))
+
+    def should_flush(self) -> bool:
+        if self._oldest_pending_at is None:
+            return False
+        if self.pending_count >= self.max_rows:
+            return True
+        return (time.monotonic() - self._oldest_pending_at) * 1000 >= self.max_delay_ms
+
+    def _flush_sent_logs(self, log_rows: List[Dict[str, Any]]):
+        # Committed on its own: a failed status UPDATE rolls back its transaction, and the
+        # logs are what IMAP reply matching relies on for emails that were already sent
+        if database.log_sent_emails(self.db, log_rows) is not None:
+            return
+        logger.warning(f"LeadCampaignStatusBatchWriter: Bulk insert of {len(log_rows)} sent email logs failed; retrying row by row.")
+        for row in log_rows:
+            if not database.log_sent_email(self.db, **row):
+                logger.error(f"LeadCampaignStatusBatchWriter: CRITICAL - Failed to log sent email with Message-ID {row.get('message_id_header')} for lead {row.get('lead_id')}.")
+
+    def flush(self) -> int:
+        if self._oldest_pending_at is None:
+            return 0
+        batch: List[Dict[str, Any]] = list(self._pending.values())
+        log_rows = self._pending_sent_logs
+        self._pending.clear()
+        self._pending_sent_logs = []
+        self._oldest_pending_at = None
+
+        if log_rows:
+            self._flush_sent_logs(log_rows)
+        if not batch:
+            self.flush_count += 1
+            return 0
+
+        written = database.bulk_update_lead_campaign_statuses(self.db, batch)
+        if written is None:
+            # Don't lose transitions for emails that were already sent: fall back to row-by-row updates
+            logger.warning(f"LeadCampaignStatusBatchWriter: Bulk flush of {len(batch)} rows failed; retrying row by row.")
+            written = sum(
+                1 for item in batch
+                if database.update_lead_campaign_status(self.db, item["status_id"], item["organization_id"], item["updates"])
+            )
+        self.flush_count += 1
+        return written
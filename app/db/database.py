@@ -3,12 +3,13 @@
 # --- Standard Library Imports ---
 import os
 import json
-from datetime import datetime, timezone
+import zlib
+from datetime import datetime, timezone, timedelta
 from typing import Optional, List, Dict, Any
 
 # --- SQLAlchemy Core Imports ---
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy import create_engine, func, and_, or_, text, inspect # Added inspect
+from sqlalchemy.orm import sessionmaker, Session, aliased
+from sqlalchemy import create_engine, func, and_, or_, text, inspect, update, bindparam, case, literal, select, union_all # Added inspect
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 from app.schemas import SubscriptionCreate
@@ -71,6 +72,10 @@ except Exception as e_settings:
     if not SQLALCHEMY_DATABASE_URL:
         raise ValueError("FATAL ERROR: DATABASE_URL not in OS env after settings error.")
 
+# 6. In-process due-time wheel, kept current as lead campaign statuses change
+from app.utils.due_time_wheel import due_time_wheel
+from app.utils.raw_content import compress_raw_content, decompress_raw_content
+
 # --- Engine and Session Setup ---
 if not SQLALCHEMY_DATABASE_URL:
     raise ValueError("FATAL ERROR: SQLALCHEMY_DATABASE_URL not set before engine creation.")
@@ -586,6 +591,7 @@ def enroll_lead_in_campaign(db: Session, lead_id: int, campaign_id: int, organiz
             next_email_due_at=datetime.now(timezone.utc)
         )
         db.add(new_status); db.commit(); db.refresh(new_status)
+        due_time_wheel.schedule(new_status.id, new_status.next_email_due_at)
         logger.info(f"Enrolled Lead {lead_id} in Campaign {campaign_id} (Status ID: {new_status.id})")
         return new_status
     except IntegrityError:
@@ -594,14 +600,24 @@ def enroll_lead_in_campaign(db: Session, lead_id: int, campaign_id: int, organiz
     except SQLAlchemyError as e:
         db.rollback(); logger.error(f"DB Error enroll lead {lead_id} in camp {campaign_id}: {e}", exc_info=True); return None
 
+def _notify_due_time_wheel(status_id: int, updates: Dict[str, Any]):
+    """Mirrors a lead campaign status change into the in-process due-time wheel."""
+    if "status" in updates and updates["status"] != LeadStatusEnum.active.value:
+        due_time_wheel.discard(status_id)
+    elif "next_email_due_at" in updates:
+        due_time_wheel.schedule(status_id, updates["next_email_due_at"])
+
+_LCS_UPDATABLE_FIELDS = {"current_step_number", "status", "last_email_sent_at", "next_email_due_at",
+                         "last_response_type", "last_response_at", "error_message", "user_notes",
+                         "claimed_by", "claim_expires_at"}
+
 def update_lead_campaign_status(db: Session, status_id: int, organization_id: int, updates: Dict[str, Any]) -> Optional[models.LeadCampaignStatus]:
     if not models.LeadCampaignStatus: logger.error("DB: LeadCampaignStatus model not loaded."); return None
     try:
         status_obj = db.query(models.LeadCampaignStatus).filter(models.LeadCampaignStatus.id == status_id, models.LeadCampaignStatus.organization_id == organization_id).first()
         if not status_obj: logger.warning(f"LCS ID {status_id} not found for update."); return None
         
-        allowed = {"current_step_number", "status", "last_email_sent_at", "next_email_due_at", 
-                   "last_response_type", "last_response_at", "error_message", "user_notes"}
+        allowed = _LCS_UPDATABLE_FIELDS
         # Ensure 'status' update uses enum's value if model stores string
         if "status" in updates and isinstance(updates["status"], LeadStatusEnum):
             updates["status"] = updates["status"].value
@@ -610,26 +626,90 @@ def update_lead_campaign_status(db: Session, status_id: int, organization_id: in
             logger.info(f"No valid fields to update for LCS {status_id}."); return status_obj
             
         db.commit(); db.refresh(status_obj); logger.info(f"Updated LCS ID {status_id}")
+        _notify_due_time_wheel(status_id, updates)
         return status_obj
     except SQLAlchemyError as e:
         db.rollback(); logger.error(f"DB Error update LCS {status_id}: {e}", exc_info=True); return None
 
+def bulk_update_lead_campaign_statuses(db: Session, updates: List[Dict[str, Any]], commit: bool = True) -> Optional[int]:
+    """
+    Applies many lead campaign status updates with one executemany UPDATE per distinct
+    set of updated columns, in a single transaction.
+    Each item is {"status_id": int, "organization_id": int, "updates": {field: value}}.
+    Returns the number of rows written, or None if the batch failed and was rolled back.
+    """
+    if not models.LeadCampaignStatus: logger.error("DB: LeadCampaignStatus model not loaded."); return 0
+    lcs_table = models.LeadCampaignStatus.__table__
+    now_utc = datetime.now(timezone.utc)
+    params_by_columns: Dict[tuple, List[Dict[str, Any]]] = {}
+    for item in updates:
+        values = {}
+        for key, value in item["updates"].items():
+            if key not in _LCS_UPDATABLE_FIELDS: continue
+            values[key] = value.value if LeadStatusEnum and isinstance(value, LeadStatusEnum) else value
+        if not values: continue
+        values["updated_at"] = now_utc # Core UPDATE bypasses the ORM's onupdate
+        params = {f"b_{key}": value for key, value in values.items()}
+        params["b_id"] = item["status_id"]
+        params["b_organization_id"] = item["organization_id"]
+        params_by_columns.setdefault(tuple(sorted(values)), []).append(params)
+
+    written = 0
+    try:
+        for columns, params_list in params_by_columns.items():
+            stmt = update(lcs_table).\
+                where(lcs_table.c.id == bindparam("b_id"), lcs_table.c.organization_id == bindparam("b_organization_id")).\
+                values({column: bindparam(f"b_{column}") for column in columns})
+            db.execute(stmt, params_list)
+            written += len(params_list)
+        if commit: db.commit()
+        for item in updates:
+            _notify_due_time_wheel(item["status_id"], {
+                key: value.value if LeadStatusEnum and isinstance(value, LeadStatusEnum) else value
+                for key, value in item["updates"].items()
+            })
+        logger.info(f"DB: Bulk updated {written} lead campaign statuses in {len(params_by_columns)} statement(s).")
+        return written
+    except SQLAlchemyError as e:
+        db.rollback(); logger.error(f"DB Error bulk updating {len(updates)} lead campaign statuses: {e}", exc_info=True); return None
+
+def _lead_campaign_status_due_filter(now: datetime):
+    return and_(
+        models.LeadCampaignStatus.status == LeadStatusEnum.active.value,
+        or_(
+            models.LeadCampaignStatus.next_email_due_at <= now,
+            and_(models.LeadCampaignStatus.next_email_due_at.is_(None), models.LeadCampaignStatus.current_step_number == 0)
+        )
+    )
+
+def _due_lead_campaign_statuses(now: datetime, *extra_filters):
+    """
+    The rows matched by _lead_campaign_status_due_filter, as a UNION ALL of its two OR
+    branches (sent before and due by now / never sent). Each branch is a range scan on the
+    partial index ix_lcs_active_due_org, where the OR form falls back to a bitmap-OR or
+    sequential scan on large tables. The status literal must reach Postgres inlined (as
+    psycopg2 does) for the planner to match the index's WHERE status = 'active'.
+    Columns: id, lead_id, campaign_id, organization_id, next_email_due_at, created_at.
+    """
+    lcs = models.LeadCampaignStatus
+    columns = (lcs.id, lcs.lead_id, lcs.campaign_id, lcs.organization_id, lcs.next_email_due_at, lcs.created_at)
+    active = lcs.status == LeadStatusEnum.active.value
+    return union_all(
+        select(*columns).where(active, lcs.next_email_due_at <= now, *extra_filters),
+        select(*columns).where(active, lcs.next_email_due_at.is_(None), lcs.current_step_number == 0, *extra_filters),
+    ).subquery("due_lead_campaign_statuses")
+
 def get_active_leads_due_for_step(db: Session, organization_id: Optional[int] = None, query_limit: int = 100) -> List[models.LeadCampaignStatus]:
     if not models.LeadCampaignStatus or not models.Lead or not models.EmailCampaign or not LeadStatusEnum:
         logger.error("DB: Models/Enums missing for get_active_leads_due_for_step.")
         return []
     try:
+        org_filter = () if organization_id is None else (models.LeadCampaignStatus.organization_id == organization_id,)
+        due = _due_lead_campaign_statuses(datetime.now(timezone.utc), *org_filter)
         query = db.query(models.LeadCampaignStatus).\
+            join(due, due.c.id == models.LeadCampaignStatus.id).\
             join(models.Lead, models.LeadCampaignStatus.lead_id == models.Lead.id).\
-            join(models.EmailCampaign, models.LeadCampaignStatus.campaign_id == models.EmailCampaign.id).\
-            filter(models.LeadCampaignStatus.status == LeadStatusEnum.active.value).\
-            filter(or_(
-                models.LeadCampaignStatus.next_email_due_at <= datetime.now(timezone.utc),
-                and_(models.LeadCampaignStatus.next_email_due_at.is_(None), models.LeadCampaignStatus.current_step_number == 0)
-            ))
-
-        if organization_id is not None:
-            query = query.filter(models.LeadCampaignStatus.organization_id == organization_id)
+            join(models.EmailCampaign, models.LeadCampaignStatus.campaign_id == models.EmailCampaign.id)
 
         leads_due = query.order_by(
                 models.LeadCampaignStatus.organization_id,
@@ -645,6 +725,225 @@ def get_active_leads_due_for_step(db: Session, organization_id: Optional[int] =
         logger.error(f"DB SQLAlchemyError in get_active_leads_due_for_step: {e}", exc_info=True)
         return []
 
+def get_upcoming_due_times(db: Session, horizon_end: datetime) -> Optional[List[tuple]]:
+    """(status_id, next_email_due_at) for every active lead campaign status due before horizon_end, in one query."""
+    if not models.LeadCampaignStatus or not LeadStatusEnum:
+        logger.error("DB: Models/Enums missing for get_upcoming_due_times.")
+        return None
+    try:
+        due = _due_lead_campaign_statuses(horizon_end)
+        rows = db.query(due.c.id, due.c.next_email_due_at).all()
+        return [(row.id, row.next_email_due_at) for row in rows]
+    except SQLAlchemyError as e:
+        logger.error(f"DB Error loading upcoming due times: {e}", exc_info=True); return None
+
+def get_due_backlog_stats(db: Session, organization_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Scheduling lag metrics: how many lead campaign statuses are due right now and how long
+    the oldest one has been overdue (never-sent step-0 rows count from their created_at).
+    """
+    if not models.LeadCampaignStatus or not models.Lead or not models.EmailCampaign or not LeadStatusEnum:
+        logger.error("DB: Models/Enums missing for get_due_backlog_stats.")
+        return None
+    now_utc = datetime.now(timezone.utc)
+    try:
+        org_filter = () if organization_id is None else (models.LeadCampaignStatus.organization_id == organization_id,)
+        due = _due_lead_campaign_statuses(now_utc, *org_filter)
+        query = db.query(
+                func.count(due.c.id),
+                func.min(func.coalesce(due.c.next_email_due_at, due.c.created_at))
+            ).select_from(due).\
+            join(models.Lead, due.c.lead_id == models.Lead.id).\
+            join(models.EmailCampaign, due.c.campaign_id == models.EmailCampaign.id)
+        due_count, oldest_due_at = query.one()
+        if oldest_due_at is not None and oldest_due_at.tzinfo is None:
+            oldest_due_at = oldest_due_at.replace(tzinfo=timezone.utc)
+        return {
+            "due_count": int(due_count or 0),
+            "oldest_due_at": oldest_due_at,
+            "oldest_overdue_seconds": max(0.0, (now_utc - oldest_due_at).total_seconds()) if oldest_due_at else 0.0,
+        }
+    except SQLAlchemyError as e:
+        logger.error(f"DB Error getting due backlog stats: {e}", exc_info=True); return None
+
+def _subscription_tier_weight(tier_weights: Dict[str, float]):
+    """
+    SQL expression for an organization's fair-share weight, from its Stripe price id.
+    Orgs without a live subscription, or on a price not listed, weigh 1.0.
+    Expects Subscription to be outer-joined on a live (active/trialing) subscription.
+    """
+    if not tier_weights:
+        return literal(1.0)
+    return case(
+        *[(models.Subscription.stripe_price_id == price_id, float(weight)) for price_id, weight in tier_weights.items()],
+        else_=1.0
+    )
+
+# Candidates locked per claimed row, so concurrent claimers ranking the same rows still fill their batches
+_CLAIM_OVERSELECT_FACTOR = 4
+
+def claim_leads_due_for_step(db: Session, worker_id: str, organization_id: Optional[int] = None,
+                             query_limit: int = 100, lease_seconds: int = 600,
+                             tier_weights: Optional[Dict[str, float]] = None) -> List[models.LeadCampaignStatus]:
+    """
+    Leases a batch of due LeadCampaignStatus rows to one scheduler worker.
+    Candidate rows are locked with FOR UPDATE SKIP LOCKED, so concurrent workers
+    never claim the same row, and a lease that was never released (crashed worker)
+    becomes claimable again once claim_expires_at has passed.
+
+    The batch is shared between organizations by weighted round-robin: each org's due
+    rows are numbered oldest-first (row_number() OVER (PARTITION BY organization_id)) and
+    the batch takes rows in order of row_number / weight, so every org with due work gets
+    a share of every batch, in proportion to its subscription tier's weight
+    (tier_weights maps Stripe price id -> weight; see EMAIL_SCHEDULER_TIER_WEIGHTS).
+
+    Cost: the window numbers the whole claimable due backlog (a sort per org) on every claim,
+    so a claim is O(backlog log backlog) even though it returns query_limit rows. That is
+    fine for backlogs in the tens of thousands; beyond that, cap each org's candidates first
+    (e.g. a LATERAL top-N per org) before ranking.
+    """
+    if not models.LeadCampaignStatus or not models.Lead or not models.EmailCampaign or not models.Subscription or not LeadStatusEnum:
+        logger.error("DB: Models/Enums missing for claim_leads_due_for_step.")
+        return []
+    now_utc = datetime.now(timezone.utc)
+    lcs = models.LeadCampaignStatus
+    claimable = or_(
+        lcs.claimed_by.is_(None),
+        lcs.claim_expires_at.is_(None),
+        lcs.claim_expires_at <= now_utc
+    )
+    try:
+        org_filter = () if organization_id is None else (lcs.organization_id == organization_id,)
+        due = _due_lead_campaign_statuses(now_utc, claimable, *org_filter)
+        org_rank = func.row_number().over(
+            partition_by=due.c.organization_id,
+            order_by=(due.c.next_email_due_at.asc().nulls_first(), due.c.created_at.asc())
+        )
+        candidates = db.query(
+                due.c.id.label("status_id"),
+                due.c.next_email_due_at.label("due_at"),
+                org_rank.label("org_rank"),
+                _subscription_tier_weight(tier_weights or {}).label("weight")
+            ).select_from(due).\
+            join(models.Lead, due.c.lead_id == models.Lead.id).\
+            join(models.EmailCampaign, due.c.campaign_id == models.EmailCampaign.id).\
+            outerjoin(models.Subscription, and_(
+                models.Subscription.organization_id == due.c.organization_id,
+                models.Subscription.status.in_(("active", "trialing"))
+            )).subquery("fair_share_candidates")
+        # The window function can't share a query level with FOR UPDATE, so rows are ranked first
+        # and locked by id; due/claimable are re-checked when the lock is taken. Concurrent
+        # workers rank the same rows, so more candidates than needed are locked with SKIP
+        # LOCKED and the batch is trimmed in ranked order: a worker that loses the race for the
+        # top rows still fills its batch from the ones after them.
+        ranked_ids = [row.status_id for row in db.query(candidates.c.status_id).order_by(
+                (candidates.c.org_rank / candidates.c.weight).asc(),
+                candidates.c.due_at.asc().nulls_first()
+            ).limit(query_limit * _CLAIM_OVERSELECT_FACTOR).all()]
+        if not ranked_ids:
+            db.commit() # End the transaction
+            return []
+
+        locked_ids = {row.id for row in db.query(lcs.id).filter(
+                lcs.id.in_(ranked_ids),
+                _lead_campaign_status_due_filter(now_utc),
+                claimable
+            ).with_for_update(skip_locked=True, of=lcs).all()}
+        claimed_ids = [status_id for status_id in ranked_ids if status_id in locked_ids][:query_limit]
+
+        if not claimed_ids:
+            db.commit() # End the locking transaction
+            return []
+
+        db.query(lcs).filter(lcs.id.in_(claimed_ids)).update(
+            {"claimed_by": worker_id, "claim_expires_at": now_utc + timedelta(seconds=lease_seconds)},
+            synchronize_session=False
+        )
+        db.commit()
+
+        claimed_rows = db.query(lcs).filter(lcs.id.in_(claimed_ids)).order_by(
+                lcs.organization_id,
+                lcs.next_email_due_at.asc().nulls_first(),
+                lcs.created_at.asc()
+            ).all()
+        logger.debug(f"DB: Worker {worker_id} claimed {len(claimed_rows)} due lead campaign statuses "
+                     f"across {len({row.organization_id for row in claimed_rows})} organizations.")
+        return claimed_rows
+    except SQLAlchemyError as e:
+        db.rollback(); logger.error(f"DB Error claiming due leads for worker {worker_id}: {e}", exc_info=True); return []
+
+def release_lead_campaign_status_claims(db: Session, status_ids: List[int], worker_id: str) -> int:
+    """Clears the lease on the given rows, but only where it is still held by worker_id."""
+    if not models.LeadCampaignStatus: logger.error("DB: LeadCampaignStatus model not loaded."); return 0
+    if not status_ids: return 0
+    try:
+        released = db.query(models.LeadCampaignStatus).filter(
+            models.LeadCampaignStatus.id.in_(status_ids),
+            models.LeadCampaignStatus.claimed_by == worker_id
+        ).update({"claimed_by": None, "claim_expires_at": None}, synchronize_session=False)
+        db.commit()
+        logger.debug(f"DB: Worker {worker_id} released {released} lead campaign status claims.")
+        return released
+    except SQLAlchemyError as e:
+        db.rollback(); logger.error(f"DB Error releasing claims for worker {worker_id}: {e}", exc_info=True); return 0
+
+def get_scheduler_working_set(db: Session, status_ids: List[int]) -> List[Dict[str, Any]]:
+    """
+    Loads everything the email scheduler needs for a batch of lead campaign statuses
+    in a single query: the status row, its Lead, the next and following CampaignStep,
+    and the organization's email settings (decrypted once per organization).
+    Returns one dict per status with keys: status, lead, next_step, following_step, email_settings.
+    """
+    if not models.LeadCampaignStatus or not models.Lead or not models.CampaignStep or not models.OrganizationEmailSettings:
+        logger.error("DB: Models missing for get_scheduler_working_set."); return []
+    if not status_ids: return []
+    next_step = aliased(models.CampaignStep)
+    following_step = aliased(models.CampaignStep)
+    try:
+        rows = db.query(models.LeadCampaignStatus, models.Lead, next_step, following_step, models.OrganizationEmailSettings).\
+            outerjoin(models.Lead, and_(
+                models.Lead.id == models.LeadCampaignStatus.lead_id,
+                models.Lead.organization_id == models.LeadCampaignStatus.organization_id)).\
+            outerjoin(next_step, and_(
+                next_step.campaign_id == models.LeadCampaignStatus.campaign_id,
+                next_step.organization_id == models.LeadCampaignStatus.organization_id,
+                next_step.step_number == models.LeadCampaignStatus.current_step_number + 1)).\
+            outerjoin(following_step, and_(
+                following_step.campaign_id == models.LeadCampaignStatus.campaign_id,
+                following_step.organization_id == models.LeadCampaignStatus.organization_id,
+                following_step.step_number == models.LeadCampaignStatus.current_step_number + 2)).\
+            outerjoin(models.OrganizationEmailSettings,
+                models.OrganizationEmailSettings.organization_id == models.LeadCampaignStatus.organization_id).\
+            filter(models.LeadCampaignStatus.id.in_(status_ids)).\
+            order_by(
+                models.LeadCampaignStatus.organization_id,
+                models.LeadCampaignStatus.next_email_due_at.asc().nulls_first(),
+                models.LeadCampaignStatus.created_at.asc()
+            ).all()
+
+        working_set = []
+        decrypted_org_ids = set()
+        read_only_objs = {}
+        for status_obj, lead_obj, next_step_obj, following_step_obj, settings_obj in rows:
+            if settings_obj is not None and settings_obj.organization_id not in decrypted_org_ids:
+                _attach_decrypted_email_settings(settings_obj)
+                decrypted_org_ids.add(settings_obj.organization_id)
+            for obj in (lead_obj, next_step_obj, following_step_obj, settings_obj):
+                if obj is not None: read_only_objs[id(obj)] = obj
+            working_set.append({
+                "status": status_obj, "lead": lead_obj,
+                "next_step": next_step_obj, "following_step": following_step_obj,
+                "email_settings": settings_obj
+            })
+        # Detach the read-only objects so status-update commits during the cycle
+        # don't expire them and trigger one lazy reload per object.
+        for obj in read_only_objs.values():
+            db.expunge(obj)
+        logger.debug(f"DB: Loaded scheduler working set of {len(working_set)} statuses across {len(decrypted_org_ids)} orgs.")
+        return working_set
+    except SQLAlchemyError as e:
+        logger.error(f"DB Error loading scheduler working set: {e}", exc_info=True); return []
+
 def get_lead_campaign_status_by_id(db: Session, status_id: int, organization_id: int) -> Optional[models.LeadCampaignStatus]:
     if not models.LeadCampaignStatus: logger.error("DB: LeadCampaignStatus model not loaded."); return None
     try: return db.query(models.LeadCampaignStatus).filter(models.LeadCampaignStatus.id == status_id, models.LeadCampaignStatus.organization_id == organization_id).first()
@@ -721,16 +1020,20 @@ def get_org_email_settings_from_db(db: Session, organization_id: int, decrypt: b
     try:
         settings_obj = db.query(models.OrganizationEmailSettings).filter(models.OrganizationEmailSettings.organization_id == organization_id).first()
         if settings_obj and decrypt:
-            # Add transient decrypted attributes
-            setattr(settings_obj, 'smtp_password', _decrypt_data(getattr(settings_obj, 'encrypted_smtp_password', None)))
-            setattr(settings_obj, 'api_key', _decrypt_data(getattr(settings_obj, 'encrypted_api_key', None))) # Assuming 'api_key' maps to encrypted_api_key
-            setattr(settings_obj, 'secret_key', _decrypt_data(getattr(settings_obj, 'encrypted_secret_key', None)))
-            setattr(settings_obj, 'access_token', _decrypt_data(getattr(settings_obj, 'encrypted_access_token', None)))
-            setattr(settings_obj, 'refresh_token', _decrypt_data(getattr(settings_obj, 'encrypted_refresh_token', None)))
-            setattr(settings_obj, 'imap_password', _decrypt_data(getattr(settings_obj, 'encrypted_imap_password', None)))
+            _attach_decrypted_email_settings(settings_obj)
         return settings_obj
     except SQLAlchemyError as e: logger.error(f"DB Error get email settings for Org {organization_id}: {e}", exc_info=True); return None
 
+def _attach_decrypted_email_settings(settings_obj: models.OrganizationEmailSettings) -> models.OrganizationEmailSettings:
+    # Add transient decrypted attributes
+    setattr(settings_obj, 'smtp_password', _decrypt_data(getattr(settings_obj, 'encrypted_smtp_password', None)))
+    setattr(settings_obj, 'api_key', _decrypt_data(getattr(settings_obj, 'encrypted_api_key', None))) # Assuming 'api_key' maps to encrypted_api_key
+    setattr(settings_obj, 'secret_key', _decrypt_data(getattr(settings_obj, 'encrypted_secret_key', None)))
+    setattr(settings_obj, 'access_token', _decrypt_data(getattr(settings_obj, 'encrypted_access_token', None)))
+    setattr(settings_obj, 'refresh_token', _decrypt_data(getattr(settings_obj, 'encrypted_refresh_token', None)))
+    setattr(settings_obj, 'imap_password', _decrypt_data(getattr(settings_obj, 'encrypted_imap_password', None)))
+    return settings_obj
+
 # ==========================================
 # SUBSCRIPTION CRUD - ADDED/MODIFIED
 # ==========================================
@@ -823,7 +1126,7 @@ def update_organization_email_settings_field(db: Session, organization_id: int,
         settings = db.query(models.OrganizationEmailSettings).filter(models.OrganizationEmailSettings.organization_id == organization_id).first()
         if not settings: logger.warning(f"No org email settings for org {organization_id} to update."); return False
 
-        allowed = {"last_imap_poll_uid", "last_imap_poll_timestamp", "enable_reply_detection", "is_configured"}
+        allowed = {"last_imap_poll_uid", "last_imap_poll_timestamp", "last_imap_uidvalidity", "enable_reply_detection", "is_configured"}
         if not _update_entity_fields(settings, updates, allowed):
             logger.info(f"No valid fields for org email settings update (Org {organization_id})."); return False
             
@@ -857,7 +1160,37 @@ def log_sent_email(db: Session, lead_campaign_status_id: Optional[int], organiza
     except SQLAlchemyError as e:
         db.rollback(); logger.error(f"DB Error logging sent email: {e}", exc_info=True); return None
 
+def log_sent_emails(db: Session, rows: List[Dict[str, Any]], commit: bool = True) -> Optional[List[int]]:
+    """
+    Bulk version of log_sent_email: one multi-row INSERT ... ON CONFLICT (organization_id,
+    message_id_header) DO NOTHING RETURNING id. Each row carries the OutgoingEmailLog columns
+    (lead_campaign_status_id, organization_id, lead_id, campaign_id, campaign_step_id,
+    message_id_header, to_email, subject). Returns the ids of newly inserted rows
+    (duplicates are skipped), or None if the insert failed and was rolled back.
+    """
+    if not models.OutgoingEmailLog: logger.error("DB: OutgoingEmailLog model not loaded."); return None
+    if not rows: return []
+    columns = ("lead_campaign_status_id", "organization_id", "lead_id", "campaign_id",
+               "campaign_step_id", "message_id_header", "to_email", "subject")
+    values = [{column: row.get(column) for column in columns} for row in rows]
+    stmt = pg_insert(models.OutgoingEmailLog).values(values).on_conflict_do_nothing(
+        index_elements=[models.OutgoingEmailLog.organization_id, models.OutgoingEmailLog.message_id_header]
+    ).returning(models.OutgoingEmailLog.id)
+    try:
+        inserted_ids = list(db.execute(stmt).scalars().all())
+        if commit: db.commit()
+        if len(inserted_ids) < len(values):
+            logger.warning(f"DB: {len(values) - len(inserted_ids)} of {len(values)} sent email log rows already existed (duplicate Message-IDs).")
+        logger.info(f"Logged {len(inserted_ids)} sent emails in one statement.")
+        return inserted_ids
+    except SQLAlchemyError as e:
+        db.rollback(); logger.error(f"DB Error bulk logging {len(values)} sent emails: {e}", exc_info=True); return None
+
 def store_email_reply(db: Session, reply_data: Dict[str, Any]) -> Optional[models.EmailReply]:
+    """
+    Inserts a reply, idempotently on its Message-ID (message_id_header_of_reply): if a reply with
+    that Message-ID is already stored, nothing is written and the stored row is returned.
+    """
     if not models.EmailReply: logger.error("DB: EmailReply model not loaded."); return None
     
     required_fields = ["organization_id", "lead_id", "received_at", "from_email"] # LCS_id, campaign_id can be optional
@@ -872,7 +1205,9 @@ def store_email_reply(db: Session, reply_data: Dict[str, Any]) -> Optional[model
             logger.warning(f"Attempting to store non-dict/list ai_extracted_entities of type {type(ai_entities)}. Setting to None.")
             ai_entities = None
 
+        reply_message_id = (reply_data.get("message_id_header_of_reply") or "").strip() or None # "" would collide
         new_reply_params = {
+            "message_id_header_of_reply": reply_message_id,
             "outgoing_email_log_id": reply_data.get("outgoing_email_log_id"),
             "lead_campaign_status_id": reply_data.get("lead_campaign_status_id"), # Allow None
             "organization_id": reply_data["organization_id"],
@@ -881,21 +1216,72 @@ def store_email_reply(db: Session, reply_data: Dict[str, Any]) -> Optional[model
             "received_at": reply_data["received_at"],
             "from_email": reply_data["from_email"],
             "reply_subject": reply_data.get("reply_subject"),
-            "raw_body_text": reply_data.get("raw_body_text"),
+            "raw_content_hash": None,
             "cleaned_reply_text": reply_data.get("cleaned_reply_text"),
             "ai_classification": reply_data.get("ai_classification"), # Assumes string value of enum
             "ai_summary": reply_data.get("ai_summary"),
             "ai_extracted_entities": ai_entities,
+            "classification_status": reply_data.get("classification_status") or models.REPLY_CLASSIFICATION_DONE,
             "is_actioned_by_user": bool(reply_data.get("is_actioned_by_user", False)),
             "user_action_notes": reply_data.get("user_action_notes"),
         }
-        new_reply = models.EmailReply(**new_reply_params)
-        db.add(new_reply); db.commit(); db.refresh(new_reply)
-        logger.info(f"Stored email reply ID {new_reply.id} from {new_reply.from_email}")
+        raw_body_text = reply_data.get("raw_body_text")
+        if raw_body_text:
+            # Kept off the hot email_replies row; identical messages share one compressed copy
+            raw_content = compress_raw_content(raw_body_text)
+            db.execute(pg_insert(models.EmailReplyRawContent).values(
+                content_hash=raw_content.content_hash, codec=raw_content.codec,
+                compressed_content=raw_content.data, original_size=raw_content.original_size,
+            ).on_conflict_do_nothing(index_elements=[models.EmailReplyRawContent.content_hash]))
+            new_reply_params["raw_content_hash"] = raw_content.content_hash
+
+        insert_stmt = pg_insert(models.EmailReply).values(**new_reply_params).on_conflict_do_nothing(
+            index_elements=[models.EmailReply.message_id_header_of_reply]
+        ).returning(models.EmailReply.id)
+        new_reply_id = db.execute(insert_stmt).scalar()
+        db.commit()
+        if new_reply_id is None:
+            logger.info(f"Email reply {reply_message_id} is already stored; skipped duplicate.")
+            return db.query(models.EmailReply).filter(models.EmailReply.message_id_header_of_reply == reply_message_id).first()
+        new_reply = db.get(models.EmailReply, new_reply_id)
+        logger.info(f"Stored email reply ID {new_reply_id} from {new_reply_params['from_email']}")
         return new_reply
     except SQLAlchemyError as e:
         db.rollback(); logger.error(f"DB Error storing email reply: {e}", exc_info=True); return None
 
+def get_email_reply_raw_text(db: Session, reply_id: int, organization_id: int) -> Optional[str]:
+    """The full raw message of one reply, decompressed on demand; falls back to the legacy raw_body_text column."""
+    if not models.EmailReply or not models.EmailReplyRawContent: logger.error("DB: Models missing for get_email_reply_raw_text."); return None
+    try:
+        row = db.query(
+            models.EmailReply.raw_body_text, models.EmailReplyRawContent.codec, models.EmailReplyRawContent.compressed_content
+        ).outerjoin(
+            models.EmailReplyRawContent, models.EmailReplyRawContent.content_hash == models.EmailReply.raw_content_hash
+        ).filter(
+            models.EmailReply.id == reply_id, models.EmailReply.organization_id == organization_id
+        ).first()
+        if row is None:
+            return None
+        if row.compressed_content is not None:
+            return decompress_raw_content(row.codec, row.compressed_content)
+        return row.raw_body_text
+    except (SQLAlchemyError, ValueError, zlib.error) as e:
+        logger.error(f"DB Error loading raw content of reply {reply_id} for org {organization_id}: {e}", exc_info=True); return None
+
+def get_stored_reply_message_ids(db: Session, message_ids: List[str]) -> Optional[set]:
+    """Which of these reply Message-IDs are already stored; matches the global unique index on message_id_header_of_reply."""
+    if not models.EmailReply: logger.error("DB: EmailReply model not loaded."); return None
+    lookup_values = {message_id for message_id in message_ids if message_id}
+    if not lookup_values:
+        return set()
+    try:
+        rows = db.query(models.EmailReply.message_id_header_of_reply).filter(
+            models.EmailReply.message_id_header_of_reply.in_(lookup_values)
+        ).all()
+        return {row[0] for row in rows}
+    except SQLAlchemyError as e:
+        logger.error(f"DB Error checking {len(lookup_values)} reply Message-IDs: {e}", exc_info=True); return None
+
 def get_outgoing_email_log_by_message_id(db: Session, organization_id: int, message_id_header: str) -> Optional[models.OutgoingEmailLog]:
     if not models.OutgoingEmailLog: logger.error("DB: OutgoingEmailLog model not loaded."); return None
     try:
@@ -905,6 +1291,203 @@ def get_outgoing_email_log_by_message_id(db: Session, organization_id: int, mess
         ).first()
     except SQLAlchemyError as e: logger.error(f"DB Error get outgoing log by MsgID: {e}", exc_info=True); return None
 
+def get_reply_links_by_message_ids(db: Session, organization_id: int, message_ids: List[str]) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    Resolves a batch of In-Reply-To/References Message-IDs to the outgoing email, lead and lead
+    campaign status they answer, in one query. Message-IDs are matched with and without angle
+    brackets; the result is keyed by the bare id and omits ids that match no outgoing email.
+    """
+    if not models.OutgoingEmailLog or not models.Lead or not models.LeadCampaignStatus:
+        logger.error("DB: Models missing for get_reply_links_by_message_ids."); return None
+    bare_ids = {message_id.strip("<> ") for message_id in message_ids if message_id and message_id.strip("<> ")}
+    if not bare_ids:
+        return {}
+    lookup_values = bare_ids | {f"<{message_id}>" for message_id in bare_ids}
+    oel, lcs = models.OutgoingEmailLog, models.LeadCampaignStatus
+    try:
+        rows = db.query(
+            oel.id, oel.message_id_header, oel.lead_id, oel.campaign_id,
+            func.coalesce(oel.lead_campaign_status_id, lcs.id).label("lcs_id"), models.Lead.name
+        ).join(
+            models.Lead, and_(models.Lead.id == oel.lead_id, models.Lead.organization_id == oel.organization_id)
+        ).outerjoin(
+            # Fallback for log rows without lead_campaign_status_id: the lead's status in the same
+            # campaign, so a reply is never linked to another campaign's status
+            lcs, and_(lcs.lead_id == oel.lead_id, lcs.campaign_id == oel.campaign_id, lcs.organization_id == oel.organization_id)
+        ).filter(
+            oel.organization_id == organization_id,
+            oel.message_id_header.in_(lookup_values)
+        ).all()
+        return {
+            row.message_id_header.strip("<> "): {
+                "lead_id": row.lead_id,
+                "campaign_id": row.campaign_id,
+                "lcs_id": row.lcs_id,
+                "outgoing_email_log_id": row.id,
+                "lead_name": row.name,
+            }
+            for row in rows
+        }
+    except SQLAlchemyError as e:
+        logger.error(f"DB Error resolving {len(bare_ids)} reply Message-IDs for org {organization_id}: {e}", exc_info=True); return None
+
+# ==========================================
+# REPLY CLASSIFICATION CACHE
+# ==========================================
+def get_cached_reply_classification(db: Session, cache_keys: List[str], ttl: timedelta) -> Optional[Dict[str, Any]]:
+    """
+    The cached classification for the first of cache_keys that has an entry younger than ttl
+    (with the matching "cache_key"), or None. A hit bumps the entry's last_used_at (for LRU
+    eviction) and hit_count.
+    """
+    if not models.ReplyClassificationCache: logger.error("DB: ReplyClassificationCache model not loaded."); return None
+    cache = models.ReplyClassificationCache
+    try:
+        entries = db.query(cache).filter(
+            cache.cache_key.in_(cache_keys), cache.created_at >= datetime.now(timezone.utc) - ttl
+        ).all()
+        entries_by_key = {entry.cache_key: entry for entry in entries}
+        entry = next((entries_by_key[key] for key in cache_keys if key in entries_by_key), None)
+        if entry is None:
+            return None
+        db.query(cache).filter(cache.cache_key == entry.cache_key).update(
+            {cache.last_used_at: func.now(), cache.hit_count: cache.hit_count + 1}, synchronize_session=False
+        )
+        db.commit()
+        return {"category": entry.category, "summary": entry.summary, "extracted_info": entry.extracted_info or {}, "cache_key": entry.cache_key}
+    except SQLAlchemyError as e:
+        db.rollback(); logger.error(f"DB Error reading reply classification cache: {e}", exc_info=True); return None
+
+def store_reply_classification(db: Session, cache_keys: List[str], model: str, prompt_version: str, classification: Dict[str, Any]) -> bool:
+    """Caches one classification under each of cache_keys, replacing expired or older entries."""
+    if not models.ReplyClassificationCache: logger.error("DB: ReplyClassificationCache model not loaded."); return False
+    if not cache_keys:
+        return True
+    extracted_info = classification.get("extracted_info")
+    values = [{
+        "cache_key": key, "model": model, "prompt_version": prompt_version,
+        "category": classification["category"], "summary": classification.get("summary"),
+        "extracted_info": extracted_info if isinstance(extracted_info, dict) else {}, "hit_count": 0,
+    } for key in cache_keys]
+    try:
+        insert_stmt = pg_insert(models.ReplyClassificationCache).values(values)
+        db.execute(insert_stmt.on_conflict_do_update(
+            index_elements=[models.ReplyClassificationCache.cache_key],
+            set_={
+                "category": insert_stmt.excluded.category, "summary": insert_stmt.excluded.summary,
+                "extracted_info": insert_stmt.excluded.extracted_info, "hit_count": 0,
+                "created_at": func.now(), "last_used_at": func.now(),
+            }
+        ))
+        db.commit()
+        return True
+    except SQLAlchemyError as e:
+        db.rollback(); logger.error(f"DB Error storing reply classification cache entry: {e}", exc_info=True); return False
+
+def prune_reply_classification_cache(db: Session, max_entries: int, ttl: timedelta) -> Optional[int]:
+    """Deletes entries older than ttl, then the least recently used beyond max_entries. Returns rows deleted."""
+    if not models.ReplyClassificationCache: logger.error("DB: ReplyClassificationCache model not loaded."); return None
+    cache = models.ReplyClassificationCache
+    try:
+        expired = db.query(cache).filter(cache.created_at < datetime.now(timezone.utc) - ttl).delete(synchronize_session=False)
+        keep = db.query(cache.cache_key).order_by(cache.last_used_at.desc()).limit(max_entries)
+        evicted = db.query(cache).filter(~cache.cache_key.in_(keep.scalar_subquery())).delete(synchronize_session=False)
+        db.commit()
+        return expired + evicted
+    except SQLAlchemyError as e:
+        db.rollback(); logger.error(f"DB Error pruning reply classification cache: {e}", exc_info=True); return None
+
+def count_reply_classification_cache_entries(db: Session) -> Optional[int]:
+    if not models.ReplyClassificationCache: logger.error("DB: ReplyClassificationCache model not loaded."); return None
+    try:
+        return db.query(func.count(models.ReplyClassificationCache.cache_key)).scalar()
+    except SQLAlchemyError as e:
+        logger.error(f"DB Error counting reply classification cache entries: {e}", exc_info=True); return None
+
+# ==========================================
+# REPLY CLASSIFICATION QUEUE
+# ==========================================
+def claim_pending_reply_classifications(db: Session, limit: int, lease_seconds: float) -> Optional[List[Dict[str, Any]]]:
+    """
+    Claims up to limit replies awaiting classification, oldest first, and returns what a worker
+    needs to classify them. Rows locked by another worker are skipped; a claim is a lease, so
+    replies whose worker died are claimed again once classification_next_attempt_at passes.
+    """
+    if not models.EmailReply or not models.Lead: logger.error("DB: Models missing for claim_pending_reply_classifications."); return None
+    reply = models.EmailReply
+    now_utc = datetime.now(timezone.utc)
+    try:
+        claimable_ids = [row.id for row in db.query(reply.id).filter(
+            reply.classification_status.in_([models.REPLY_CLASSIFICATION_PENDING, models.REPLY_CLASSIFICATION_IN_PROGRESS]),
+            or_(reply.classification_next_attempt_at.is_(None), reply.classification_next_attempt_at <= now_utc)
+        ).order_by(reply.received_at).limit(limit).with_for_update(skip_locked=True).all()]
+        if not claimable_ids:
+            db.rollback() # Release the (empty) locking transaction
+            return []
+        db.query(reply).filter(reply.id.in_(claimable_ids)).update({
+            reply.classification_status: models.REPLY_CLASSIFICATION_IN_PROGRESS,
+            reply.classification_attempts: reply.classification_attempts + 1,
+            reply.classification_next_attempt_at: now_utc + timedelta(seconds=lease_seconds),
+        }, synchronize_session=False)
+        rows = db.query(
+            reply.id, reply.organization_id, reply.lead_id, reply.lead_campaign_status_id, reply.received_at,
+            reply.cleaned_reply_text, reply.classification_attempts, models.Lead.name.label("lead_name")
+        ).join(models.Lead, models.Lead.id == reply.lead_id).filter(reply.id.in_(claimable_ids)).order_by(reply.received_at).all()
+        db.commit()
+        return [dict(row._mapping) for row in rows]
+    except SQLAlchemyError as e:
+        db.rollback(); logger.error(f"DB Error claiming pending reply classifications: {e}", exc_info=True); return None
+
+def complete_reply_classification(db: Session, reply_id: int, classification: Dict[str, Any]) -> bool:
+    """Stores a worker's classification result on a claimed reply and takes it off the queue."""
+    if not models.EmailReply: logger.error("DB: EmailReply model not loaded."); return False
+    extracted_info = classification.get("extracted_info")
+    try:
+        updated = db.query(models.EmailReply).filter(models.EmailReply.id == reply_id).update({
+            models.EmailReply.ai_classification: classification.get("category"),
+            models.EmailReply.ai_summary: classification.get("summary"),
+            models.EmailReply.ai_extracted_entities: extracted_info if isinstance(extracted_info, (dict, list)) else None,
+            models.EmailReply.classification_status: models.REPLY_CLASSIFICATION_DONE,
+            models.EmailReply.classification_next_attempt_at: None,
+        }, synchronize_session=False)
+        db.commit()
+        return updated > 0
+    except SQLAlchemyError as e:
+        db.rollback(); logger.error(f"DB Error completing classification of reply {reply_id}: {e}", exc_info=True); return False
+
+def fail_reply_classification(db: Session, reply_id: int, max_attempts: int, retry_delay_seconds: float) -> Optional[str]:
+    """
+    Records a failed classification attempt: the reply goes back on the queue with exponential
+    backoff, or after max_attempts is marked failed (ai_classification CLASSIFICATION_FAILED).
+    Returns the reply's new classification_status.
+    """
+    if not models.EmailReply: logger.error("DB: EmailReply model not loaded."); return None
+    try:
+        reply_obj = db.query(models.EmailReply).filter(models.EmailReply.id == reply_id).first()
+        if not reply_obj: logger.warning(f"Email reply {reply_id} not found to record classification failure."); return None
+        attempts = reply_obj.classification_attempts or 0
+        if attempts >= max_attempts:
+            reply_obj.classification_status = models.REPLY_CLASSIFICATION_FAILED
+            reply_obj.ai_classification = "CLASSIFICATION_FAILED"
+            reply_obj.classification_next_attempt_at = None
+        else:
+            reply_obj.classification_status = models.REPLY_CLASSIFICATION_PENDING
+            reply_obj.classification_next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=retry_delay_seconds * 2 ** max(0, attempts - 1))
+        db.commit()
+        return reply_obj.classification_status
+    except SQLAlchemyError as e:
+        db.rollback(); logger.error(f"DB Error recording classification failure of reply {reply_id}: {e}", exc_info=True); return None
+
+def count_email_replies_by_classification_status(db: Session) -> Optional[Dict[str, int]]:
+    if not models.EmailReply: logger.error("DB: EmailReply model not loaded."); return None
+    try:
+        rows = db.query(models.EmailReply.classification_status, func.count(models.EmailReply.id)).filter(
+            models.EmailReply.classification_status != models.REPLY_CLASSIFICATION_DONE
+        ).group_by(models.EmailReply.classification_status).all()
+        return {status: count for status, count in rows}
+    except SQLAlchemyError as e:
+        logger.error(f"DB Error counting email replies by classification status: {e}", exc_info=True); return None
+
 # ==========================================
 # DASHBOARD & ANALYTICS QUERIES
 # ==========================================
@@ -2,9 +2,9 @@
 
 from sqlalchemy import (
     Boolean, Column, ForeignKey, Integer, String, DateTime, Text,
-    Float, func, UniqueConstraint, Enum as SQLAlchemyEnum # Keep SQLAlchemyEnum for potential future use
+    Float, func, Index, LargeBinary, UniqueConstraint, Enum as SQLAlchemyEnum # Keep SQLAlchemyEnum for potential future use
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.dialects.postgresql import JSONB
 
 # Import Base from your central base_class.py
@@ -207,6 +207,14 @@ class LeadCampaignStatus(Base):
     user_notes = Column(Text, nullable=True) # From your DDL
     # error_count = Column(Integer, default=0) # From your model, add if needed
 
+    # Scheduler lease: set by claim_leads_due_for_step, cleared when the worker releases the row.
+    # create_all doesn't alter existing tables; on an existing database add them with:
+    #   ALTER TABLE lead_campaign_status ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(255);
+    #   ALTER TABLE lead_campaign_status ADD COLUMN IF NOT EXISTS claim_expires_at TIMESTAMPTZ;
+    #   CREATE INDEX IF NOT EXISTS ix_lead_campaign_status_claimed_by ON lead_campaign_status (claimed_by);
+    claimed_by = Column(String(255), nullable=True, index=True)
+    claim_expires_at = Column(DateTime(timezone=True), nullable=True)
+
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False) # Added this!
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
 
@@ -215,6 +223,21 @@ class LeadCampaignStatus(Base):
     outgoing_email_logs = relationship("OutgoingEmailLog", back_populates="lead_campaign_status", cascade="all, delete-orphan")
     email_replies = relationship("EmailReply", back_populates="lead_campaign_status", cascade="all, delete-orphan")
 
+# Serves the scheduler's due-lead scan (see database._due_lead_campaign_statuses): both halves of
+# "due now, or never sent" are range scans here, and only active rows are indexed.
+# create_all doesn't add indexes to existing tables; on an existing database build it without
+# blocking writes (outside a transaction) with:
+#   CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_lcs_active_due_org
+#     ON lead_campaign_status (next_email_due_at ASC NULLS FIRST, organization_id)
+#     WHERE status = 'active';
+# scripts/explain_due_leads.py --create-index runs the same statement.
+Index(
+    "ix_lcs_active_due_org",
+    LeadCampaignStatus.next_email_due_at.asc().nulls_first(),
+    LeadCampaignStatus.organization_id,
+    postgresql_where=(LeadCampaignStatus.status == (LeadStatusEnum.active.value if LeadStatusEnum else "active")),
+)
+
 
 class OrganizationEmailSettings(Base):
     __tablename__ = "organization_email_settings"
@@ -248,6 +271,9 @@ class OrganizationEmailSettings(Base):
 
     last_imap_poll_uid = Column(Text, nullable=True)
     last_imap_poll_timestamp = Column(DateTime(timezone=True), nullable=True)
+    # create_all doesn't alter existing tables; on an existing database add it with:
+    #   ALTER TABLE organization_email_settings ADD COLUMN IF NOT EXISTS last_imap_uidvalidity VARCHAR(64);
+    last_imap_uidvalidity = Column(String(64), nullable=True) # UIDVALIDITY that last_imap_poll_uid belongs to
 
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
@@ -279,6 +305,14 @@ class OutgoingEmailLog(Base):
     email_replies = relationship("EmailReply", back_populates="outgoing_email_log", cascade="all, delete-orphan") # A sent email can have many replies
 
 
+# EmailReply.classification_status: replies are stored as pending and classified afterwards by
+# the worker pool in app/agents/reply_classification_queue.py
+REPLY_CLASSIFICATION_PENDING = "pending_classification"
+REPLY_CLASSIFICATION_IN_PROGRESS = "classifying"
+REPLY_CLASSIFICATION_DONE = "classified"
+REPLY_CLASSIFICATION_FAILED = "classification_failed"
+
+
 class EmailReply(Base):
     __tablename__ = "email_replies"
 
@@ -297,13 +331,32 @@ class EmailReply(Base):
     received_at = Column(DateTime(timezone=True), nullable=False, index=True)
     from_email = Column(String(255), nullable=False, index=True) # Added index
     reply_subject = Column(Text, nullable=True)
-    raw_body_text = Column(Text, nullable=True)
+    # Legacy: raw messages now live compressed in email_reply_raw_contents (see raw_content_hash).
+    # Deferred so list and dashboard queries don't read it.
+    raw_body_text = deferred(Column(Text, nullable=True))
+    # create_all creates email_reply_raw_contents but doesn't alter email_replies; on an existing
+    # database add the column, its foreign key and index with:
+    #   ALTER TABLE email_replies ADD COLUMN IF NOT EXISTS raw_content_hash VARCHAR(64)
+    #     REFERENCES email_reply_raw_contents (content_hash) ON DELETE SET NULL;
+    #   CREATE INDEX IF NOT EXISTS ix_email_replies_raw_content_hash ON email_replies (raw_content_hash);
+    raw_content_hash = Column(String(64), ForeignKey("email_reply_raw_contents.content_hash", ondelete="SET NULL"), nullable=True, index=True)
     cleaned_reply_text = Column(Text, nullable=True)
 
     # Storing as string, ensure AIClassificationEnum is imported from schemas
     ai_classification = Column(String(100), nullable=True) # Store enum value
     ai_summary = Column(Text, nullable=True)
     ai_extracted_entities = Column(JSONB, nullable=True, default=lambda: {}) # Default to empty dict
+    # Classification queue state. create_all doesn't alter existing tables; on an existing database
+    # add the columns (existing rows default to classified) and mark replies whose synchronous
+    # classification failed with:
+    #   ALTER TABLE email_replies ADD COLUMN IF NOT EXISTS classification_status VARCHAR(32) NOT NULL DEFAULT 'classified';
+    #   ALTER TABLE email_replies ADD COLUMN IF NOT EXISTS classification_attempts INTEGER NOT NULL DEFAULT 0;
+    #   ALTER TABLE email_replies ADD COLUMN IF NOT EXISTS classification_next_attempt_at TIMESTAMPTZ;
+    #   CREATE INDEX IF NOT EXISTS ix_email_replies_classification_status ON email_replies (classification_status);
+    #   UPDATE email_replies SET classification_status = 'classification_failed' WHERE ai_classification = 'CLASSIFICATION_FAILED';
+    classification_status = Column(String(32), default=REPLY_CLASSIFICATION_DONE, server_default=REPLY_CLASSIFICATION_DONE, nullable=False, index=True)
+    classification_attempts = Column(Integer, default=0, server_default="0", nullable=False)
+    classification_next_attempt_at = Column(DateTime(timezone=True), nullable=True) # Retry time, or lease expiry while classifying
 
     is_actioned_by_user = Column(Boolean, default=False, nullable=False)
     user_action_notes = Column(Text, nullable=True)
@@ -317,6 +370,31 @@ class EmailReply(Base):
     lead_campaign_status = relationship("LeadCampaignStatus", back_populates="email_replies")
     lead = relationship("Lead", back_populates="email_replies")
 
+
+class EmailReplyRawContent(Base):
+    """Compressed raw reply messages, content-addressed by SHA-256 and only read for the raw view."""
+    __tablename__ = "email_reply_raw_contents"
+
+    content_hash = Column(String(64), primary_key=True) # SHA-256 hex of the uncompressed UTF-8 message
+    codec = Column(String(16), nullable=False, default="zlib")
+    compressed_content = Column(LargeBinary, nullable=False)
+    original_size = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+class ReplyClassificationCache(Base):
+    """LLM reply classifications keyed by a hash of the normalized reply text, model and prompt version."""
+    __tablename__ = "reply_classification_cache"
+
+    cache_key = Column(String(64), primary_key=True) # SHA-256 hex, see reply_classifier_agent.classification_cache_keys
+    model = Column(String(100), nullable=False)
+    prompt_version = Column(String(32), nullable=False)
+    category = Column(String(100), nullable=False)
+    summary = Column(Text, nullable=True)
+    extracted_info = Column(JSONB, nullable=True, default=lambda: {})
+    hit_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True) # TTL
+    last_used_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True) # LRU eviction
+
 class Subscription(Base):
     __tablename__ = "subscriptions"
 
@@ -69,13 +69,15 @@ except ImportError as e_imp_db:
 # IMPORTANT: Ensure these agents are updated to use SQLAlchemy ORM database functions
 # and correctly handle Session objects.
 try:
-    from app.agents.emailscheduler import EmailSchedulerAgent
+    from app.agents.emailscheduler import EmailSchedulerAgent, get_email_scheduler_agent
     from app.agents.imap_reply_agent import ImapReplyAgent
+    from app.agents.imap_idle_manager import ImapIdleConnectionManager
 except ImportError as e_imp_agents:
     logger.error(f"Could not import one or more scheduler agents: {e_imp_agents}")
     # Decide if these are critical for startup. For now, allow startup but log error.
     EmailSchedulerAgent = None
     ImapReplyAgent = None
+    ImapIdleConnectionManager = None
 
 
 # API Routers/Routes
@@ -115,7 +117,7 @@ except Exception as e_routers:
 email_scheduler_agent_instance = None
 if EmailSchedulerAgent:
     try:
-        email_scheduler_agent_instance = EmailSchedulerAgent()
+        email_scheduler_agent_instance = get_email_scheduler_agent() # Shared with the /scheduler/run-cycle route
         logger.info("EmailSchedulerAgent instance created for scheduler.")
     except Exception as e_sa:
         logger.error(f"Failed to instantiate EmailSchedulerAgent: {e_sa}", exc_info=True)
@@ -174,13 +176,16 @@ except Exception as e_cors:
 # --- Scheduler Instance ---
 # ==============================================
 scheduler: Optional[AsyncIOScheduler] = None # Global scheduler instance with type hint
+due_time_loop_task: Optional[asyncio.Task] = None # Event-driven email sender, see EmailSchedulerAgent.run_due_time_loop
+imap_idle_manager = None # Persistent per-org IMAP sessions, see ImapIdleConnectionManager
+reply_classification_task: Optional[asyncio.Task] = None # Drains queued replies, see ReplyClassificationWorkerPool
 
 # ==============================================
 # --- Startup & Shutdown Events ---
 # ==============================================
 @app.on_event("startup")
 async def on_app_startup():
-    global scheduler # Allow modification of the global scheduler instance
+    global scheduler, due_time_loop_task, imap_idle_manager, reply_classification_task # Allow modification of the global scheduler instance
     logger.info("Application startup event triggered.")
 
     # 1. Database Schema Creation/Check
@@ -202,13 +207,17 @@ async def on_app_startup():
     if getattr(settings, "ENABLE_EMAIL_SCHEDULER", False) and email_scheduler_agent_instance:
         interval_send = int(getattr(settings, "EMAIL_SCHEDULER_INTERVAL_MINUTES", 5)) # Default to 5
         scheduler.add_job(
-            email_scheduler_agent_instance.run_scheduler_cycle,
+            email_scheduler_agent_instance.run_scheduler_cycle_async, # Coroutine: runs on the app's event loop without blocking it
             "interval",
             minutes=interval_send,
             id="email_sending_job",
             replace_existing=True
         )
         logger.info(f"Email sending job added to scheduler. Interval: {interval_send} minutes.")
+        if getattr(settings, "ENABLE_EMAIL_SCHEDULER_DUE_WHEEL", True):
+            # Sends as soon as emails fall due; the interval job above remains as a safety net
+            due_time_loop_task = asyncio.create_task(email_scheduler_agent_instance.run_due_time_loop())
+            logger.info("Email due-time loop started.")
     else:
         logger.info("Email sending scheduler is disabled or agent instance failed/not available.")
 
@@ -226,6 +235,16 @@ async def on_app_startup():
     else:
         logger.info("IMAP reply polling scheduler is disabled or agent instance failed/not available.")
 
+    if imap_reply_agent_instance and imap_reply_agent_instance.classification_pool:
+        # Started before any mailbox is processed so replies are queued rather than classified inline
+        reply_classification_task = asyncio.create_task(imap_reply_agent_instance.classification_pool.run())
+        logger.info("Reply classification worker pool started.")
+
+    if getattr(settings, "ENABLE_IMAP_IDLE_MODE", False) and imap_reply_agent_instance and ImapIdleConnectionManager:
+        # Replies are processed as they arrive; the interval poller covers orgs whose session is reconnecting
+        imap_idle_manager = ImapIdleConnectionManager(imap_reply_agent_instance)
+        imap_idle_manager.start()
+
     if scheduler.get_jobs(): # Start scheduler only if there are jobs
         try:
             scheduler.start()
@@ -241,6 +260,14 @@ async def on_app_startup():
 @app.on_event("shutdown")
 async def on_app_shutdown():
     logger.info("Application shutdown event triggered.")
+    if due_time_loop_task and not due_time_loop_task.done():
+        due_time_loop_task.cancel()
+        logger.info("Email due-time loop cancelled.")
+    if imap_idle_manager:
+        await asyncio.to_thread(imap_idle_manager.stop) # Joins the session threads
+    if reply_classification_task and not reply_classification_task.done():
+        reply_classification_task.cancel() # Replies it had claimed are reclaimed once their lease expires
+        logger.info("Reply classification worker pool cancelled.")
     if scheduler and scheduler.running:
         try:
             scheduler.shutdown(wait=False) # wait=False for potentially quicker shutdown in some envs
@@ -132,6 +132,27 @@ async def get_dashboard_actionable_replies(
     return actionable_items
 
 
+@router.get("/replies/{reply_id}/raw", response_model=schemas.EmailReplyRawContentResponse)
+async def get_dashboard_reply_raw_content(
+    reply_id: int,
+    db: Session = Depends(db_ops.get_db),
+    current_user: UserModel = Depends(get_current_active_user)
+):
+    """
+    Returns the full raw message of one reply. Raw messages are stored compressed outside
+    the email_replies table and are only loaded here, when a user opens the raw view.
+    """
+    if not current_user.organization_id:
+        logger.warning(f"API: User {current_user.email} (ID: {current_user.id}) has no organization_id for reply raw content.")
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User not associated with an organization")
+
+    org_id = current_user.organization_id
+    raw_message = db_ops.get_email_reply_raw_text(db, reply_id=reply_id, organization_id=org_id)
+    if raw_message is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Raw message not found for this reply.")
+    return schemas.EmailReplyRawContentResponse(reply_id=reply_id, raw_message=raw_message)
+
+
 # --- Placeholder for Campaign Performance Summary ---
 # @router.get("/campaign_performance_summary", response_model=List[schemas.CampaignPerformanceSummaryItem])
 # async def get_dashboard_campaign_performance(
@@ -1,11 +1,15 @@
 from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
 from typing import Any, List, Optional, Dict
+from sqlalchemy.orm import Session
 
 # Import project modules
 from app.auth.dependencies import get_current_user # Secure the endpoint (optional, could be admin-only)
 from app.schemas import UserPublic # For type hinting current_user
 # Import the agent containing the cycle logic
-from app.agents.emailscheduler import EmailSchedulerAgent
+from app.agents.emailscheduler import get_email_scheduler_agent
+from app.agents.reply_classifier_agent import classification_cache_stats
+from app.db import database
+from app.db.database import get_db
 from app.utils.logger import logger
 
 # Define Router
@@ -28,13 +32,58 @@ async def trigger_scheduler_cycle(
     """
     logger.info("API: Received request to trigger scheduler cycle.")
 
-    def run_cycle_in_background():
+    async def run_cycle_in_background():
         try:
-            scheduler = EmailSchedulerAgent()
-            scheduler.run_scheduler_cycle()
+            # The app's own agent: shares its rate budgets and is skipped if a cycle is already running
+            await get_email_scheduler_agent().run_scheduler_cycle_async()
         except Exception as e:
             logger.error(f"Error running scheduler cycle in background: {e}", exc_info=True)
 
     background_tasks.add_task(run_cycle_in_background)
 
     return {"message": "Scheduler cycle trigger request accepted. Processing runs in background."}
+
+
+# Endpoint to inspect scheduling lag without running a cycle
+@router.get("/backlog")
+def get_scheduler_backlog(
+    db: Session = Depends(get_db),
+    # current_user: UserPublic = Depends(get_current_user)
+):
+    """
+    Returns how many lead campaign statuses are due right now and how long the
+    oldest one has been waiting (in seconds).
+    """
+    backlog = database.get_due_backlog_stats(db)
+    if backlog is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to read scheduler backlog.")
+    return backlog
+
+
+# Endpoint to monitor how many reply classifications are served without an LLM call
+@router.get("/reply-classification-cache")
+def get_reply_classification_cache_stats(
+    db: Session = Depends(get_db),
+    # current_user: UserPublic = Depends(get_current_user)
+):
+    """
+    Returns this process's reply classification cache hits, misses and hit rate since
+    startup, plus the number of cached classifications.
+    """
+    return {**classification_cache_stats.snapshot(), "entries": database.count_reply_classification_cache_entries(db)}
+
+
+# Endpoint to monitor the reply classification queue drained by ReplyClassificationWorkerPool
+@router.get("/reply-classification-queue")
+def get_reply_classification_queue_stats(
+    db: Session = Depends(get_db),
+    # current_user: UserPublic = Depends(get_current_user)
+):
+    """
+    Returns the number of replies waiting for classification, being classified and whose
+    classification failed for good.
+    """
+    counts = database.count_email_replies_by_classification_status(db)
+    if counts is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to read reply classification queue.")
+    return counts
@@ -337,6 +337,10 @@ class ActionableReply(BaseModel):
     latest_reply_snippet: Optional[str] = None
     model_config = {"from_attributes": True}
 
+class EmailReplyRawContentResponse(BaseModel):
+    reply_id: int
+    raw_message: str
+
 class CampaignPerformanceSummaryItem(BaseModel):
     campaign_id: int
     campaign_name: str
@@ -6,7 +6,7 @@ from dotenv import load_dotenv
 from pathlib import Path
 import warnings
 from pydantic import Field # Keep this if used elsewhere
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 # Determine the base directory of the project
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
@@ -72,8 +72,53 @@ class Settings(BaseSettings):
 
     ENABLE_EMAIL_SCHEDULER: bool = Field(default=True, description="Enable the periodic email sending worker")
     EMAIL_SCHEDULER_INTERVAL_MINUTES: int = Field(default=5, gt=0, description="How often the email sender runs")
+    EMAIL_SEND_MAX_CONCURRENCY: int = Field(default=10, gt=0, description="Maximum emails the scheduler sends in parallel")
+    EMAIL_SEND_MAX_CONCURRENCY_PER_ORG: int = Field(default=2, gt=0, description="Maximum emails sent in parallel for a single organization")
+    EMAIL_SEND_RATE_PER_ORG_PER_MINUTE: float = Field(default=60, gt=0, description="Sustained send rate allowed per organization")
+    EMAIL_SEND_BURST_PER_ORG: float = Field(default=20, ge=1, description="Sends an organization may burst above its sustained rate")
+    EMAIL_SEND_RATE_PER_HOST_PER_MINUTE: float = Field(default=300, gt=0, description="Sustained send rate allowed per SMTP host / provider")
+    EMAIL_SEND_BURST_PER_HOST: float = Field(default=50, ge=1, description="Sends an SMTP host / provider may burst above its sustained rate")
+    SMTP_POOL_MAX_MESSAGES_PER_CONNECTION: int = Field(default=100, gt=0, description="Recycle a pooled SMTP session after this many messages")
+    SMTP_POOL_MAX_IDLE_SECONDS: int = Field(default=60, gt=0, description="Close pooled SMTP sessions idle for longer than this")
+    EMAIL_SCHEDULER_STATUS_FLUSH_ROWS: int = Field(default=200, gt=0, description="Flush buffered lead status updates after this many rows")
+    EMAIL_SCHEDULER_STATUS_FLUSH_INTERVAL_MS: int = Field(default=1000, gt=0, description="Flush buffered lead status updates at least this often")
+    EMAIL_SCHEDULER_CLAIM_LEASE_SECONDS: int = Field(default=600, gt=0, description="How long a scheduler worker holds claimed lead statuses before other workers may take them over")
+    EMAIL_SCHEDULER_CLAIM_BATCH_SIZE: int = Field(default=500, gt=0, description="Lead statuses claimed per scheduler batch")
+    EMAIL_SCHEDULER_TIER_WEIGHTS: Dict[str, float] = Field(default_factory=dict, description="Fair-share weight per subscription tier, keyed by Stripe price ID (JSON); unlisted tiers and orgs without a subscription weigh 1.0")
+    EMAIL_SCHEDULER_DRAIN_MODE: bool = Field(default=False, description="Keep claiming batches within a cycle until nothing is due or the drain time budget is spent")
+    EMAIL_SCHEDULER_DRAIN_TIME_BUDGET_SECONDS: int = Field(default=240, gt=0, description="Maximum time one draining scheduler cycle may keep claiming new batches")
+    EMAIL_SCHEDULER_BACKLOG_STATS_INTERVAL_SECONDS: float = Field(default=300, gt=0, description="How often a scheduler cycle logs due-backlog stats (every cycle with debug logging)")
+    ENABLE_EMAIL_SCHEDULER_DUE_WHEEL: bool = Field(default=True, description="Wake the email sender when the next email is due instead of only on the fixed interval")
+    EMAIL_SCHEDULER_DEFERRED_RETRY_SECONDS: float = Field(default=30, gt=0, description="Rate-deferred sends are retried no sooner than this, on a shared grid of this many seconds so their wake-ups coalesce")
+    EMAIL_SCHEDULER_WHEEL_HORIZON_SECONDS: int = Field(default=900, gt=0, description="How far ahead the in-process due-time wheel tracks upcoming sends")
     ENABLE_IMAP_REPLY_POLLER: bool = Field(default=True, description="Enable the periodic IMAP reply poller")
     IMAP_POLLER_INTERVAL_MINUTES: int = Field(default=10, gt=0, description="How often the IMAP poller runs")
+    IMAP_POLL_MAX_WORKERS: int = Field(default=8, gt=0, description="Organizations whose inboxes are polled in parallel")
+    IMAP_TIMEOUT_SECONDS: float = Field(default=30, gt=0, description="Socket timeout for each organization's IMAP connection")
+    IMAP_FETCH_BATCH_SIZE: int = Field(default=200, gt=0, description="Messages requested per IMAP UID FETCH command")
+    IMAP_MAX_TEXT_PART_BYTES: int = Field(default=262144, gt=0, description="Most bytes of a reply's text part downloaded for classification")
+    ENABLE_RULE_BASED_REPLY_CLASSIFICATION: bool = Field(default=True, description="Classify unambiguous replies (auto-replies, unsubscribes, acknowledgements) with rules instead of the LLM")
+    ENABLE_REPLY_CLASSIFICATION_CACHE: bool = Field(default=True, description="Reuse LLM classifications of identical replies (same model and prompt version)")
+    REPLY_CLASSIFICATION_CACHE_TTL_DAYS: float = Field(default=30, gt=0, description="How long a cached reply classification stays valid")
+    REPLY_CLASSIFICATION_CACHE_MAX_ENTRIES: int = Field(default=50000, gt=0, description="Cached reply classifications kept; least recently used entries are evicted")
+    ENABLE_REPLY_CLASSIFICATION_WORKERS: bool = Field(default=True, description="Queue replies for a background worker pool instead of classifying them inside the IMAP loop")
+    REPLY_CLASSIFICATION_MAX_CONCURRENCY: int = Field(default=8, gt=0, description="LLM classifications the worker pool runs at once")
+    REPLY_CLASSIFICATION_MAX_ATTEMPTS: int = Field(default=5, gt=0, description="Classification attempts per reply before it is marked CLASSIFICATION_FAILED")
+    REPLY_CLASSIFICATION_RETRY_DELAY_SECONDS: float = Field(default=30, gt=0, description="Delay before the first classification retry; doubles with each further attempt")
+    REPLY_CLASSIFICATION_BATCH_SIZE: int = Field(default=10, gt=0, description="Queued replies classified per LLM request (1 sends each reply on its own)")
+    REPLY_CLASSIFICATION_BATCH_MAX_CHARS: int = Field(default=16000, gt=0, description="Most reply text packed into one batch classification request")
+    REPLY_CLASSIFICATION_BATCH_WAIT_SECONDS: float = Field(default=2, ge=0, description="How long the worker pool lets newly queued replies accumulate into a batch before claiming them")
+    REPLY_CLASSIFICATION_LEASE_SECONDS: float = Field(default=600, gt=0, description="How long a claimed reply is reserved for one worker before others may claim it again")
+    REPLY_CLASSIFICATION_POLL_INTERVAL_SECONDS: float = Field(default=15, gt=0, description="How often the worker pool checks for queued replies and due retries when not notified")
+    REPLY_CLEANER_MAX_SCAN_BYTES: int = Field(default=65536, gt=0, description="Most of a reply's text scanned for quoted history and signatures; the rest is ignored")
+    IMAP_MESSAGE_ID_CACHE_SIZE: int = Field(default=10000, ge=0, description="Resolved reply Message-IDs cached per organization (0 disables the cache)")
+    IMAP_MESSAGE_ID_MISS_TTL_SECONDS: float = Field(default=3600, gt=0, description="How long a Message-ID that matched no outgoing email is remembered as a miss")
+    IMAP_POLL_CYCLE_BUDGET_SECONDS: float = Field(default=300, gt=0, description="Time budget for one IMAP polling cycle across all organizations")
+    ENABLE_IMAP_IDLE_MODE: bool = Field(default=False, description="Keep a persistent IMAP connection per organization and process replies as they arrive (IDLE, else NOOP polling)")
+    IMAP_IDLE_TIMEOUT_SECONDS: float = Field(default=1500, gt=0, description="Longest a single IMAP IDLE command is held before it is re-issued (capped at 29 minutes)")
+    IMAP_IDLE_NOOP_INTERVAL_SECONDS: float = Field(default=30, gt=0, description="NOOP polling interval for servers without IDLE")
+    IMAP_IDLE_ORG_REFRESH_SECONDS: float = Field(default=300, gt=0, description="How often the IDLE manager re-reads which organizations have reply detection enabled")
+    IMAP_IDLE_MAX_RECONNECT_DELAY_SECONDS: float = Field(default=300, gt=0, description="Upper bound of the reconnect backoff for a dropped IDLE session")
 
     STRIPE_PUBLISHABLE_KEY: Optional[str] = os.getenv("STRIPE_PUBLISHABLE_KEY")
     STRIPE_SECRET_KEY: Optional[str] = os.getenv("STRIPE_SECRET_KEY")
@@ -0,0 +1,122 @@
+# app/utils/due_time_wheel.py
+
+import asyncio
+import heapq
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.utils.config import settings
+from app.utils.logger import logger
+
+
+def _timestamp(due_at: Optional[datetime]) -> float:
+    if due_at is None:
+        return time.time() # Never-sent step 0 rows are due immediately
+    if due_at.tzinfo is None:
+        due_at = due_at.replace(tzinfo=timezone.utc)
+    return due_at.timestamp()
+
+
+class DueTimeWheel:
+    """
+    In-process min-heap of upcoming next_email_due_at times, keyed by lead_campaign_status id,
+    covering the next horizon_seconds. It is loaded in one query and kept current by
+    schedule()/discard() calls on enrollment and status changes, so the scheduler can sleep
+    until exactly the next due time instead of polling the DB.
+
+    Entries are removed lazily: _due_at holds the current due time per status and heap
+    entries that no longer match it are skipped. Safe to call from worker threads; the
+    waiting coroutine is woken through its event loop when an earlier due time arrives.
+    The DB stays the source of truth - a missed notification only delays a send until the
+    next reload or the interval safety-net cycle.
+    """
+    def __init__(self, horizon_seconds: float = 900):
+        self.horizon_seconds = horizon_seconds
+        self._lock = threading.Lock()
+        self._heap: List[Tuple[float, int]] = []
+        self._due_at: Dict[int, float] = {}
+        self._horizon_end = 0.0 # Nothing is tracked until the first load()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return len(self._due_at)
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        """Binds the wheel to the event loop of the coroutine that will wait() on it."""
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+
+    def _wake(self):
+        if self._loop is not None and self._wakeup is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def load(self, entries: Iterable[Tuple[int, Optional[datetime]]], horizon_end: datetime):
+        """Replaces the wheel's contents with (status_id, next_email_due_at) pairs due before horizon_end."""
+        due_at = {status_id: _timestamp(due) for status_id, due in entries}
+        heap = [(ts, status_id) for status_id, ts in due_at.items()]
+        heapq.heapify(heap)
+        with self._lock:
+            self._due_at = due_at
+            self._heap = heap
+            self._horizon_end = horizon_end.timestamp()
+        logger.debug(f"DueTimeWheel: Loaded {len(due_at)} due times up to {horizon_end.isoformat()}.")
+        self._wake()
+
+    def schedule(self, status_id: int, due_at: Optional[datetime]):
+        ts = _timestamp(due_at)
+        with self._lock:
+            if ts > self._horizon_end:
+                # Beyond the loaded horizon; the next reload picks it up
+                self._due_at.pop(status_id, None)
+                return
+            self._prune_head()
+            earlier_than_head = not self._heap or ts < self._heap[0][0]
+            self._due_at[status_id] = ts
+            heapq.heappush(self._heap, (ts, status_id))
+        if earlier_than_head:
+            self._wake()
+
+    def discard(self, status_id: int):
+        with self._lock:
+            self._due_at.pop(status_id, None)
+
+    def _prune_head(self):
+        while self._heap and self._due_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_due_at(self) -> Optional[float]:
+        """Epoch timestamp of the earliest tracked due time, or None if nothing is due within the horizon."""
+        with self._lock:
+            self._prune_head()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: Optional[float] = None) -> List[int]:
+        """Removes and returns the ids of every status due at or before now."""
+        now = time.time() if now is None else now
+        due_ids: List[int] = []
+        with self._lock:
+            self._prune_head()
+            while self._heap and self._heap[0][0] <= now:
+                _, status_id = heapq.heappop(self._heap)
+                if self._due_at.pop(status_id, None) is not None:
+                    due_ids.append(status_id)
+                self._prune_head()
+        return due_ids
+
+    async def wait(self, timeout: float):
+        """Sleeps for up to timeout seconds, returning early when an earlier due time is scheduled."""
+        if self._wakeup is None:
+            await asyncio.sleep(timeout)
+            return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, timeout))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._wakeup.clear()
+
+
+due_time_wheel = DueTimeWheel(horizon_seconds=float(getattr(settings, "EMAIL_SCHEDULER_WHEEL_HORIZON_SECONDS", 900)))
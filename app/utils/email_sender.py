@@ -1,69 +1,102 @@
 # app/utils/email_sender.py
 
 import smtplib
+import threading
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from typing import Dict, Optional
-from dataclasses import dataclass
+from email.utils import make_msgid
+from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
 
 # Import logger
 from app.utils.logger import logger
+from app.utils.config import settings
 # --- Import the DB function to get settings ---
 try:
-    from app.db.database import get_org_email_settings_from_db
+    from app.db.database import get_org_email_settings_from_db, SessionLocal
 except ImportError:
     logger.critical("FATAL: Could not import database function 'get_org_email_settings_from_db'. Email sending will fail.")
+    SessionLocal = None
     # Define a dummy function to prevent NameErrors later, but log critical failure
-    def get_org_email_settings_from_db(org_id: int) -> Optional[Dict]:
+    def get_org_email_settings_from_db(db: Any, organization_id: int, decrypt: bool = True) -> Optional[Dict]:
         logger.error("Dummy get_org_email_settings_from_db called - DB module import failed!")
         return None
 
+@dataclass
+class EmailSendingResult:
+    success: bool
+    message_id: Optional[str] = None # e.g., "<unique-id@yourdomain.com>"
+    error_message: Optional[str] = None
+
+_EMAIL_SETTINGS_FIELDS = (
+    "is_configured", "provider_type", "verified_sender_email", "sender_name",
+    "smtp_host", "smtp_port", "smtp_username", "smtp_password",
+)
+
+def _email_settings_as_dict(email_settings: Any) -> Optional[Dict[str, Any]]:
+    """Accepts either a settings dict or a decrypted OrganizationEmailSettings ORM object."""
+    if email_settings is None or isinstance(email_settings, dict):
+        return email_settings
+    return {field: getattr(email_settings, field, None) for field in _EMAIL_SETTINGS_FIELDS}
+
+def _load_email_settings(organization_id: int) -> Optional[Dict[str, Any]]:
+    if SessionLocal is None:
+        return None
+    db = SessionLocal()
+    try:
+        return _email_settings_as_dict(get_org_email_settings_from_db(db, organization_id, decrypt=True))
+    finally:
+        db.close()
+
 # --- Main Sending Function ---
 def send_email(
     recipient_email: str,
     subject: str,
     html_body: str,
-    organization_id: int # Required to fetch settings
-    ) -> bool:
+    organization_id: int, # Required to fetch settings
+    text_body: Optional[str] = None,
+    email_settings: Optional[Any] = None # Pre-loaded decrypted settings (dict or ORM object); fetched from DB if omitted
+    ) -> EmailSendingResult:
     """
-    Fetches organization-specific email settings from the database
-    and sends the email via the configured provider type.
+    Sends the email via the organization's configured provider type.
+    Callers that already hold the organization's decrypted email settings
+    (e.g. the scheduler's prefetched working set) pass them in to skip the DB lookup.
     """
     logger.info(f"Initiating email send for Org {organization_id} to {recipient_email}")
 
-    # 1. Get Organization's specific email settings from DB
-    # This function should return decrypted credentials
-    email_config = get_org_email_settings_from_db(organization_id)
+    # 1. Get Organization's specific email settings (decrypted credentials)
+    email_config = _email_settings_as_dict(email_settings) if email_settings is not None else _load_email_settings(organization_id)
 
     # 2. Validate Configuration
     if not email_config:
         logger.error(f"Email sending failed: Settings not found in DB for Org {organization_id}.")
-        return False
+        return EmailSendingResult(success=False, error_message="Email settings not found.")
     if not email_config.get("is_configured"):
         logger.error(f"Email sending failed: Settings not marked as configured for Org {organization_id}.")
-        return False
+        return EmailSendingResult(success=False, error_message="Email settings not configured.")
 
     provider = email_config.get("provider_type")
     sender_address = email_config.get("verified_sender_email")
-    sender_name = email_config.get("sender_name", f"Org {organization_id} Team") # Default name
+    sender_name = email_config.get("sender_name") or f"Org {organization_id} Team" # Default name
 
     if not sender_address:
          logger.error(f"Email sending failed: Verified sender address missing in settings for Org {organization_id}.")
-         return False
+         return EmailSendingResult(success=False, error_message="Verified sender address missing.")
     if not provider:
          logger.error(f"Email sending failed: Provider type missing in settings for Org {organization_id}.")
-         return False
+         return EmailSendingResult(success=False, error_message="Provider type missing.")
 
     # Basic validation of core inputs
     if not all([recipient_email, subject, html_body]):
         logger.error(f"Email sending failed for Org {organization_id}: Missing recipient, subject, or body.")
-        return False
+        return EmailSendingResult(success=False, error_message="Missing recipient, subject, or body.")
     if '@' not in recipient_email:
          logger.error(f"Invalid recipient email address: {recipient_email}")
-         return False
+         return EmailSendingResult(success=False, error_message=f"Invalid recipient email address: {recipient_email}")
     if '@' not in sender_address:
          logger.error(f"Invalid sender email address from org settings: {sender_address}")
-         return False
+         return EmailSendingResult(success=False, error_message=f"Invalid sender email address: {sender_address}")
 
 
     # 3. Route to Provider-Specific Sending Function
@@ -74,9 +107,11 @@ def send_email(
             recipient_email=recipient_email,
             subject=subject,
             html_body=html_body,
+            text_body=text_body,
             sender_address=sender_address,
             sender_name=sender_name,
-            smtp_config=email_config # Contains host, port, user, decrypted pass
+            smtp_config=email_config, # Contains host, port, user, decrypted pass
+            organization_id=organization_id
         )
     elif provider == 'ses_api': # Example if you add AWS SES API later
         return _send_with_ses_api(
@@ -91,12 +126,136 @@ def send_email(
     # Add elif for 'google_oauth', 'm365_oauth', 'sendgrid_api', etc.
     else:
         logger.error(f"Unsupported email provider type '{provider}' configured for Org {organization_id}.")
-        return False
+        return EmailSendingResult(success=False, error_message=f"Unsupported email provider type '{provider}'.")
+
+
+# --- SMTP Connection Pool ---
+@dataclass
+class _PooledSmtpConnection:
+    key: Tuple
+    server: smtplib.SMTP
+    messages_sent: int = 0
+    last_used_at: float = field(default_factory=time.monotonic)
+
+class SmtpConnectionPool:
+    """
+    Keeps authenticated SMTP sessions alive per (organization, server, user) so a batch
+    of sends costs one TCP/TLS/LOGIN handshake per org instead of one per email.
+    Idle sessions are probed with NOOP before reuse and recycled after
+    max_messages_per_connection sends or max_idle_seconds of inactivity.
+    A session is only ever used by the thread that acquired it. The scheduler closes
+    every idle session with close_all() at the end of each cycle.
+    """
+    def __init__(self, max_messages_per_connection: int = 100, max_idle_seconds: float = 60.0):
+        self.max_messages_per_connection = max_messages_per_connection
+        self.max_idle_seconds = max_idle_seconds
+        self._lock = threading.Lock()
+        self._idle: Dict[Tuple, List[_PooledSmtpConnection]] = {}
+
+    def _connect(self, key: Tuple, host: str, port: int, username: str, password: str) -> _PooledSmtpConnection:
+        if port == 465:
+            server = smtplib.SMTP_SSL(host, port, timeout=20)
+        else: # Assume STARTTLS for 587 or others
+            server = smtplib.SMTP(host, port, timeout=20)
+        try:
+            if port != 465:
+                server.starttls()
+            server.login(username, password)
+        except Exception:
+            server.close() # Don't leak the socket of a session that never became usable
+            raise
+        logger.debug(f"SMTP pool: opened new authenticated session to {host}:{port} for {username}")
+        return _PooledSmtpConnection(key=key, server=server)
+
+    def _is_stale(self, conn: _PooledSmtpConnection) -> bool:
+        return (conn.messages_sent >= self.max_messages_per_connection or
+                time.monotonic() - conn.last_used_at > self.max_idle_seconds)
 
+    @staticmethod
+    def _close(conn: _PooledSmtpConnection):
+        try: conn.server.quit()
+        except Exception:
+            try: conn.server.close()
+            except Exception: pass
+
+    @staticmethod
+    def _is_alive(conn: _PooledSmtpConnection) -> bool:
+        try:
+            code, _ = conn.server.noop()
+            return code == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def acquire(self, key: Tuple, host: str, port: int, username: str, password: str) -> _PooledSmtpConnection:
+        """Returns a live session for key, reusing an idle one when it still answers NOOP."""
+        while True:
+            with self._lock:
+                idle_list = self._idle.get(key)
+                conn = idle_list.pop() if idle_list else None
+            if conn is None:
+                return self._connect(key, host, port, username, password)
+            if not self._is_stale(conn) and self._is_alive(conn):
+                return conn
+            self._close(conn)
+
+    def release(self, conn: _PooledSmtpConnection, reusable: bool = True):
+        """Returns a session to the pool, or closes it if it is broken or has reached its message limit."""
+        conn.last_used_at = time.monotonic()
+        if not reusable or conn.messages_sent >= self.max_messages_per_connection:
+            self._close(conn)
+            return
+        with self._lock:
+            self._idle.setdefault(conn.key, []).append(conn)
+
+    def discard(self, conn: _PooledSmtpConnection):
+        self._close(conn)
+
+    def close_all(self):
+        with self._lock:
+            all_conns = [c for idle_list in self._idle.values() for c in idle_list]
+            self._idle.clear()
+        for conn in all_conns:
+            self._close(conn)
+        if all_conns:
+            logger.debug(f"SMTP pool: closed {len(all_conns)} idle session(s).")
+
+smtp_connection_pool = SmtpConnectionPool(
+    max_messages_per_connection=int(getattr(settings, "SMTP_POOL_MAX_MESSAGES_PER_CONNECTION", 100)),
+    max_idle_seconds=float(getattr(settings, "SMTP_POOL_MAX_IDLE_SECONDS", 60))
+)
+
+def _is_transient_smtp_error(e: Exception) -> bool:
+    """True for failures where a fresh session may succeed: dropped connections and 4xx (incl. 421) replies."""
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(e, smtplib.SMTPResponseException) and not isinstance(e, smtplib.SMTPAuthenticationError):
+        return 400 <= e.smtp_code < 500
+    return False
+
+def _send_envelope_and_data(server: smtplib.SMTP, sender_address: str, recipient_email: str, message_str: str, sent_state: dict):
+    """
+    smtplib's sendmail() in its three steps, so the caller knows whether a failure happened
+    before DATA: sent_state["data_started"] is set just before the message is transmitted.
+    """
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(sender_address)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, sender_address)
+    code, resp = server.rcpt(recipient_email)
+    if code not in (250, 251):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused({recipient_email: (code, resp)})
+    sent_state["data_started"] = True
+    code, resp = server.data(message_str)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
 
 # --- SMTP Sending Logic ---
-def _send_with_smtp(recipient_email: str, subject: str, html_body: str, sender_address: str, sender_name: str, smtp_config: dict) -> bool:
-    """Handles sending via standard SMTP using decrypted credentials from smtp_config."""
+def _send_with_smtp(recipient_email: str, subject: str, html_body: str, sender_address: str, sender_name: str,
+                    smtp_config: dict, text_body: Optional[str] = None, organization_id: Optional[int] = None) -> EmailSendingResult:
+    """Handles sending via standard SMTP using decrypted credentials from smtp_config, over a pooled session."""
 
     host = smtp_config.get("smtp_host")
     port = smtp_config.get("smtp_port") # Should be int
@@ -105,58 +264,71 @@ def _send_with_smtp(recipient_email: str, subject: str, html_body: str, sender_a
 
     if not all([host, port, username, password]):
          logger.error(f"SMTP configuration incomplete for sender {sender_address} via {host}. Required: host, port, username, password.")
-         return False
+         return EmailSendingResult(success=False, error_message="SMTP configuration incomplete.")
 
     logger.info(f"Attempting SMTP send via {host}:{port} from {sender_address} to {recipient_email}")
 
-    # Construct message
+    # Construct message; the Message-ID is generated here so replies can be linked back to it
+    message_id = make_msgid(domain=sender_address.split('@')[-1])
     message = MIMEMultipart("alternative")
     message["Subject"] = subject
     message["From"] = f"{sender_name} <{sender_address}>"
     message["To"] = recipient_email
+    message["Message-ID"] = message_id
     try:
+        if text_body:
+            message.attach(MIMEText(text_body, "plain", "utf-8"))
         part = MIMEText(html_body, "html", "utf-8")
         message.attach(part)
     except Exception as e:
         logger.error(f"Failed to create SMTP email body MIMEText part: {e}")
-        return False
+        return EmailSendingResult(success=False, error_message=f"Failed to build message: {e}")
 
-    # Send via SMTP
-    server = None
+    # Send via a pooled SMTP session; on a dropped session or 4xx reply before DATA, reconnect once and retry
     try:
         # Handle potential non-integer port from DB retrieval if not validated earlier
         smtp_port_int = int(port)
-        if smtp_port_int == 465:
-            server = smtplib.SMTP_SSL(host, smtp_port_int, timeout=20)
-        else: # Assume STARTTLS for 587 or others
-            server = smtplib.SMTP(host, smtp_port_int, timeout=20)
-            server.starttls()
-        server.login(username, password)
-        server.sendmail(sender_address, recipient_email, message.as_string())
-        logger.info(f"Email successfully sent via SMTP to: {recipient_email}")
-        return True
-    except smtplib.SMTPAuthenticationError as e: logger.error(f"SMTP Auth Error for {username} on {host}: {e}", exc_info=False) # Don't log password details
-    except smtplib.SMTPConnectError as e: logger.error(f"SMTP Connection Error to {host}:{port}: {e}", exc_info=True)
-    except smtplib.SMTPSenderRefused as e: logger.error(f"SMTP Sender Refused: {sender_address}. Error: {e}", exc_info=True)
-    except smtplib.SMTPRecipientsRefused as e: logger.error(f"SMTP Recipient Refused: {recipient_email}. Error: {e.recipients}", exc_info=True)
-    except smtplib.SMTPException as e: logger.error(f"SMTP Error sending to {recipient_email}: {e}", exc_info=True)
-    except ValueError as e: logger.error(f"SMTP Config Error (invalid port? {port}): {e}", exc_info=True)
-    except OSError as e: logger.error(f"Network/OS Error during SMTP connection: {e}", exc_info=True)
-    except Exception as e: logger.error(f"Unexpected SMTP error sending to {recipient_email}: {e}", exc_info=True)
-    finally:
-        if server:
-             try: server.quit()
-             except: pass
-    return False
+    except (TypeError, ValueError) as e:
+        logger.error(f"SMTP Config Error (invalid port? {port}): {e}", exc_info=True)
+        return EmailSendingResult(success=False, error_message=f"SMTP Config Error: {e}")
 
-@dataclass
-class EmailSendingResult:
-    success: bool
-    message_id: Optional[str] = None # e.g., "<unique-id@yourdomain.com>"
-    error_message: Optional[str] = None
+    pool_key = (organization_id, host, smtp_port_int, username)
+    message_str = message.as_string()
+    error_message = None
+    for attempt in (1, 2):
+        conn = None
+        sent_state = {"data_started": False}
+        try:
+            conn = smtp_connection_pool.acquire(pool_key, host, smtp_port_int, username, password)
+            _send_envelope_and_data(conn.server, sender_address, recipient_email, message_str, sent_state)
+            conn.messages_sent += 1
+            smtp_connection_pool.release(conn)
+            logger.info(f"Email successfully sent via SMTP to: {recipient_email}")
+            return EmailSendingResult(success=True, message_id=message_id)
+        except smtplib.SMTPRecipientsRefused as e:
+            # Session is still healthy (smtplib resets it); only this recipient failed
+            if conn: smtp_connection_pool.release(conn)
+            error_message = f"SMTP Recipient Refused: {e.recipients}"; logger.error(f"SMTP Recipient Refused: {recipient_email}. Error: {e.recipients}", exc_info=True)
+            break
+        except Exception as e:
+            if conn: smtp_connection_pool.discard(conn)
+            # Only failures before DATA are retried here: once the message has been transmitted
+            # the server may have accepted it even if the session then drops, and a retry on a
+            # new session could deliver it twice. Those are left to the scheduler's error handling.
+            if attempt == 1 and not sent_state["data_started"] and _is_transient_smtp_error(e):
+                logger.warning(f"SMTP transient error via {host}:{port} ({e}); reconnecting and retrying once.")
+                continue
+            if isinstance(e, smtplib.SMTPAuthenticationError): error_message = f"SMTP Auth Error: {e}"; logger.error(f"SMTP Auth Error for {username} on {host}: {e}", exc_info=False) # Don't log password details
+            elif isinstance(e, smtplib.SMTPConnectError): error_message = f"SMTP Connection Error: {e}"; logger.error(f"SMTP Connection Error to {host}:{port}: {e}", exc_info=True)
+            elif isinstance(e, smtplib.SMTPSenderRefused): error_message = f"SMTP Sender Refused: {e}"; logger.error(f"SMTP Sender Refused: {sender_address}. Error: {e}", exc_info=True)
+            elif isinstance(e, smtplib.SMTPException): error_message = f"SMTP Error: {e}"; logger.error(f"SMTP Error sending to {recipient_email}: {e}", exc_info=True)
+            elif isinstance(e, OSError): error_message = f"Network/OS Error: {e}"; logger.error(f"Network/OS Error during SMTP connection: {e}", exc_info=True)
+            else: error_message = f"Unexpected SMTP error: {e}"; logger.error(f"Unexpected SMTP error sending to {recipient_email}: {e}", exc_info=True)
+            break
+    return EmailSendingResult(success=False, error_message=error_message)
 
 # --- Placeholder for AWS SES API Sending Logic ---
-def _send_with_ses_api(recipient_email: str, subject: str, html_body: str, sender_address: str, sender_name: str, **kwargs) -> bool:
+def _send_with_ses_api(recipient_email: str, subject: str, html_body: str, sender_address: str, sender_name: str, **kwargs) -> EmailSendingResult:
     """[Placeholder] Handles sending via AWS SES API using Boto3."""
     logger.warning("SES API sending (_send_with_ses_api) not fully implemented yet.")
     # Add Boto3 imports and logic here if/when needed
@@ -170,8 +342,8 @@ def _send_with_ses_api(recipient_email: str, subject: str, html_body: str, sende
     # except NoCredentialsError: logger.error("AWS Credentials not found for SES.")
     # except ClientError as e: logger.error(f"AWS SES ClientError: {e}")
     # except Exception as e: logger.error(f"Unexpected SES error: {e}")
-    return False # Return False until implemented
+    return EmailSendingResult(success=False, error_message="SES API sending not implemented.") # Fail until implemented
 
 # --- Add placeholders for other providers as needed ---
-# def _send_with_google_oauth(...) -> bool: ...
-# def _send_with_sendgrid(...) -> bool: ...
+# def _send_with_google_oauth(...) -> EmailSendingResult: ...
+# def _send_with_sendgrid(...) -> EmailSendingResult: ...
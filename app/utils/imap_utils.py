@@ -0,0 +1,183 @@
+# app/utils/imap_utils.py
+
+import base64
+import binascii
+import html
+import quopri
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from app.utils.logger import logger
+
+_FETCH_UID_PATTERN = re.compile(rb'UID (\d+)')
+_LITERAL_MARKER_PATTERN = re.compile(rb'\{(\d+)\}$')
+_SEXP_TOKEN_PATTERN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+
+def compress_uid_set(uids: List[int]) -> str:
+    """Renders UIDs as an IMAP sequence set, collapsing runs: [1, 2, 3, 7] -> "1:3,7"."""
+    runs: List[List[int]] = []
+    for uid in sorted(set(uids)):
+        if runs and uid == runs[-1][1] + 1:
+            runs[-1][1] = uid
+        else:
+            runs.append([uid, uid])
+    return ",".join(f"{first}:{last}" if first != last else str(first) for first, last in runs)
+
+
+def parse_uid_fetch_literals(fetch_data: List[Any]) -> Dict[int, bytes]:
+    """
+    Maps UID -> literal from an imaplib UID FETCH response that requests one literal per message.
+    Servers may send the UID before the literal (inside the tuple) or after it (in the
+    trailing bytes item), so both positions are handled.
+    """
+    literals: Dict[int, bytes] = {}
+    pending_literal: Optional[bytes] = None
+    for item in fetch_data:
+        if isinstance(item, tuple) and len(item) == 2:
+            uid_match = _FETCH_UID_PATTERN.search(item[0])
+            if uid_match:
+                literals[int(uid_match.group(1))] = item[1]
+                pending_literal = None
+            else:
+                pending_literal = item[1]
+        elif isinstance(item, bytes) and pending_literal is not None:
+            uid_match = _FETCH_UID_PATTERN.search(item)
+            if uid_match:
+                literals[int(uid_match.group(1))] = pending_literal
+            pending_literal = None
+    return literals
+
+
+def _parse_sexp(data: bytes) -> List[Any]:
+    """
+    Parses an IMAP parenthesized response into nested lists of str (NIL -> None).
+    Returns the top-level items, e.g. b'1 (UID 5 FLAGS ())' -> ['1', ['UID', '5', 'FLAGS', []]].
+    """
+    stack: List[List[Any]] = [[]]
+    position = 0
+    while position < len(data):
+        match = _SEXP_TOKEN_PATTERN.match(data, position)
+        if not match:
+            if data[position:].strip():
+                raise ValueError(f"Unparseable IMAP response near: {data[position:position + 40]!r}")
+            break
+        position = match.end()
+        opening, closing, quoted, atom = match.groups()
+        if opening:
+            stack.append([])
+        elif closing:
+            if len(stack) == 1:
+                raise ValueError("Unbalanced ')' in IMAP response")
+            finished = stack.pop()
+            stack[-1].append(finished)
+        elif quoted is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted).decode('utf-8', 'replace'))
+        else:
+            stack[-1].append(None if atom.upper() == b"NIL" else atom.decode('ascii', 'replace'))
+    if len(stack) != 1:
+        raise ValueError("Unbalanced '(' in IMAP response")
+    return stack[0]
+
+
+def parse_uid_fetch_items(fetch_data: List[Any]) -> Dict[int, Dict[str, Any]]:
+    """
+    Maps UID -> {item name: value} for a UID FETCH of non-literal items such as BODYSTRUCTURE.
+    Literals embedded in the response (e.g. non-ASCII attachment names) are inlined as strings.
+    """
+    stream = b""
+    for item in fetch_data:
+        if isinstance(item, tuple) and len(item) == 2:
+            prefix, literal = item
+            quoted = b'"' + literal.replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+            stream += _LITERAL_MARKER_PATTERN.sub(lambda _: quoted, prefix.rstrip())
+        elif isinstance(item, bytes):
+            stream += b" " + item
+
+    items_by_uid: Dict[int, Dict[str, Any]] = {}
+    for message_items in _parse_sexp(stream):
+        if not isinstance(message_items, list): # Message sequence numbers between the item lists
+            continue
+        fetched = {str(message_items[index]).upper(): message_items[index + 1] for index in range(0, len(message_items) - 1, 2)}
+        if fetched.get("UID", "").isdigit():
+            items_by_uid[int(fetched["UID"])] = fetched
+    return items_by_uid
+
+
+@dataclass(frozen=True)
+class TextPartLocation:
+    """Where a message's readable text lives, from its BODYSTRUCTURE."""
+    section: str # e.g. "1", "1.1"; usable as BODY.PEEK[<section>]
+    subtype: str # "plain" or "html"
+    charset: str
+    encoding: str # Content-Transfer-Encoding, e.g. "base64"
+    size: int
+
+
+def _text_parts(bodystructure: List[Any], section_prefix: str = ""):
+    """Yields (TextPartLocation, is_attachment) for every text/* leaf, depth first."""
+    if bodystructure and isinstance(bodystructure[0], list): # multipart: child parts, then subtype and extensions
+        children = []
+        for part in bodystructure:
+            if not isinstance(part, list):
+                break
+            children.append(part)
+        for index, child in enumerate(children, start=1):
+            yield from _text_parts(child, f"{section_prefix}{index}.")
+        return
+    if len(bodystructure) < 7 or str(bodystructure[0]).lower() != "text":
+        return # Non-text leaf (attachments, images, message/rfc822): never fetched
+    params = bodystructure[2] if isinstance(bodystructure[2], list) else []
+    param_map = {str(params[i]).lower(): params[i + 1] for i in range(0, len(params) - 1, 2)}
+    disposition = bodystructure[9] if len(bodystructure) > 9 and isinstance(bodystructure[9], list) else None
+    is_attachment = bool(disposition) and str(disposition[0]).lower() == "attachment"
+    yield TextPartLocation(
+        section=section_prefix.rstrip(".") or "1", # A single-part message's body is section 1
+        subtype=str(bodystructure[1]).lower(),
+        charset=param_map.get("charset") or "utf-8",
+        encoding=str(bodystructure[5] or "7bit").lower(),
+        size=int(bodystructure[6]) if str(bodystructure[6]).isdigit() else 0,
+    ), is_attachment
+
+
+def find_text_part(bodystructure: List[Any]) -> Optional[TextPartLocation]:
+    """The first inline text/plain part, else the first inline text/html part, else None."""
+    inline_parts = [part for part, is_attachment in _text_parts(bodystructure) if not is_attachment]
+    for wanted_subtype in ("plain", "html"):
+        for part in inline_parts:
+            if part.subtype == wanted_subtype:
+                return part
+    return None
+
+
+def decode_text_part(data: bytes, location: TextPartLocation) -> str:
+    """Undoes the part's Content-Transfer-Encoding and charset; tolerates a truncated (partial) fetch."""
+    if location.encoding == "base64":
+        compact = re.sub(rb'[^A-Za-z0-9+/=]', b'', data)
+        try:
+            data = base64.b64decode(compact[:len(compact) // 4 * 4])
+        except (binascii.Error, ValueError) as e:
+            logger.warning(f"IMAP: Could not base64-decode text part {location.section}: {e}")
+            return ""
+    elif location.encoding == "quoted-printable":
+        data = quopri.decodestring(data)
+    try:
+        return data.decode(location.charset, 'replace')
+    except LookupError:
+        return data.decode('latin1', 'replace')
+
+
+_HTML_DROP_PATTERN = re.compile(r'<(script|style|head)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+_HTML_BREAK_PATTERN = re.compile(r'<\s*(br|/p|/div|/li|/tr|/h[1-6])\b[^>]*>', re.IGNORECASE)
+_HTML_BLOCKQUOTE_PATTERN = re.compile(r'<blockquote\b.*?</blockquote\s*>', re.IGNORECASE | re.DOTALL)
+_HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+
+
+def html_to_text(html_body: str) -> str:
+    """Plain-text rendering of an HTML reply; quoted history (<blockquote>) is dropped."""
+    text = _HTML_DROP_PATTERN.sub('', html_body)
+    text = _HTML_BLOCKQUOTE_PATTERN.sub('', text)
+    text = _HTML_BREAK_PATTERN.sub('\n', text)
+    text = html.unescape(_HTML_TAG_PATTERN.sub('', text))
+    return re.sub(r'\n\s*\n\s*\n+', '\n\n', text).strip()
@@ -0,0 +1,63 @@
+# app/utils/message_id_cache.py
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+
+class MessageIdLinkCache:
+    """
+    Per-organization LRU of recently resolved reply Message-IDs: the link (lead, campaign,
+    status, outgoing log) for ids that matched an outgoing email, and a miss marker for ids
+    that did not. Replies in the same thread keep referencing the same ids, so most lookups
+    after the first are answered without touching the DB.
+
+    Misses expire after miss_ttl_seconds, so an id looked up before its outgoing_email_log row
+    was written (the scheduler logs sends in batches) is eventually re-checked.
+    """
+    def __init__(self, max_entries_per_org: int = 10000, miss_ttl_seconds: float = 3600):
+        self.max_entries_per_org = max_entries_per_org
+        self.miss_ttl_seconds = miss_ttl_seconds
+        self._lock = threading.Lock()
+        # org_id -> message_id -> (link or None for a miss, monotonic time cached)
+        self._entries: Dict[int, "OrderedDict[str, Tuple[Optional[Dict[str, Any]], float]]"] = {}
+
+    def lookup(self, organization_id: int, message_ids: Iterable[str]) -> Tuple[Dict[str, Dict[str, Any]], set]:
+        """Returns (links for cached hits, ids cached as misses); ids in neither must be resolved."""
+        hits: Dict[str, Dict[str, Any]] = {}
+        misses: set = set()
+        now = time.monotonic()
+        with self._lock:
+            org_entries = self._entries.get(organization_id)
+            if not org_entries:
+                return hits, misses
+            for message_id in message_ids:
+                entry = org_entries.get(message_id)
+                if entry is None:
+                    continue
+                link, cached_at = entry
+                if link is None and now - cached_at > self.miss_ttl_seconds:
+                    del org_entries[message_id]
+                    continue
+                org_entries.move_to_end(message_id)
+                if link is None:
+                    misses.add(message_id)
+                else:
+                    hits[message_id] = link
+        return hits, misses
+
+    def store(self, organization_id: int, resolved: Dict[str, Dict[str, Any]], missing: Iterable[str]):
+        if self.max_entries_per_org <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            org_entries = self._entries.setdefault(organization_id, OrderedDict())
+            for message_id, link in resolved.items():
+                org_entries[message_id] = (link, now)
+                org_entries.move_to_end(message_id)
+            for message_id in missing:
+                org_entries[message_id] = (None, now)
+                org_entries.move_to_end(message_id)
+            while len(org_entries) > self.max_entries_per_org:
+                org_entries.popitem(last=False)
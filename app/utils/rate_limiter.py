@@ -0,0 +1,86 @@
+# app/utils/rate_limiter.py
+
+import threading
+import time
+from typing import Dict, Hashable, Optional
+
+from app.utils.logger import logger
+
+
+class TokenBucket:
+    """
+    Classic token bucket: refills at rate_per_second up to capacity tokens.
+    try_consume never sleeps; it just reports whether budget is available.
+    """
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate_per_second)
+            self.updated_at = now
+
+    def available(self, now: Optional[float] = None) -> float:
+        self._refill(now if now is not None else time.monotonic())
+        return self.tokens
+
+    def seconds_until(self, tokens: float, now: Optional[float] = None) -> float:
+        """How long until the bucket holds tokens (capped at its capacity); 0 if it already does."""
+        missing = min(tokens, self.capacity) - self.available(now)
+        return max(0.0, missing / self.rate_per_second) if self.rate_per_second > 0 else 0.0
+
+    def try_consume(self, tokens: float = 1.0, now: Optional[float] = None) -> bool:
+        if self.available(now) >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+
+class SendRateLimiter:
+    """
+    Per-organization and per-SMTP-host (or provider) send budgets.
+    A send is allowed only if both the org bucket and the host bucket have a token;
+    tokens are taken from both atomically so a refusal never consumes budget.
+    """
+    def __init__(self, org_rate_per_minute: float, org_burst: float,
+                 host_rate_per_minute: float, host_burst: float):
+        self.org_rate_per_minute = org_rate_per_minute
+        self.org_burst = org_burst
+        self.host_rate_per_minute = host_rate_per_minute
+        self.host_burst = host_burst
+        self._lock = threading.Lock()
+        self._org_buckets: Dict[Hashable, TokenBucket] = {}
+        self._host_buckets: Dict[Hashable, TokenBucket] = {}
+
+    @staticmethod
+    def _bucket(buckets: Dict[Hashable, TokenBucket], key: Hashable, rate_per_minute: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate_per_second=rate_per_minute / 60.0, capacity=burst)
+        return bucket
+
+    def try_acquire(self, organization_id: int, host_key: Optional[str]) -> bool:
+        host_key = (host_key or "unknown").lower()
+        with self._lock:
+            now = time.monotonic()
+            org_bucket = self._bucket(self._org_buckets, organization_id, self.org_rate_per_minute, self.org_burst)
+            host_bucket = self._bucket(self._host_buckets, host_key, self.host_rate_per_minute, self.host_burst)
+            if org_bucket.available(now) < 1 or host_bucket.available(now) < 1:
+                logger.debug(f"SendRateLimiter: Budget exhausted for Org {organization_id} / host '{host_key}'.")
+                return False
+            org_bucket.try_consume(1, now)
+            host_bucket.try_consume(1, now)
+            return True
+
+    def seconds_until_available(self, organization_id: int, host_key: Optional[str], sends: int = 1) -> float:
+        """How long until both the org and host buckets have budget for sends sends (each capped at its burst)."""
+        host_key = (host_key or "unknown").lower()
+        with self._lock:
+            now = time.monotonic()
+            org_bucket = self._bucket(self._org_buckets, organization_id, self.org_rate_per_minute, self.org_burst)
+            host_bucket = self._bucket(self._host_buckets, host_key, self.host_rate_per_minute, self.host_burst)
+            return max(org_bucket.seconds_until(sends, now), host_bucket.seconds_until(sends, now))
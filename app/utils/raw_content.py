@@ -0,0 +1,33 @@
+# app/utils/raw_content.py
+
+import hashlib
+import zlib
+from dataclasses import dataclass
+
+RAW_CONTENT_CODEC_ZLIB = "zlib"
+_ZLIB_LEVEL = 6 # Raw email text compresses 3-5x here; higher levels buy little for the extra CPU
+
+
+@dataclass(frozen=True)
+class CompressedRawContent:
+    """A raw message ready for email_reply_raw_contents, addressed by the SHA-256 of its UTF-8 bytes."""
+    content_hash: str
+    codec: str
+    data: bytes
+    original_size: int
+
+
+def compress_raw_content(raw_text: str) -> CompressedRawContent:
+    raw_bytes = raw_text.encode("utf-8", "replace")
+    return CompressedRawContent(
+        content_hash=hashlib.sha256(raw_bytes).hexdigest(),
+        codec=RAW_CONTENT_CODEC_ZLIB,
+        data=zlib.compress(raw_bytes, _ZLIB_LEVEL),
+        original_size=len(raw_bytes),
+    )
+
+
+def decompress_raw_content(codec: str, data: bytes) -> str:
+    if codec != RAW_CONTENT_CODEC_ZLIB:
+        raise ValueError(f"Unknown raw content codec: {codec}")
+    return zlib.decompress(data).decode("utf-8", "replace")
@@ -0,0 +1,108 @@
+# app/utils/reply_text_cleaner.py
+
+import re
+from typing import Optional
+
+# Only the top of a reply matters; quoted history below this is never scanned
+DEFAULT_MAX_SCAN_CHARS = 65536
+
+# Patterns are compiled once, anchored at line starts and built from disjoint character
+# classes, so a scan is linear in the text scanned; no input can make them backtrack.
+# Markers are matched case-sensitively, as mail clients write them; IGNORECASE doubled the scan time.
+
+_ATTRIBUTION_STARTS = r"On|Am|Le|El|Il giorno|Il|Op|Em|Den|På|Dne|W dniu|В"
+_OUTLOOK_FROM_LABELS = r"From|Von|De|Da|Van|Från|Fra|Od|От"
+_ORIGINAL_MESSAGE_LABELS = (
+    r"Original [Mm]essage|Forwarded [Mm]essage|Ursprüngliche Nachricht|Weitergeleitete Nachricht|Message d'origine"
+    r"|Mensaje original|Messaggio originale|Oorspronkelijk bericht|Ursprungligt meddelande|Oprindelig meddelelse"
+    r"|Opprinnelig melding|Originalnachricht|Mensagem original"
+)
+_MOBILE_SIGNATURES = r"Sent from my|Get Outlook for|Envoyé de mon|Enviado desde mi|Von meinem"
+
+# One pass finds every line that may start the quoted original or the signature; the few
+# candidates are then confirmed individually. Anchoring on a literal "\n" (the text is scanned
+# with one prepended) lets the regex engine skip to line starts instead of trying every offset.
+_CANDIDATE_PATTERN = re.compile(
+    rf"\n[ \t]*(?:"
+    rf"(?P<attribution>(?:{_ATTRIBUTION_STARTS})[ \t])"
+    rf"|(?P<outlook>\*?(?:{_OUTLOOK_FROM_LABELS})[ \t]?\*?:)"
+    rf"|(?P<separator>-{{2,}}[ \t]?(?:{_ORIGINAL_MESSAGE_LABELS})[ \t]?-{{2,}}[ \t]*$|_{{10,}}[ \t]*$|--[ \t]*$)"
+    rf"|(?P<mobile>(?:{_MOBILE_SIGNATURES})[ \t]\w)"
+    rf")",
+    re.MULTILINE
+)
+# "... wrote:" at the end of an attribution, matched against the lowercased line (much faster
+# than IGNORECASE); German puts the sender after "schrieb"
+_ATTRIBUTION_END_PATTERN = re.compile(
+    r"(?:wrote|schrieb|a écrit|escribió|ha scritto|schreef|escreveu|skrev|napsal|napisał|написал)(?:[ \t][^:\n]{1,160})?[ \t]?:$"
+)
+_MAX_ATTRIBUTION_TAIL_CHARS = 240 # "wrote:" is only looked for in this much of the attribution's end
+# Outlook header blocks: "From:" followed within a few lines by "Sent:" (or "Date:")
+_OUTLOOK_SENT_PATTERN = re.compile(
+    r"^[ \t]*\*?(?:Sent|Date|Gesendet|Datum|Envoyé|Enviado|Fecha|Inviato|Data|Verzonden|Skickat|Sendt|Wysłano|Отправлено)[ \t]?\*?:",
+    re.MULTILINE
+)
+_OUTLOOK_HEADER_LOOKAHEAD_LINES = 4
+_QUOTED_LINE_PATTERN = re.compile(r"\n[ \t]*>[^\n]*") # Also scanned with a prepended "\n"
+
+
+def _line_end(text: str, start: int) -> int:
+    end = text.find("\n", start)
+    return len(text) if end == -1 else end
+
+
+def _ends_attribution(text: str, start: int, end: int) -> bool:
+    tail = text[max(start, end - _MAX_ATTRIBUTION_TAIL_CHARS):end].rstrip().lower()
+    return _ATTRIBUTION_END_PATTERN.search(tail) is not None
+
+
+def _is_attribution(text: str, line_start: int) -> bool:
+    line_end = _line_end(text, line_start)
+    if _ends_attribution(text, line_start, line_end):
+        return True
+    if line_end >= len(text):
+        return False
+    # Gmail wraps long attributions onto a second line
+    next_end = _line_end(text, line_end + 1)
+    return next_end - line_end <= _MAX_ATTRIBUTION_TAIL_CHARS and _ends_attribution(text, line_end + 1, next_end)
+
+
+def _is_outlook_header(text: str, line_start: int) -> bool:
+    lookahead_start = lookahead_end = _line_end(text, line_start) + 1
+    for _ in range(_OUTLOOK_HEADER_LOOKAHEAD_LINES):
+        if lookahead_end >= len(text):
+            break
+        lookahead_end = _line_end(text, lookahead_end) + 1
+    return _OUTLOOK_SENT_PATTERN.search(text, lookahead_start, lookahead_end) is not None
+
+
+def find_quoted_history_start(text: str) -> Optional[int]:
+    """Offset of the first line that starts the quoted original or the signature, or None."""
+    for candidate in _CANDIDATE_PATTERN.finditer("\n" + text):
+        line_start = candidate.start() # The matched "\n" sits one character before the line in text
+        kind = candidate.lastgroup
+        if kind == "attribution" and not _is_attribution(text, line_start):
+            continue
+        if kind == "outlook" and not _is_outlook_header(text, line_start):
+            continue
+        return line_start
+    return None
+
+
+def clean_reply_text(text: str, max_scan_chars: int = DEFAULT_MAX_SCAN_CHARS) -> str:
+    """
+    The new part of a reply: cut at the first quoted-original marker (attribution line,
+    Outlook header block, "Original Message" separator) or signature delimiter, with
+    ">"-quoted lines dropped. Only the first max_scan_chars characters are scanned.
+    """
+    if not text:
+        return ""
+    text = text[:max_scan_chars]
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    cut = find_quoted_history_start(text)
+    if cut is not None:
+        text = text[:cut]
+    if ">" in text: # Inline-quoted lines; the answers between them are kept
+        text = _QUOTED_LINE_PATTERN.sub("", "\n" + text)
+    return text.strip()
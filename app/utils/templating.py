@@ -0,0 +1,100 @@
+# app/utils/templating.py
+
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from app.utils.logger import logger
+
+# Placeholders the email personalization knows how to fill, e.g. {{lead_first_name}}
+KNOWN_PLACEHOLDERS = frozenset({
+    "lead_name", "lead_first_name", "company_name", "title", "industry", "location",
+})
+
+_PLACEHOLDER_PATTERN = re.compile(r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}")
+
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    """
+    A template split into literal segments and placeholder slots:
+    segments[0] + value(slots[0]) + segments[1] + ... + segments[-1].
+    Unknown placeholders are kept as literal text, as before, and listed in unknown_placeholders.
+    """
+    segments: Tuple[str, ...]
+    slots: Tuple[str, ...]
+    unknown_placeholders: Tuple[str, ...] = ()
+
+    def render(self, values: Dict[str, str]) -> str:
+        parts = [self.segments[0]]
+        for slot, literal in zip(self.slots, self.segments[1:]):
+            parts.append(values.get(slot, ""))
+            parts.append(literal)
+        return "".join(parts)
+
+
+def compile_template(template: Optional[str]) -> CompiledTemplate:
+    if not template:
+        return CompiledTemplate(segments=("",), slots=())
+    segments, slots, unknown = [], [], []
+    literal_start = 0
+    for match in _PLACEHOLDER_PATTERN.finditer(template):
+        name = match.group(1)
+        if name not in KNOWN_PLACEHOLDERS:
+            if name not in unknown: unknown.append(name)
+            continue # Left in place as part of the surrounding literal text
+        segments.append(template[literal_start:match.start()])
+        slots.append(name)
+        literal_start = match.end()
+    segments.append(template[literal_start:])
+    return CompiledTemplate(segments=tuple(segments), slots=tuple(slots), unknown_placeholders=tuple(unknown))
+
+
+def lead_placeholder_values(lead_orm_obj: Any) -> Dict[str, str]:
+    """Placeholder values for one lead; computed once and shared by every template rendered for it."""
+    lead_name = getattr(lead_orm_obj, "name", "")
+    first_name = lead_name.split(" ")[0] if lead_name else "there"
+    values = {
+        "lead_name": lead_name or "there",
+        "lead_first_name": first_name,
+        "company_name": getattr(lead_orm_obj, "company", "your company"),
+        "title": getattr(lead_orm_obj, "title", "your role"),
+        "industry": getattr(lead_orm_obj, "industry", "your industry"),
+        "location": getattr(lead_orm_obj, "location", "your area"),
+    }
+    return {key: str(value) if value is not None else "" for key, value in values.items()}
+
+
+class CompiledStepTemplateCache:
+    """
+    LRU cache of compiled (subject, body) templates per campaign step, keyed by
+    (campaign_step.id, updated_at) so an edited step is recompiled automatically.
+    Unknown placeholders are logged once, when the step is compiled.
+    """
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[int, Optional[datetime]], Tuple[CompiledTemplate, CompiledTemplate]]" = OrderedDict()
+
+    def get(self, campaign_step: Any) -> Tuple[CompiledTemplate, CompiledTemplate]:
+        key = (campaign_step.id, getattr(campaign_step, "updated_at", None))
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                return compiled
+
+        compiled = (compile_template(campaign_step.subject_template), compile_template(campaign_step.body_template))
+        unknown = sorted(set(compiled[0].unknown_placeholders) | set(compiled[1].unknown_placeholders))
+        if unknown:
+            logger.warning(f"Templating: Campaign step {campaign_step.id} (Campaign {getattr(campaign_step, 'campaign_id', None)}) "
+                           f"uses unknown placeholders {unknown}; they will be sent verbatim.")
+        with self._lock:
+            self._entries[key] = compiled
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return compiled
@@ -0,0 +1,105 @@
+# scripts/bench_reply_cleaner.py
+"""
+Micro-benchmark for app.utils.reply_text_cleaner against the regex split it replaced.
+
+Runs both cleaners over a corpus of common reply shapes (Gmail, Outlook, Apple Mail,
+localized clients, mobile signatures, inline quoting) plus inputs that made the old
+pattern backtrack, and prints the mean time per call for each.
+
+    python -m scripts.bench_reply_cleaner
+    python -m scripts.bench_reply_cleaner --repeat 200 --pathological-size 2000
+
+The legacy pattern is cubic on whitespace-padded attributions (about 3 s per call at
+1,000 characters), so large --pathological-size values mostly time the old cleaner.
+"""
+
+import argparse
+import re
+import sys
+import time
+
+from app.utils.reply_text_cleaner import clean_reply_text
+
+QUOTED_HISTORY = "\n".join(f"> Line {n} of the original campaign email, quoted back by the client." for n in range(40))
+
+REPLY_SHAPES = {
+    "gmail": (
+        "Thanks, Tuesday at 3pm works for me.\n\nBest,\nDana\n\n"
+        "On Mon, Jan 8, 2024 at 9:14 AM Alex Rivera <alex@example.com> wrote:\n" + QUOTED_HISTORY
+    ),
+    "gmail_wrapped_attribution": (
+        "Sure, send over the deck.\n\n"
+        "On Mon, Jan 8, 2024 at 9:14 AM Alexandra Rivera-Montgomery <\nalexandra.rivera@example.com> wrote:\n" + QUOTED_HISTORY
+    ),
+    "outlook": (
+        "Not interested at this time, please remove me.\r\n\r\n"
+        "________________________________\r\nFrom: Alex Rivera <alex@example.com>\r\n"
+        "Sent: Monday, January 8, 2024 9:14 AM\r\nTo: Dana Lee <dana@example.org>\r\nSubject: Quick question\r\n\r\n"
+        + QUOTED_HISTORY.replace("> ", "")
+    ),
+    "outlook_original_message": (
+        "Can you call me next week?\n\n-----Original Message-----\nFrom: Alex Rivera\nSent: Monday\n" + QUOTED_HISTORY
+    ),
+    "apple_mail_german": (
+        "Ja, gerne. Passt Donnerstag?\n\n"
+        "Am 08.01.2024 um 09:14 schrieb Alex Rivera <alex@example.com>:\n\n" + QUOTED_HISTORY
+    ),
+    "french": "Oui, merci.\n\nLe lun. 8 janv. 2024 à 09:14, Alex Rivera <alex@example.com> a écrit :\n" + QUOTED_HISTORY,
+    "spanish": "Me interesa.\n\nEl lun, 8 ene 2024 a las 9:14, Alex Rivera (<alex@example.com>) escribió:\n" + QUOTED_HISTORY,
+    "mobile_signature": "Call me tomorrow.\n\nSent from my iPhone\n\n" + QUOTED_HISTORY,
+    "signature_delimiter": "Happy to chat.\n\n-- \nDana Lee\nVP Sales, Example Org\n+1 555 0100\n",
+    "inline_answers": "\n".join(f"> Question {n}?\nAnswer {n}." for n in range(20)),
+}
+
+
+def _pathological_shapes(size: int) -> dict:
+    return {
+        # A long single-line body that never closes the attribution
+        "long_single_line": "On " + "word " * (size // 5),
+        # Whitespace between "On" and the rest made the old pattern's \s+ .* \s+ try every split
+        "whitespace_padded_attribution": "Reply\nOn" + " " * size + "x",
+        "many_attribution_like_lines": "\nOn the call we said " * (size // 20),
+    }
+
+
+_LEGACY_PATTERN = r'\n\s*(?:On|El|Le)\s+.*\s+(?:wrote|écrit|escribió):|\n\s*--\s*\n?>'
+
+
+def legacy_clean_reply_text(text: str) -> str:
+    """The cleaner before app.utils.reply_text_cleaner; its pattern was compiled (cache lookup) on every call."""
+    return re.split(_LEGACY_PATTERN, text, 1)[0].strip()
+
+
+def _time_per_call(cleaner, text: str, repeat: int, budget_seconds: float) -> float:
+    started = time.perf_counter()
+    calls = 0
+    while calls < repeat:
+        cleaner(text)
+        calls += 1
+        if time.perf_counter() - started > budget_seconds:
+            break
+    return (time.perf_counter() - started) / calls
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=1000, help="Calls per shape and cleaner")
+    parser.add_argument("--pathological-size", type=int, default=1000, help="Approximate length of the pathological inputs (the legacy pattern is cubic in it)")
+    parser.add_argument("--budget-seconds", type=float, default=5.0, help="Stop timing a shape/cleaner pair after this long")
+    args = parser.parse_args()
+
+    corpus = {**REPLY_SHAPES, **_pathological_shapes(args.pathological_size)}
+    print(f"{'shape':<32}{'chars':>8}{'legacy µs':>14}{'cleaner µs':>14}{'speedup':>10}")
+    for name, text in corpus.items():
+        legacy = _time_per_call(legacy_clean_reply_text, text, args.repeat, args.budget_seconds) * 1e6
+        current = _time_per_call(clean_reply_text, text, args.repeat, args.budget_seconds) * 1e6
+        print(f"{name:<32}{len(text):>8}{legacy:>14.1f}{current:>14.1f}{legacy / current:>9.1f}x")
+
+    print("\nCleaned output:")
+    for name, text in REPLY_SHAPES.items():
+        print(f"  {name:<30}{clean_reply_text(text)!r}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
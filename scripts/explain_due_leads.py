@@ -0,0 +1,136 @@
+# scripts/explain_due_leads.py
+"""
+EXPLAIN benchmark for the email scheduler's due-lead scan.
+
+Compares the original OR-filtered query with the UNION ALL form used by
+database._due_lead_campaign_statuses and reports whether Postgres serves it from
+the partial index ix_lcs_active_due_org.
+
+    # Existing databases: create_all() does not add indexes to existing tables
+    python -m scripts.explain_due_leads --create-index
+
+    # Scratch database only: seed synthetic rows, then compare plans
+    python -m scripts.explain_due_leads --seed-rows 10000000 --seed-orgs 500 --scratch-db
+
+Uses DATABASE_URL from app settings. Exits non-zero if the rewritten query does not
+use the partial index.
+"""
+
+import argparse
+import sys
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import select, text
+from sqlalchemy.schema import CreateIndex
+
+from app.db import database, models
+from app.schemas import LeadStatusEnum
+
+INDEX_NAME = "ix_lcs_active_due_org"
+
+SEED_SQL = """
+WITH orgs AS (
+    INSERT INTO organizations (name)
+    SELECT :prefix || g FROM generate_series(1, :orgs) g
+    RETURNING id
+), camps AS (
+    INSERT INTO email_campaigns (organization_id, name, is_active, ai_status)
+    SELECT id, 'explain-bench', true, 'completed' FROM orgs
+    RETURNING id, organization_id
+), numbered_camps AS (
+    SELECT id, organization_id, row_number() OVER (ORDER BY id) - 1 AS idx FROM camps
+), lead_rows AS (
+    INSERT INTO leads (organization_id, email, matched, crm_status, appointment_confirmed)
+    -- Skewed on purpose: low-numbered orgs get most of the leads
+    SELECT c.organization_id, :prefix || g || '@bench.invalid', false, 'pending', false
+    FROM generate_series(1, :rows) g
+    JOIN numbered_camps c ON c.idx = floor(:orgs * power(random(), 3))::int
+    RETURNING id, organization_id
+)
+INSERT INTO lead_campaign_status (lead_id, campaign_id, organization_id, current_step_number, status, next_email_due_at)
+SELECT l.id, c.id, l.organization_id, s.step,
+       CASE WHEN random() < 0.3 THEN 'active' ELSE 'completed_sequence' END,
+       CASE WHEN s.step = 0 AND random() < 0.05 THEN NULL
+            ELSE now() + (random() * 31 - 1) * interval '1 day' END
+FROM lead_rows l
+JOIN camps c ON c.organization_id = l.organization_id
+CROSS JOIN LATERAL (SELECT floor(random() * 4)::int AS step) s
+"""
+
+
+def _compile(statement) -> str:
+    return str(statement.compile(dialect=database.engine.dialect, compile_kwargs={"literal_binds": True}))
+
+
+def _compile_index(index) -> str:
+    ddl = str(CreateIndex(index).compile(dialect=database.engine.dialect))
+    return ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY IF NOT EXISTS", 1)
+
+
+def _due_queries(now: datetime, limit: int):
+    lcs = models.LeadCampaignStatus
+    legacy = select(lcs.id).where(database._lead_campaign_status_due_filter(now)).order_by(
+        lcs.next_email_due_at.asc().nulls_first(), lcs.organization_id
+    ).limit(limit)
+    due = database._due_lead_campaign_statuses(now)
+    rewritten = select(due.c.id).order_by(
+        due.c.next_email_due_at.asc().nulls_first(), due.c.organization_id
+    ).limit(limit)
+    return {"or_filter": legacy, "union_all": rewritten}
+
+
+def _explain(connection, name: str, statement) -> str:
+    started = time.perf_counter()
+    plan_rows = connection.execute(text("EXPLAIN (ANALYZE, BUFFERS) " + _compile(statement))).fetchall()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    plan = "\n".join(row[0] for row in plan_rows)
+    print(f"=== {name} ({elapsed_ms:.1f} ms wall) ===\n{plan}\n")
+    return plan
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--create-index", action="store_true", help=f"CREATE INDEX CONCURRENTLY {INDEX_NAME} if it is missing")
+    parser.add_argument("--seed-rows", type=int, default=0, help="Synthetic lead_campaign_status rows to insert")
+    parser.add_argument("--seed-orgs", type=int, default=100, help="Organizations to spread seeded rows over")
+    parser.add_argument("--scratch-db", action="store_true", help="Confirms DATABASE_URL is a scratch database (required for seeding)")
+    parser.add_argument("--limit", type=int, default=500, help="Batch size to explain (EMAIL_SCHEDULER_CLAIM_BATCH_SIZE)")
+    args = parser.parse_args()
+
+    if args.seed_rows:
+        if not args.scratch_db:
+            parser.error("--seed-rows writes synthetic organizations and leads; pass --scratch-db to confirm.")
+        started = time.perf_counter()
+        with database.engine.begin() as connection:
+            connection.execute(text(SEED_SQL), {
+                "prefix": f"explain-bench-{int(time.time())}-", "orgs": args.seed_orgs, "rows": args.seed_rows
+            })
+        print(f"Seeded {args.seed_rows} rows over {args.seed_orgs} orgs in {time.perf_counter() - started:.1f}s.")
+
+    if args.create_index:
+        index = next(idx for idx in models.LeadCampaignStatus.__table__.indexes if idx.name == INDEX_NAME)
+        ddl = _compile_index(index)
+        # CONCURRENTLY can't run inside a transaction block
+        with database.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.execute(text(ddl))
+        print(f"Ensured index: {ddl}")
+
+    with database.engine.connect() as connection:
+        connection.execute(text("ANALYZE lead_campaign_status"))
+        active_rows = connection.execute(
+            text("SELECT count(*) FROM lead_campaign_status WHERE status = :status"), {"status": LeadStatusEnum.active.value}
+        ).scalar()
+        print(f"lead_campaign_status active rows: {active_rows}\n")
+        plans = {name: _explain(connection, name, query)
+                 for name, query in _due_queries(datetime.now(timezone.utc), args.limit).items()}
+
+    if INDEX_NAME not in plans["union_all"]:
+        print(f"FAIL: the UNION ALL due scan does not use {INDEX_NAME}.")
+        return 1
+    print(f"OK: the UNION ALL due scan uses {INDEX_NAME}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+# tests/test_batch_writer.py
+
+from app.db import batch_writer
+from app.db.batch_writer import LeadCampaignStatusBatchWriter
+
+
+class FakeSession:
+    """Tracks rows written in the open transaction separately from committed ones."""
+    def __init__(self):
+        self.pending_logs = []
+        self.committed_logs = []
+
+    def commit(self):
+        self.committed_logs.extend(self.pending_logs)
+        self.pending_logs = []
+
+    def rollback(self):
+        self.pending_logs = []
+
+
+def test_sent_logs_survive_failed_bulk_status_update(monkeypatch):
+    db = FakeSession()
+    status_updates = []
+
+    def fake_log_sent_emails(session, rows, commit=True):
+        session.pending_logs.extend(rows)
+        if commit:
+            session.commit()
+        return list(range(len(rows)))
+
+    def failing_bulk_update(session, updates, commit=True):
+        session.rollback()
+        return None
+
+    def fake_update_lead_campaign_status(session, status_id, organization_id, updates):
+        status_updates.append(status_id)
+        return object()
+
+    monkeypatch.setattr(batch_writer.database, "log_sent_emails", fake_log_sent_emails)
+    monkeypatch.setattr(batch_writer.database, "bulk_update_lead_campaign_statuses", failing_bulk_update)
+    monkeypatch.setattr(batch_writer.database, "update_lead_campaign_status", fake_update_lead_campaign_status)
+
+    writer = LeadCampaignStatusBatchWriter(db)
+    log_rows = [
+        {"lead_campaign_status_id": status_id, "organization_id": 1, "lead_id": status_id, "campaign_id": 7,
+         "campaign_step_id": 3, "message_id_header": f"<msg-{status_id}@example.com>",
+         "to_email": f"lead{status_id}@example.com", "subject": "Hello"}
+        for status_id in (10, 11)
+    ]
+    for row in log_rows:
+        writer.add_sent_email_log(row)
+        writer.add(row["lead_campaign_status_id"], 1, {"current_step_number": 1})
+
+    assert writer.flush() == 2
+    assert db.committed_logs == log_rows
+    assert status_updates == [10, 11]
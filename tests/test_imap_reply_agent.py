@@ -0,0 +1,37 @@
+# tests/test_imap_reply_agent.py
+
+from types import SimpleNamespace
+from unittest import mock
+
+from app.agents import imap_reply_agent
+from app.agents.imap_reply_agent import ImapReplyAgent
+
+
+def _agent_with_replies(uids, store_side_effect):
+    """An ImapReplyAgent whose IMAP fetches and lead linking are faked for the given UIDs."""
+    agent = object.__new__(ImapReplyAgent) # Skip __init__: no classifier or worker pool needed
+    agent._uid_fetch = mock.Mock(return_value={uid: f"Message-ID: <reply-{uid}@example.com>\r\n".encode() for uid in uids})
+    agent._parse_reply_headers = lambda message: {"message_id_header": message["Message-ID"]}
+    agent._link_replies_to_leads = mock.Mock(side_effect=lambda db, org_id, headers_by_uid: {uid: {"lead_id": uid} for uid in headers_by_uid})
+    agent._fetch_reply_texts = mock.Mock(return_value={uid: "Sounds good" for uid in uids})
+    agent._store_and_classify_reply = mock.Mock(side_effect=store_side_effect)
+    agent._mark_seen = mock.Mock()
+    return agent
+
+
+def test_last_poll_uid_stays_below_reply_whose_store_raised(monkeypatch):
+    update_settings = mock.Mock()
+    monkeypatch.setattr(imap_reply_agent.db_ops, "get_stored_reply_message_ids", mock.Mock(return_value=set()))
+    monkeypatch.setattr(imap_reply_agent.db_ops, "update_organization_email_settings_field", update_settings)
+
+    agent = _agent_with_replies([11, 12, 13], [True, RuntimeError("database went away"), True])
+    imap_conn = mock.Mock()
+    imap_conn.uid.return_value = ("OK", [b"11 12 13"])
+    org_settings = SimpleNamespace(organization_id=1, last_imap_poll_uid="10", last_imap_uidvalidity="42")
+
+    agent.process_mailbox(mock.Mock(), imap_conn, org_settings, "42")
+
+    assert agent._store_and_classify_reply.call_count == 3
+    update_settings.assert_called_once()
+    assert update_settings.call_args.args[2]["last_imap_poll_uid"] == "11"
+    agent._mark_seen.assert_called_once_with(imap_conn, [11, 13], 1)